@@ -0,0 +1,171 @@
+# Benchmark offline: N chat x M UID chạy với mock_server.py thay cho Golike + Telegram.
+#
+#   python bench.py --chats 50 --accounts 5 --duration 60 --out before.json
+#   python bench.py --chats 50 --accounts 5 --duration 60 --engine asyncio --compare before.json
+#   python bench.py --chats 10 --accounts 50 --workers 4 --compare before.json         # nhiều worker mỗi nền tảng
+#   python bench.py --memory 10000 --state-cache-max 1000000 --out mem.json   # RAM của 10k chat đã dừng (không bỏ bớt)
+#
+# Báo cáo: số vòng hỏi job/giây, job hoàn thành/giây, p50/p99 độ trễ một vòng worker (khoảng cách giữa
+# 2 lần hỏi job liên tiếp của cùng worker), số lời gọi Telegram mỗi job, số thread và RSS lớn nhất.
+# Mock server chạy ở tiến trình con, nên thread/RSS đo được chỉ là của bot.
+# Chế độ --memory: dựng N UserJobState như khi N chat gõ /status rồi bỏ đi, đo RSS + bộ nhớ Python cho mỗi 10k chat.
+# Kết quả tham chiếu trong benchmarks/: memory-before.json (ib.py trước khi giới hạn registry) và memory-after.json,
+# cùng lệnh --memory 10000 --state-cache-max 1000000; memory-default-*.json là lệnh --memory 10000 (giới hạn mặc định).
+#   python bench.py --memory 10000 --state-cache-max 1000000 --compare benchmarks/memory-before.json
+import argparse
+import gc
+import json
+import os
+import platform as platform_module
+import subprocess
+import sys
+import threading
+import time
+import tracemalloc
+import urllib.request
+
+MOCK_SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_server.py')
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f: return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def percentile(values, q):
+    if not values: return 0.0
+    values = sorted(values); return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def start_mock(args):
+    # -> (process, base_url); port 0 để hệ điều hành chọn cổng trống, mock in URL thật ở dòng đầu.
+    command = [sys.executable, MOCK_SERVER, '--port', '0', '--accounts', str(args.accounts), '--latency-ms', str(args.latency_ms),
+               '--jitter-ms', str(args.jitter_ms), '--job-rate', str(args.job_rate), '--error-rate', str(args.error_rate),
+               '--tg-429-rate', str(args.tg_429_rate), '--retry-after', str(args.retry_after), '--seed', str(args.seed)]
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline().strip()
+    if not line.startswith("Mock server: "): process.kill(); raise RuntimeError(f"Mock server không khởi động được: {line!r}")
+    return process, line.split(": ", 1)[1]
+
+
+def mock_call(base_url, path):
+    with urllib.request.urlopen(base_url + path, timeout=30) as response: return json.load(response)
+
+
+def import_bot(base_url, args):
+    # ib.py đọc cấu hình từ biến môi trường lúc import, nên phải đặt trước khi import.
+    os.environ.update({'BOT_TOKEN': '1:bench', 'GOLIKE_API_BASE': base_url, 'TELEGRAM_API_URL': base_url, 'STORAGE_BACKEND': 'memory',
+                       'JOB_ENGINE': args.engine, 'JOB_DELAY_MIN': str(args.job_delay[0]), 'JOB_DELAY_MAX': str(args.job_delay[1]),
+                       'NO_JOB_DELAY': str(args.no_job_delay), 'GLOBAL_LOG_UPDATE_INTERVAL': str(args.status_interval)})
+    if args.state_cache_max is not None: os.environ['STATE_CACHE_MAX'] = str(args.state_cache_max)
+    import ib
+    return ib
+
+
+def run(args):
+    mock, base_url = start_mock(args)
+    try: return measure(import_bot(base_url, args), base_url, args)
+    finally: mock.terminate(); mock.wait()
+
+
+def measure(ib, base_url, args):
+    baseline_threads = threading.active_count(); baseline_rss = rss_bytes()
+
+    states = []
+    for index in range(args.chats):
+        chat_id = 10_000 + index; token = f"Bearer bench-{index}"
+        state = ib.UserJobState(token, chat_id, {'instagram': True, 'threads': True}, {'instagram': args.workers, 'threads': args.workers}); ib.USER_JOB_STATES[chat_id] = state
+        lists = ib.ACCOUNT_CACHE.get(token)
+        state.last_status_message_id = ib.tg_send(chat_id, state.generate_status_text(), parse_mode='Markdown').result(30).message_id
+        state.start_workers(lists['instagram'][0], lists['threads'][0]); states.append(state)
+
+    mock_call(base_url, '/__reset'); started = time.monotonic(); peak_threads = peak_rss = 0
+    while time.monotonic() - started < args.duration:
+        peak_threads = max(peak_threads, threading.active_count()); peak_rss = max(peak_rss, rss_bytes()); time.sleep(0.5)
+    elapsed = time.monotonic() - started; snapshot = mock_call(base_url, '/__stats')
+    workers = [worker for state in states for worker in state.threads]
+    for state in states: state.stop_workers(wait=False)
+    ib.WORKER_WATCHDOG.join(workers, 10); ib.OUTBOX.shutdown()
+
+    calls = snapshot['calls']
+    polls = sum(v for k, v in calls.items() if k.endswith('.jobs'))
+    completed = sum(v for k, v in calls.items() if k.endswith('.complete-jobs'))
+    telegram_calls = sum(v for k, v in calls.items() if k.startswith('telegram.') and k != 'telegram.429')
+    loop_latencies = [b - a for times in snapshot['poll_times'].values() for a, b in zip(times, times[1:])]
+    return {
+        'params': {k: v for k, v in vars(args).items() if k not in ('out', 'compare')},
+        'python': platform_module.python_version(), 'elapsed_s': round(elapsed, 2),
+        'job_cycles_per_s': round(polls / elapsed, 2), 'jobs_completed_per_s': round(completed / elapsed, 3),
+        'loop_latency_p50_ms': round(percentile(loop_latencies, 0.5) * 1000, 1), 'loop_latency_p99_ms': round(percentile(loop_latencies, 0.99) * 1000, 1),
+        'telegram_calls': telegram_calls, 'telegram_calls_per_job': round(telegram_calls / completed, 2) if completed else None,
+        'telegram_429': calls.get('telegram.429', 0), 'golike_errors': calls.get('golike.error', 0),
+        'threads_baseline': baseline_threads, 'threads_peak': peak_threads,
+        'rss_baseline_mb': round(baseline_rss / 2**20, 1), 'rss_peak_mb': round(peak_rss / 2**20, 1),
+        'calls': calls,
+    }
+
+
+def run_memory(args):
+    # Không cần mock server: chỉ dựng state trong RAM (Database = memory), không gọi mạng.
+    ib = import_bot('http://127.0.0.1:9', args)
+    states = ib.USER_JOB_STATES; created = args.memory
+    gc.collect(); baseline_rss = rss_bytes(); tracemalloc.start(); before, _ = tracemalloc.get_traced_memory()
+    for index in range(created):
+        chat_id = 10_000 + index; state = ib.UserJobState(f"Bearer bench-{index}", chat_id, {'instagram': True, 'threads': True})
+        states[chat_id] = state; state.add_activity_log("Dữ liệu Status được khôi phục từ Database.")
+    gc.collect(); traced, _ = tracemalloc.get_traced_memory(); tracemalloc.stop(); rss = rss_bytes()
+    resident = len(states); per_10k = lambda total: round(total / max(resident, 1) * 10_000 / 2**20, 2)
+    return {
+        'mode': 'memory', 'params': {k: v for k, v in vars(args).items() if k not in ('out', 'compare')}, 'python': platform_module.python_version(),
+        'states_created': created, 'states_resident': resident, 'state_registry': states.stats() if hasattr(states, 'stats') else None,
+        'rss_delta_mb': round((rss - baseline_rss) / 2**20, 2), 'python_alloc_mb': round((traced - before) / 2**20, 2),
+        'rss_per_10k_resident_mb': per_10k(rss - baseline_rss), 'python_alloc_per_10k_resident_mb': per_10k(traced - before),
+        'bytes_per_resident_state': round((traced - before) / max(resident, 1)),
+    }
+
+
+COMPARED_METRICS = ('job_cycles_per_s', 'jobs_completed_per_s', 'loop_latency_p50_ms', 'loop_latency_p99_ms',
+                    'telegram_calls_per_job', 'threads_peak', 'rss_peak_mb')
+MEMORY_METRICS = ('states_resident', 'rss_delta_mb', 'python_alloc_mb', 'rss_per_10k_resident_mb', 'python_alloc_per_10k_resident_mb', 'bytes_per_resident_state')
+
+
+def compare(result, baseline_path):
+    with open(baseline_path, encoding='utf-8') as f: baseline = json.load(f)
+    print(f"\n{'metric':<24} {'baseline':>12} {'hiện tại':>12} {'thay đổi':>10}")
+    for key in (MEMORY_METRICS if result.get('mode') == 'memory' else COMPARED_METRICS):
+        old, new = baseline.get(key), result.get(key)
+        change = f"{(new - old) / old * 100:+.1f}%" if isinstance(old, (int, float)) and isinstance(new, (int, float)) and old else "-"
+        print(f"{key:<24} {str(old):>12} {str(new):>12} {change:>10}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark bot với mock Golike/Telegram.")
+    parser.add_argument('--chats', type=int, default=20); parser.add_argument('--accounts', type=int, default=5, help="UID mỗi nền tảng mỗi chat")
+    parser.add_argument('--duration', type=float, default=30, help="Số giây đo")
+    parser.add_argument('--engine', choices=('thread', 'asyncio'), default='thread')
+    parser.add_argument('--workers', type=int, default=1, help="Số worker mỗi nền tảng mỗi chat (UID chia thành nhóm rời nhau)")
+    parser.add_argument('--job-delay', type=float, nargs=2, default=(0.5, 1.0), metavar=('MIN', 'MAX'), help="Nghỉ sau mỗi job (thay cho 8-15s)")
+    parser.add_argument('--no-job-delay', type=float, default=0.2); parser.add_argument('--status-interval', type=int, default=3)
+    parser.add_argument('--latency-ms', type=float, default=50); parser.add_argument('--jitter-ms', type=float, default=20)
+    parser.add_argument('--job-rate', type=float, default=0.3); parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--tg-429-rate', type=float, default=0.0); parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--memory', type=int, metavar='N', help="Đo RAM của N chat đã dừng thay vì chạy job")
+    parser.add_argument('--state-cache-max', type=int, help="STATE_CACHE_MAX của bot (số chat đã dừng giữ trong RAM)")
+    parser.add_argument('--out', help="Ghi kết quả JSON ra file"); parser.add_argument('--compare', help="File JSON của lần chạy trước để so sánh")
+    args = parser.parse_args(argv)
+
+    result = run_memory(args) if args.memory else run(args)
+    text = json.dumps(result, indent=2, ensure_ascii=False)
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f: f.write(text + "\n")
+    print(text)
+    if args.compare: compare(result, args.compare)
+
+
+if __name__ == '__main__':
+    main()
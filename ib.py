@@ -1,574 +1,3099 @@
-import os
-import requests
-import cloudscraper
-import threading
-import time
-import random
-import re
-from colorama import Fore, init
-from datetime import datetime, timedelta 
-from telebot import TeleBot, types
-from flask import Flask, request
-from collections import deque
-import sqlite3 
-from typing import Optional 
-import json
-
-# ==============================================================================
-# 1. CẤU HÌNH BOT VÀ MÔI TRƯỜNG
-# ==============================================================================
-
-BOT_TOKEN = os.environ.get("BOT_TOKEN", "YOUR_TELEGRAM_BOT_TOKEN")
-SERVER_URL = os.environ.get("SERVER_URL", "YOUR_RENDER_EXTERNAL_URL") 
-WEBHOOK_URL_PATH = f"/{BOT_TOKEN}"
-WEBHOOK_PORT = int(os.environ.get("PORT", 5000))
-
-bot = TeleBot(BOT_TOKEN, threaded=False)
-app = Flask(__name__)
-
-init(autoreset=True)
-
-user_states_lock = threading.Lock()
-USER_JOB_STATES = {}
-GLOBAL_LOG_UPDATE_INTERVAL = 3
-DB_FILE = 'user_tokens.db' 
-
-
-# ==============================================================================
-# PHẦN QUẢN LÝ PERSISTENT DATA BẰNG SQLITE3
-# ==============================================================================
-
-def init_db():
-    try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS user_auth (
-                chat_id INTEGER PRIMARY KEY,
-                auth_token TEXT NOT NULL,
-                ig_enabled INTEGER DEFAULT 1,
-                th_enabled INTEGER DEFAULT 1
-            )
-        """)
-        conn.commit()
-        conn.close()
-        print(f"✅ Database {DB_FILE} khởi tạo thành công.")
-    except Exception as e:
-        print(f"❌ Lỗi khởi tạo Database: {e}")
-
-def get_auth_data(chat_id: int) -> Optional[dict]:
-    try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute("SELECT auth_token, ig_enabled, th_enabled FROM user_auth WHERE chat_id = ?", (chat_id,))
-        row = cursor.fetchone()
-        conn.close()
-        if row: return {'auth_token': row[0],'platform_config': {'instagram': bool(row[1]), 'threads': bool(row[2])}}
-    except Exception as e: print(f"❌ Lỗi đọc Database cho chat_id {chat_id}: {e}")
-    return None
-
-def save_auth_data(chat_id: int, auth_token: str, ig_enabled: bool, th_enabled: bool):
-    try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute("""
-            INSERT INTO user_auth (chat_id, auth_token, ig_enabled, th_enabled) 
-            VALUES (?, ?, ?, ?)
-            ON CONFLICT(chat_id) DO UPDATE SET
-                auth_token = excluded.auth_token,
-                ig_enabled = excluded.ig_enabled,
-                th_enabled = excluded.th_enabled
-        """, (chat_id, auth_token, ig_enabled, th_enabled))
-        conn.commit(); conn.close()
-    except Exception as e: print(f"❌ Lỗi ghi Database cho chat_id {chat_id}: {e}")
-
-def delete_auth_data(chat_id: int):
-    try:
-        conn = sqlite3.connect(DB_FILE)
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM user_auth WHERE chat_id = ?", (chat_id,))
-        conn.commit(); conn.close()
-    except Exception as e: print(f"❌ Lỗi xóa Database cho chat_id {chat_id}: {e}")
-
-
-# ==============================================================================
-# 2. CLASS QUẢN LÝ TRẠNG THÁI VÀ LOG
-# ==============================================================================
-
-class UserJobState:
-    def __init__(self, auth_token, chat_id, platform_config: dict):
-        self.auth_token = auth_token; self.chat_id = chat_id
-        self.is_running = False; self.threads = []
-        self.platform_config = platform_config 
-        self.total_money = 0; self.total_success = 0; self.total_failed = 0
-        self.current_indexes = {'instagram': 0, 'threads': 0}
-        self.status_update_event = threading.Event()
-        self.status_updater_thread = None 
-        self.last_status_message_id = None 
-        self.activity_log = deque(maxlen=10) 
-        self.money_lock = threading.Lock(); self.success_lock = threading.Lock(); self.failed_lock = threading.Lock(); self.account_lock = threading.Lock()
-        self.last_no_job_log = {'instagram': time.time(), 'threads': time.time()}
-
-    def signal_status_update(self): self.status_update_event.set()
-
-    def send_log_message(self, message):
-        timestamp = datetime.now().strftime("%H:%M:%S"); log_message = f"`[{timestamp}] {message}`"
-        try: bot.send_message(self.chat_id, log_message, parse_mode='Markdown')
-        except: pass
-            
-    def add_activity_log(self, message):
-        vn_time = datetime.now() + timedelta(hours=7) 
-        timestamp = vn_time.strftime("%H:%M:%S")
-        self.activity_log.append(f"*{timestamp}*: {message}")
-
-    def get_next_account(self, accounts, platform):
-        with self.account_lock:
-            if not accounts: return None
-            if self.current_indexes[platform] >= len(accounts): self.current_indexes[platform] = 0
-            account = accounts[self.current_indexes[platform]]
-            self.current_indexes[platform] = (self.current_indexes[platform] + 1) % len(accounts)
-            return account
-
-    def generate_status_text(self):
-        ig_config = '✅' if self.platform_config['instagram'] else '❌'; th_config = '✅' if self.platform_config['threads'] else '❌'
-        status = "*🤖 GOLIKE ROTATOR STATUS *\n"
-        if self.is_running:
-            status += f"🟢 *Trạng thái:* ĐANG CHẠY\n"; ig_count = len([t for t in self.threads if 'INSTA_WORKER' in t.name]); th_count = len([t for t in self.threads if 'THREAD_WORKER' in t.name])
-            status += f"Cấu hình: {ig_config} IG, {th_config} Threads\n"; status += f"Worker: `{len(self.threads)}` luồng (IG:{ig_count}, TH:{th_count})\n\n"
-        else:
-            status += f"🟡 *Trạng thái:* ĐÃ DỪNG\n"; status += f"Cấu hình: {ig_config} IG, {th_config} Threads\n"; status += f"Worker: `0` luồng\n\n"
-
-        with self.money_lock: status += f"💰 *TỔNG THU NHẬP:* `{self.total_money}` xu\n"
-        with self.success_lock: status += f"✅ Thành công: `{self.total_success}`\n"
-        with self.failed_lock: status += f"❌ Thất bại: `{self.total_failed}`\n"
-            
-        status += "\n\n*🔔 LOG HOẠT ĐỘNG GẦN NHẤT (VN Time):*\n"
-        status += '\n'.join(list(self.activity_log)[-5:]) if self.activity_log else "Chưa có hoạt động nào..."
-
-        status += f"\n\n/stopjob để dừng, /config để cấu hình."
-        status += f"\n*Tự động cập nhật mỗi {GLOBAL_LOG_UPDATE_INTERVAL}s (sau khi có Job thành công: Ngay lập tức).*."
-        return status
-        
-    def update_status_message(self):
-        if not self.last_status_message_id: return
-
-        text = self.generate_status_text()
-        
-        keyboard = types.InlineKeyboardMarkup()
-        if self.is_running: 
-            keyboard.row(types.InlineKeyboardButton("⏹️ DỪNG JOB", callback_data="/stopjob"),
-                         types.InlineKeyboardButton("🔄 REFRESH (LẤY DỮ LIỆU)", callback_data="/status"))
-        else: 
-             keyboard.row(types.InlineKeyboardButton("▶️ START JOB", callback_data="/startjob"))
-        keyboard.row(types.InlineKeyboardButton("⚙️ CẤU HÌNH", callback_data="/config"), types.InlineKeyboardButton("🏠 MENU CHÍNH", callback_data="/start"))
-
-
-        try:
-            bot.edit_message_text(chat_id=self.chat_id, message_id=self.last_status_message_id, text=text, reply_markup=keyboard, parse_mode='Markdown')
-        except Exception as e:
-            if "message to edit not found" in str(e).lower(): self.last_status_message_id = None
-            elif "message is not modified" not in str(e): pass
-            pass
-
-    def start_workers(self, instagram_accounts, threads_accounts):
-        if not self.status_updater_thread or not self.status_updater_thread.is_alive():
-             self.status_updater_thread = threading.Thread(target=status_updater_thread_func, args=(self,), daemon=True, name="STATUS_UPDATER")
-             self.status_updater_thread.start()
-
-        self.is_running = True; num_started = 0; self.threads = [] 
-        
-        if self.platform_config['instagram'] and instagram_accounts:
-            t_ig = threading.Thread(target=worker_instagram_telebot, args=(self, instagram_accounts, 1), daemon=True, name="INSTA_WORKER_1")
-            self.threads.append(t_ig); t_ig.start(); self.add_activity_log(f"Đã khởi chạy IG Worker ({len(instagram_accounts)} UID)"); num_started += 1
-        if self.platform_config['threads'] and threads_accounts:
-            t_th = threading.Thread(target=worker_threads_telebot, args=(self, threads_accounts, 1), daemon=True, name="THREAD_WORKER_1")
-            self.threads.append(t_th); t_th.start(); self.add_activity_log(f"Đã khởi chạy Threads Worker ({len(threads_accounts)} UID)"); num_started += 1
-        
-        if not self.threads: self.is_running = False; self.add_activity_log("❌ Không có Worker nào được khởi chạy.")
-        return num_started
-
-    def stop_workers(self):
-        self.is_running = False; self.current_indexes = {'instagram': 0, 'threads': 0}
-        if self.threads: num_stopped = len(self.threads); self.threads = []; return num_stopped
-        return 0
-
-
-# ==============================================================================
-# 3. WORKER VÀ CÁC HÀM GOLIKE (ĐÃ FIX LỖI THỤT LỀ)
-# ==============================================================================
-
-def get_headers(auth_token): return {'accept-language': 'vi,fr-FR;q=0.9,fr;q=0.8,en-US;q=0.7,en;q=0.6','authorization': auth_token,'content-type': 'application/json;charset=utf-8','origin': 'https://app.golike.net','priority': 'u=1, i','sec-ch-ua': '"Google Chrome";v="135", "Not-A.Brand";v="8", "Chromium";v="135"','sec-ch-ua-mobile': '?1','sec-ch-ua-platform': '"Android"','sec-fetch-dest': 'empty','sec-fetch-mode': 'cors','sec-fetch-site': 'same-site','t': 'VFZSak1FNTZWVFJOUkdkNFRrRTlQUT09',}
-    
-def get_accounts_from_api(auth_token, platform="instagram"): 
-    headers = get_headers(auth_token); scraper = cloudscraper.create_scraper()
-    try:
-        url = "https://gateway.golike.net/api/instagram-account" if platform == "instagram" else "https://gateway.golike.net/api/threads-account"
-        response = scraper.get(url, headers=headers, timeout=10)
-    except Exception: return [], f"Lỗi khi lấy UID từ API {platform}: (Network Error)"
-    if response.status_code == 200:
-        data = response.json(); accounts = []
-        if data.get('success') and 'data' in data:
-            for acc in data['data']:
-                if acc.get('status') == 1 and acc.get('is_banned') == 0:
-                    name = acc.get(f'{platform}_username') or acc.get('username') or f"ID:{acc['id']}"
-                    accounts.append({'id': acc['id'], 'platform': platform, 'name': name})
-            return accounts, ""
-        else: return [], f"Lỗi Golike API: {data.get('message', 'Không thể xác định danh sách tài khoản.')}"
-    else: return [], f"Lỗi HTTP {response.status_code} khi lấy UID: {response.text}"
-    
-def nhan_xu_instagram(scraper, headers, uid_cauhinh, uid_job, price_per): 
-    json_data = { 'instagram_users_advertising_id': uid_job, 'instagram_account_id': uid_cauhinh, 'async': True, 'data': None }
-    try: response = scraper.post('https://gateway.golike.net/api/advertising/publishers/instagram/complete-jobs', headers=headers, json=json_data, timeout=5)
-    except Exception: return False, 0
-    if "thành công" in response.json().get('message', '').lower(): return True, price_per
-    return False, 0
-
-def nhan_xu_threads(scraper, headers, account_id, ads_id):
-    json_data = { 'account_id': account_id, 'ads_id': ads_id }
-    try: response = scraper.post('https://gateway.golike.net/api/advertising/publishers/threads/complete-jobs', headers=headers, json=json_data, timeout=5)
-    except Exception: return False, 0
-    data = response.json()
-    if "thành công" in data.get('message', '').lower(): return True, data.get('data', {}).get('prices', 0)
-    return False, 0
-    
-def nhan_job_instagram(scraper, headers, uid_cauhinh): 
-    params = { 'instagram_account_id': f'{uid_cauhinh}', 'data': 'null' }
-    try: response = scraper.get('https://gateway.golike.net/api/advertising/publishers/instagram/jobs', params=params, headers=headers, timeout=3)
-    except Exception: return None
-    data = response.json()
-    if data.get('success') and 'data' in data and data['data'].get('status') == 0: 
-        job_data = data['data']; return { 'id': job_data.get('id'), 'price_per': job_data.get('price_after_cost', job_data.get('price_per', 0)) }
-    return None
-
-def nhan_job_threads(scraper, headers, account_id): 
-    params = { 'account_id': f'{account_id}' }
-    try: response = scraper.get('https://gateway.golike.net/api/advertising/publishers/threads/jobs', params=params, headers=headers, timeout=3)
-    except Exception: return None
-    data = response.json()
-    if data.get('success') and 'data' in data and 'lock' in data and data['lock'] is not None: 
-        job_data = data['data']; return { 'id': job_data.get('id'), 'price_per': job_data.get('price_after_cost', job_data.get('price_per', 0)) }
-    return None
-
-
-def status_updater_thread_func(job_state: UserJobState):
-    while job_state.is_running:
-        job_state.status_update_event.wait(GLOBAL_LOG_UPDATE_INTERVAL)
-        if not job_state.is_running: break
-        job_state.update_status_message()
-        job_state.status_update_event.clear()
-
-def worker_instagram_telebot(job_state: UserJobState, accounts, worker_id):
-    scraper = cloudscraper.create_scraper(browser={'browser': 'chrome','platform': 'android','mobile': True})
-    headers = get_headers(job_state.auth_token); platform = 'instagram'
-    while job_state.is_running:
-        account = job_state.get_next_account(accounts, platform)
-        if not account:
-            if time.time() - job_state.last_no_job_log[platform] > 60: job_state.add_activity_log("⚠️ Instagram: Hết UID/cấu hình bị lỗi, tạm chờ 10s..."); job_state.last_no_job_log[platform] = time.time()
-            time.sleep(10); continue
-        account_id = account['id']; account_name = account['name']; job = nhan_job_instagram(scraper, headers, account_id)
-        if job:
-            success, money_earned = nhan_xu_instagram(scraper, headers, account_id, job['id'], job['price_per'])
-            if success:
-                with job_state.money_lock: job_state.total_money += money_earned
-                with job_state.success_lock: job_state.total_success += 1
-                job_state.add_activity_log(f"✅ INSTA `{account_name}` | +{money_earned} xu")
-            else:
-                with job_state.failed_lock: job_state.total_failed += 1
-                job_state.add_activity_log(f"❌ INSTA `{account_name}` thất bại.")
-            
-            # PHỤC HỒI/GỬI TÍN HIỆU
-            if job_state.status_updater_thread and not job_state.status_updater_thread.is_alive():
-                job_state.status_updater_thread = threading.Thread(target=status_updater_thread_func, args=(job_state,), daemon=True, name="STATUS_UPDATER"); job_state.status_updater_thread.start()
-            job_state.signal_status_update()
-            time.sleep(random.uniform(8, 15))
-        else: time.sleep(1)
-
-
-def worker_threads_telebot(job_state: UserJobState, accounts, worker_id):
-    scraper = cloudscraper.create_scraper(browser={'browser': 'chrome','platform': 'android','mobile': True})
-    headers = get_headers(job_state.auth_token); platform = 'threads'
-    while job_state.is_running:
-        account = job_state.get_next_account(accounts, platform)
-        if not account:
-            if time.time() - job_state.last_no_job_log[platform] > 60: job_state.add_activity_log("⚠️ Threads: Hết UID/cấu hình bị lỗi, tạm chờ 10s..."); job_state.last_no_job_log[platform] = time.time()
-            time.sleep(10); continue
-        account_id = account['id']; account_name = account['name']; job = nhan_job_threads(scraper, headers, account_id)
-        if job:
-            success, money_earned = nhan_xu_threads(scraper, headers, account_id, job['id'])
-            if success:
-                with job_state.money_lock: job_state.total_money += money_earned
-                with job_state.success_lock: job_state.total_success += 1
-                job_state.add_activity_log(f"✅ THREADS `{account_name}` | +{money_earned} xu")
-            else:
-                with job_state.failed_lock: job_state.total_failed += 1
-                job_state.add_activity_log(f"❌ THREADS `{account_name}` thất bại.")
-            
-            # PHỤC HỒI/GỬI TÍN HIỆU
-            if job_state.status_updater_thread and not job_state.status_updater_thread.is_alive():
-                job_state.status_updater_thread = threading.Thread(target=status_updater_thread_func, args=(job_state,), daemon=True, name="STATUS_UPDATER"); job_state.status_updater_thread.start()
-
-            job_state.signal_status_update() 
-            time.sleep(random.uniform(8, 15))
-        else: time.sleep(1)
-
-# ==============================================================================
-# 4. CHỨC NĂNG LỆNH CỦA TELEBOT (Menu đã chỉnh sửa)
-# ==============================================================================
-
-def get_menu_keyboard():
-    keyboard = types.InlineKeyboardMarkup()
-    keyboard.row(types.InlineKeyboardButton("▶️ START JOB", callback_data="/startjob"), types.InlineKeyboardButton("⏹️ STOP JOB", callback_data="/stopjob"))
-    keyboard.row(types.InlineKeyboardButton("📊 STATUS", callback_data="/status"), types.InlineKeyboardButton("⚙️ CẤU HÌNH", callback_data="/config"))
-    keyboard.row(types.InlineKeyboardButton("🔑 THÊM AUTHEN", callback_data="/auth_hint"), types.InlineKeyboardButton("🗑️ XOÁ AUTHEN", callback_data="/xoaauthen"))
-    return keyboard
-
-@bot.message_handler(commands=['start', 'help'])
-def send_welcome(message):
-    text = ("🤖 *Chào mừng đến với Golike Rotator Bot!*\n\n"
-        "Sử dụng các lệnh/nút sau để quản lý:\n"
-        "`/auth <token>`: Thêm Auth Token Golike.\n"
-        "`/config`: Chọn nền tảng chạy (IG, Threads, Cả 2).\n"
-        "`/startjob`: Bắt đầu auto đa luồng.\n"
-        "`/status`: Hiện/cập nhật tin nhắn thống kê chính (Log TỰ ĐỘNG thay đổi).\n\n"
-        "⚠️ *LƯU Ý:* Token và Config đã được lưu lại để chống mất dữ liệu khi Service ngủ/Restart.")
-    bot.send_message(message.chat.id, text, reply_markup=get_menu_keyboard(), parse_mode='Markdown')
-
-def get_config_keyboard(config: dict):
-    keyboard = types.InlineKeyboardMarkup()
-    ig_emoji = "✅ IG" if config['instagram'] else " IG"; th_emoji = "✅ Threads" if config['threads'] else " Threads"
-    keyboard.row(types.InlineKeyboardButton(ig_emoji, callback_data="config_toggle_instagram"), types.InlineKeyboardButton(th_emoji, callback_data="config_toggle_threads"))
-    keyboard.row(types.InlineKeyboardButton("CẢ HAI", callback_data="config_set_both"), types.InlineKeyboardButton("❌ KHÔNG CHẠY", callback_data="config_set_none"))
-    keyboard.row(types.InlineKeyboardButton("↩️ MENU CHÍNH", callback_data="/start"))
-    return keyboard
-
-@bot.message_handler(commands=['config'])
-def handle_config(message):
-    chat_id = message.chat.id
-    with user_states_lock: job_state = USER_JOB_STATES.get(chat_id)
-    if not job_state: 
-        db_data = get_auth_data(chat_id)
-        if not db_data: bot.send_message(chat_id, "⚠️ **Chưa có Auth Token.** Vui lòng dùng lệnh `/auth` trước.", parse_mode='Markdown'); return
-        job_state = UserJobState(db_data['auth_token'], chat_id, db_data['platform_config'])
-        USER_JOB_STATES[chat_id] = job_state
-        job_state.add_activity_log("Dữ liệu cấu hình được khôi phục từ Database.")
-        
-    if job_state.is_running: bot.send_message(chat_id, "⚠️ **Phải dùng /stopjob** để dừng Job trước khi thay đổi cấu hình.", parse_mode='Markdown'); return
-
-    current_config = job_state.platform_config
-    text = "⚙️ *CHỌN NỀN TẢNG MUỐN CHẠY TRONG PHIÊN TIẾP THEO:*\n\n"; text += f"- Instagram: {'✅ Đang bật' if current_config['instagram'] else '❌ Đang tắt'}\n"
-    text += f"- Threads: {'✅ Đang bật' if current_config['threads'] else '❌ Đang tắt'}\n"; text += "\nNhấn vào các nút bên dưới để chuyển đổi."
-
-    bot.send_message(chat_id, text, reply_markup=get_config_keyboard(current_config), parse_mode='Markdown')
-
-
-@bot.callback_query_handler(func=lambda call: call.data.startswith('config_'))
-def handle_config_callback(call):
-    chat_id = call.message.chat.id; config_action = call.data
-    
-    with user_states_lock:
-        job_state = USER_JOB_STATES.get(chat_id)
-        if not job_state or job_state.is_running: bot.answer_callback_query(call.id, "❌ Không thể thay đổi khi Job đang chạy hoặc chưa có Token.", show_alert=True); return
-             
-        current_config = job_state.platform_config
-        if config_action == 'config_toggle_instagram': current_config['instagram'] = not current_config['instagram']; bot.answer_callback_query(call.id, f"IG đã chuyển sang {'BẬT' if current_config['instagram'] else 'TẮT'}")
-        elif config_action == 'config_toggle_threads': current_config['threads'] = not current_config['threads']; bot.answer_callback_query(call.id, f"Threads đã chuyển sang {'BẬT' if current_config['threads'] else 'TẮT'}")
-        elif config_action == 'config_set_both': current_config.update({'instagram': True, 'threads': True}); bot.answer_callback_query(call.id, "✅ Đã chọn CẢ HAI.")
-        elif config_action == 'config_set_none': current_config.update({'instagram': False, 'threads': False}); bot.answer_callback_query(call.id, "❌ Đã chọn KHÔNG CHẠY CÁI NÀO.")
-        
-        save_auth_data(chat_id, job_state.auth_token, current_config['instagram'], current_config['threads'])
-        
-        new_text = "⚙️ *CHỌN NỀN TẢNG MUỐN CHẠY TRONG PHIÊN TIẾP THEO:*\n\n"
-        new_text += f"- Instagram: {'✅ Đang bật' if current_config['instagram'] else '❌ Đang tắt'}\n"; new_text += f"- Threads: {'✅ Đang bật' if current_config['threads'] else '❌ Đang tắt'}\n"; new_text += "\nNhấn vào các nút bên dưới để chuyển đổi."
-        
-        try: bot.edit_message_text(chat_id=chat_id, message_id=call.message.message_id, text=new_text, reply_markup=get_config_keyboard(current_config), parse_mode='Markdown')
-        except Exception as e:
-            if "message is not modified" not in str(e): job_state.send_log_message(f"Lỗi cập nhật cấu hình: {e}")
-        
-    
-@bot.callback_query_handler(func=lambda call: call.data in ['/startjob', '/stopjob', '/status', '/xoaauthen', '/auth_hint', '/config', '/start'])
-def handle_callback_query(call):
-    message = call.message
-    bot.answer_callback_query(call.id) 
-    if call.data == '/auth_hint': bot.send_message(message.chat.id, "Để thêm Auth Token, bạn gửi lệnh theo cú pháp sau:\n\n`/auth Bearer eyJ0eXAiOi...`\n\n*Bạn phải có khoảng trắng giữa /auth và Bearer.*", parse_mode='Markdown')
-    elif call.data == '/startjob': handle_startjob(message)
-    elif call.data == '/stopjob': handle_stopjob(message)
-    elif call.data == '/status': handle_status(message)
-    elif call.data == '/xoaauthen': handle_xoaauthen(message)
-    elif call.data == '/config': handle_config(message) 
-    elif call.data == '/start': send_welcome(message) 
-
-@bot.message_handler(commands=['auth'])
-def handle_auth(message):
-    chat_id = message.chat.id; token_match = re.match(r'/auth\s+(Bearer\s+\S+)', message.text, re.DOTALL)
-    
-    if token_match:
-        auth_token = token_match.group(1).strip()
-        job_state = USER_JOB_STATES.get(chat_id)
-        if job_state: job_state.send_log_message("🔍 Đang kiểm tra Auth Token và lấy danh sách tài khoản...")
-        else: bot.send_message(chat_id, "`🔍 Đang kiểm tra Auth Token và lấy danh sách tài khoản...`", parse_mode='Markdown') # CŨNG LÀ TIN NHẮN ĐỘC LẬP.
-        
-        instagram_accounts, err_ig = get_accounts_from_api(auth_token, "instagram"); threads_accounts, err_th = get_accounts_from_api(auth_token, "threads")
-
-        if err_ig.startswith('Lỗi HTTP 401') or err_th.startswith('Lỗi HTTP 401') : bot.send_message(chat_id, "❌ Auth Token bị từ chối (401 Unauthorized). *Token không hợp lệ hoặc đã hết hạn.*", parse_mode='Markdown'); return
-
-        with user_states_lock:
-            db_data = get_auth_data(chat_id); old_config = db_data['platform_config'] if db_data else {'instagram': True, 'threads': True}
-            
-            if chat_id in USER_JOB_STATES and USER_JOB_STATES[chat_id].is_running: USER_JOB_STATES[chat_id].stop_workers(); USER_JOB_STATES[chat_id].send_log_message("⚠️ Công việc cũ đã được dừng.")
-                
-            USER_JOB_STATES[chat_id] = UserJobState(auth_token, chat_id, old_config)
-            job_state = USER_JOB_STATES[chat_id]
-            job_state.add_activity_log(f"Token mới được thiết lập. IG:{len(instagram_accounts)}, TH:{len(threads_accounts)}")
-            
-            save_auth_data(chat_id, auth_token, old_config['instagram'], old_config['threads'])
-
-        acc_info = f"✅ Lưu Auth Token thành công!\n\n"; acc_info += f"📸 Tìm thấy {len(instagram_accounts)} UID Instagram hoạt động.\n"; acc_info += f"🧵 Tìm thấy {len(threads_accounts)} UID Threads hoạt động."
-            
-        bot.send_message(chat_id, acc_info, reply_markup=get_menu_keyboard(), parse_mode='Markdown')
-    else: bot.send_message(chat_id, "❌ Cú pháp lệnh sai. Vui lòng gửi theo mẫu:\n\n`/auth Bearer <Auth_Token>`", parse_mode='Markdown')
-
-@bot.message_handler(commands=['xoaauthen'])
-def handle_xoaauthen(message):
-    chat_id = message.chat.id
-    with user_states_lock: job_state = USER_JOB_STATES.get(chat_id)
-    if not job_state and not get_auth_data(chat_id): bot.send_message(chat_id, "🤷 Auth Token chưa được thiết lập."); return
-
-    if chat_id in USER_JOB_STATES: 
-        if USER_JOB_STATES[chat_id].is_running: USER_JOB_STATES[chat_id].stop_workers(); USER_JOB_STATES[chat_id].send_log_message("⚠️ Job đang chạy đã được dừng trước khi xoá.")
-        if USER_JOB_STATES[chat_id].last_status_message_id:
-            try: bot.delete_message(chat_id, USER_JOB_STATES[chat_id].last_status_message_id)
-            except: pass
-            
-    delete_auth_data(chat_id)
-    if chat_id in USER_JOB_STATES: del USER_JOB_STATES[chat_id]
-
-    bot.send_message(chat_id, "🗑️ Đã xoá Auth Token và dữ liệu phiên thành công. Bạn có thể thêm token mới bằng lệnh /auth.", reply_markup=get_menu_keyboard())
-
-@bot.message_handler(commands=['startjob'])
-def handle_startjob(message):
-    chat_id = message.chat.id
-    with user_states_lock: 
-        job_state = USER_JOB_STATES.get(chat_id)
-        if not job_state:
-             db_data = get_auth_data(chat_id)
-             if db_data: 
-                 job_state = UserJobState(db_data['auth_token'], chat_id, db_data['platform_config'])
-                 USER_JOB_STATES[chat_id] = job_state
-             else:
-                 bot.send_message(chat_id, "⚠️ **Auth Token đã bị mất (không tìm thấy trong Database/RAM).** Vui lòng dùng lệnh `/auth` để thiết lập lại.", parse_mode='Markdown'); return
-
-    if job_state.is_running: bot.send_message(chat_id, "⚠️ Job đã và đang chạy rồi."); return
-    if not any(job_state.platform_config.values()): bot.send_message(chat_id, "❌ Không có nền tảng nào được cấu hình chạy. Vui lòng dùng lệnh `/config` để bật Instagram, Threads, hoặc cả hai.", parse_mode='Markdown'); return
-
-    job_state.send_log_message("🔄 Đang lấy danh sách UID hoạt động để chuẩn bị chạy job...")
-    instagram_accounts, err_ig = get_accounts_from_api(job_state.auth_token, "instagram"); threads_accounts, err_th = get_accounts_from_api(job_state.auth_token, "threads")
-
-    filtered_ig = instagram_accounts if job_state.platform_config['instagram'] else []; filtered_th = threads_accounts if job_state.platform_config['threads'] else []
-    if not filtered_ig and not filtered_th: bot.send_message(chat_id, "❌ Không có tài khoản hoạt động nào để chạy với cấu hình hiện tại (kiểm tra trạng thái tài khoản trên Golike)."); return
-
-    # Gửi tin nhắn Status BAN ĐẦU (để lấy ID)
-    try:
-         if job_state.last_status_message_id: 
-            try: bot.delete_message(chat_id, job_state.last_status_message_id)
-            except: pass 
-         initial_message = bot.send_message(chat_id, job_state.generate_status_text(), parse_mode='Markdown') 
-         job_state.last_status_message_id = initial_message.message_id
-    except Exception as e: job_state.send_log_message(f"❌ Lỗi gửi tin nhắn Status ban đầu: {e}"); return
-
-    num_workers = job_state.start_workers(filtered_ig, filtered_th)
-
-    if num_workers > 0: job_state.add_activity_log(f"Đã khởi động Job Đa Luồng thành công với {num_workers} Worker."); job_state.update_status_message()
-    else: job_state.send_log_message("❌ Không thể khởi động Worker nào. Có lỗi xảy ra.")
-
-@bot.message_handler(commands=['stopjob'])
-def handle_stopjob(message):
-    chat_id = message.chat.id
-    with user_states_lock: 
-        job_state = USER_JOB_STATES.get(chat_id)
-        if not job_state: bot.send_message(chat_id, "⚠️ **Job không được tìm thấy trong bộ nhớ RAM.** Đã bị dừng hoặc chưa chạy.", parse_mode='Markdown'); return
-
-    if not job_state.is_running: bot.send_message(chat_id, "⚠️ Không có Job nào đang chạy để dừng."); return
-        
-    num_stopped = job_state.stop_workers()
-    final_money = 0
-    with job_state.money_lock: final_money = job_state.total_money
-
-    job_state.add_activity_log(f"⏹️ Job đã dừng thành công {num_stopped} Worker. Tổng tiền: {final_money}")
-    
-    if job_state.last_status_message_id: job_state.update_status_message()
-    
-    bot.send_message(chat_id, f"✅ *Đã dừng thành công {num_stopped} Worker. Tổng thu nhập phiên này: {final_money} xu.*", parse_mode='Markdown', reply_markup=get_menu_keyboard())
-
-
-@bot.message_handler(commands=['status'])
-def handle_status(message):
-    chat_id = message.chat.id
-    with user_states_lock: job_state = USER_JOB_STATES.get(chat_id)
-    
-    if not job_state:
-        db_data = get_auth_data(chat_id)
-        if db_data: 
-             job_state = UserJobState(db_data['auth_token'], chat_id, db_data['platform_config'])
-             USER_JOB_STATES[chat_id] = job_state
-             job_state.add_activity_log("Dữ liệu Status được khôi phục từ Database.")
-        else:
-            bot.send_message(chat_id, "❌ **Auth Token chưa được thiết lập** (hoặc đã bị mất hoàn toàn). Vui lòng dùng /auth.", parse_mode='Markdown', reply_markup=get_menu_keyboard()); return
-
-    if job_state.is_running:
-         if job_state.last_status_message_id:
-             try: job_state.update_status_message(); return 
-             except Exception as e:
-                 if "message to edit not found" in str(e).lower(): job_state.last_status_message_id = None
-                 else: job_state.send_log_message(f"❌ Lỗi cập nhật Status: {e}")
-         
-         if not job_state.last_status_message_id:
-            try:
-               initial_message = bot.send_message(chat_id, job_state.generate_status_text(), parse_mode='Markdown')
-               job_state.last_status_message_id = initial_message.message_id
-               return
-            except Exception as e: job_state.send_log_message(f"❌ Lỗi hiển thị Status Log mới: {e}")
-
-    else:
-        status_text = f"🟡 *Trạng thái:* ĐÃ DỪNG\n"
-        status_text += f"💰 Thu nhập phiên cuối: `{job_state.total_money}` xu\n"
-        status_text += f"✅ Thành công: `{job_state.total_success}`\n"
-        status_text += f"❌ Thất bại: `{job_state.total_failed}`\n"
-        status_text += "\nNhấn /startjob để chạy lại."
-        bot.send_message(chat_id, status_text, parse_mode='Markdown', reply_markup=get_menu_keyboard())
-
-
-# ==============================================================================
-# 5. KHỞI TẠO WEBHOOK VÀ CHẠY ỨNG DỤNG FLASK (Render)
-# ==============================================================================
-
-@app.route(WEBHOOK_URL_PATH, methods=['POST'])
-def webhook():
-    if request.headers.get('content-type') == 'application/json':
-        json_string = request.get_data().decode('utf-8')
-        update = types.Update.de_json(json_string) 
-        bot.process_new_updates([update])
-        return '', 200
-    else: return '', 403
-
-def setup_webhook():
-    if not SERVER_URL or not SERVER_URL.startswith("https://"):
-         print("❌ SERVER_URL CHƯA ĐƯỢC THIẾT LẬP HOẶC KHÔNG HỢP LỆ/KHÔNG HTTPS. KHÔNG THỂ THIẾT LẬP WEBHOOK."); return
-    webhook_url = SERVER_URL + WEBHOOK_URL_PATH
-    for attempt in range(3):
-        try:
-            bot.remove_webhook(); time.sleep(1) 
-            if bot.set_webhook(url=webhook_url): print(f"✅ Webhook đã được thiết lập thành công tới: {webhook_url}"); return
-            else: print(f"Lần {attempt+1}: set_webhook trả về False.")
-        except Exception as e: print(f"Lần {attempt+1} - Lỗi khi thiết lập Webhook: {e}")
-        time.sleep(2 ** attempt) 
-    print("❌ THIẾT LẬP WEBHOOK THẤT BẠI HOÀN TOÀN.")
-            
-@app.route('/')
-def home(): return "Golike Rotator Telebot đang hoạt động! Tương tác qua Telegram.", 200
-
-if __name__ == '__main__':
-    # Chú ý: Đổi tên file này thành bot.py nếu Start command của Render là python bot.py
-    init_db()
-    setup_webhook()
-    print(f"Bot khởi động trên cổng: {WEBHOOK_PORT}")
+import time
+BOOT_STARTED = time.perf_counter()   # mốc đo thời gian khởi động (đặt trước mọi import nặng)
+import os
+import threading
+import random
+import re
+from datetime import datetime, timedelta, timezone
+from telebot import TeleBot, types, apihelper
+from flask import Flask, request, jsonify, Response
+from collections import deque, OrderedDict
+import sqlite3 
+import queue
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from typing import Optional 
+import json
+import asyncio
+import heapq
+import bisect
+import atexit
+import hashlib
+import hmac
+import io
+import signal
+import sys
+import socket
+
+# ==============================================================================
+# 1. CẤU HÌNH BOT VÀ MÔI TRƯỜNG
+# ==============================================================================
+
+BOT_TOKEN = os.environ.get("BOT_TOKEN", "YOUR_TELEGRAM_BOT_TOKEN")
+SERVER_URL = os.environ.get("SERVER_URL", "YOUR_RENDER_EXTERNAL_URL") 
+WEBHOOK_URL_PATH = f"/{BOT_TOKEN}"
+WEBHOOK_PORT = int(os.environ.get("PORT", 5000))
+# Đổi được để chạy với server giả lập (mock_server.py) khi benchmark/thử offline.
+GOLIKE_API_BASE = os.environ.get("GOLIKE_API_BASE", "https://gateway.golike.net").rstrip('/')
+TELEGRAM_API_URL = os.environ.get("TELEGRAM_API_URL", "").rstrip('/')
+if TELEGRAM_API_URL: apihelper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+# Nghỉ sau mỗi job (ngẫu nhiên trong khoảng) và sau mỗi lần hỏi không có job.
+JOB_DELAY_MIN = float(os.environ.get("JOB_DELAY_MIN", 8)); JOB_DELAY_MAX = float(os.environ.get("JOB_DELAY_MAX", 15))
+NO_JOB_DELAY = float(os.environ.get("NO_JOB_DELAY", 1))
+
+bot = TeleBot(BOT_TOKEN, threaded=False)
+app = Flask(__name__)
+
+user_states_lock = threading.Lock()
+GLOBAL_LOG_UPDATE_INTERVAL = int(os.environ.get("GLOBAL_LOG_UPDATE_INTERVAL", 3))
+DB_FILE = 'user_tokens.db' 
+TZ_OFFSET_HOURS = float(os.environ.get("BOT_TZ_OFFSET_HOURS", 7))   # múi giờ hiển thị (mặc định giờ Việt Nam)
+DISPLAY_TZ = timezone(timedelta(hours=TZ_OFFSET_HOURS))
+ACTIVITY_LOG_SIZE = int(os.environ.get("ACTIVITY_LOG_SIZE", 20))   # số sự kiện gần nhất giữ cho mỗi chat (dashboard + /export)
+ADMIN_KEY = os.environ.get("ADMIN_KEY", "")   # khoá cho các route quản trị HTTP (/export/<chat_id>, /profile); để trống = tắt các route này
+ADMIN_CHAT_IDS = {int(x) for x in os.environ.get("ADMIN_CHAT_IDS", "").split(",") if x.strip().lstrip("-").isdigit()}   # chat được dùng /profile
+PROFILE_MAX_SECONDS = float(os.environ.get("PROFILE_MAX_SECONDS", 120)); PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", 0.01))
+# Giới hạn gửi Telegram: ~1 tin/giây mỗi chat, ~30 tin/giây toàn bot.
+TG_PER_CHAT_RATE = float(os.environ.get("TG_PER_CHAT_RATE", 1)); TG_PER_CHAT_BURST = int(os.environ.get("TG_PER_CHAT_BURST", 3))
+TG_GLOBAL_RATE = float(os.environ.get("TG_GLOBAL_RATE", 25)); TG_GLOBAL_BURST = int(os.environ.get("TG_GLOBAL_BURST", 30))
+TG_OUTBOX_MAX = int(os.environ.get("TG_OUTBOX_MAX", 5000)); TG_OUTBOX_WORKERS = int(os.environ.get("TG_OUTBOX_WORKERS", 4))
+TG_MAX_RETRIES = 3; TG_WAIT_TIMEOUT = 30
+# Webhook trả 200 ngay, update được xử lý bởi pool worker (cùng chat luôn vào cùng worker để giữ thứ tự).
+UPDATE_WORKERS = int(os.environ.get("UPDATE_WORKERS", 8)); UPDATE_QUEUE_MAX = int(os.environ.get("UPDATE_QUEUE_MAX", 1000))
+UPDATE_ENQUEUE_TIMEOUT = float(os.environ.get("UPDATE_ENQUEUE_TIMEOUT", 0.5))
+# "thread": mỗi worker một OS thread (mặc định). "asyncio": mọi worker của mọi chat chạy như task trên MỘT event loop.
+JOB_ENGINE = os.environ.get("JOB_ENGINE", "thread").strip().lower()
+ASYNC_HTTP_LIMIT = int(os.environ.get("ASYNC_HTTP_LIMIT", 100))
+ASYNC_SPAWN_TIMEOUT = float(os.environ.get("ASYNC_SPAWN_TIMEOUT", 10))   # giây chờ event loop nhận task worker mới
+SESSION_POOL_MAX = int(os.environ.get("SESSION_POOL_MAX", 200))               # số session (token) giữ cùng lúc
+SESSION_POOL_CONNECTIONS = int(os.environ.get("SESSION_POOL_CONNECTIONS", 4))  # connection keep-alive tối đa mỗi host/session
+SESSION_IDLE_TTL = int(os.environ.get("SESSION_IDLE_TTL", 300))                # giây không dùng thì đóng session
+ACCOUNT_CACHE_TTL = int(os.environ.get("ACCOUNT_CACHE_TTL", 120))              # danh sách UID còn "tươi"
+ACCOUNT_CACHE_STALE_TTL = int(os.environ.get("ACCOUNT_CACHE_STALE_TTL", 900))  # quá TTL nhưng chưa tới mốc này: trả bản cũ + làm mới nền
+ACCOUNT_CACHE_MAX = int(os.environ.get("ACCOUNT_CACHE_MAX", 2000))             # số token giữ danh sách UID (LRU)
+# Chọn UID: "yield" (ưu tiên UID hay có job, UID trống bị cooldown tăng dần) hoặc "roundrobin" (xoay vòng cố định như cũ).
+ACCOUNT_SCHEDULER = os.environ.get("ACCOUNT_SCHEDULER", "yield").strip().lower()
+SCHED_COOLDOWN_BASE = float(os.environ.get("SCHED_COOLDOWN_BASE", 2)); SCHED_COOLDOWN_MAX = float(os.environ.get("SCHED_COOLDOWN_MAX", 300))
+SCHED_TRACE_FILE = os.environ.get("SCHED_TRACE_FILE", "")   # ghi lại mọi lần hỏi job (JSONL) để chạy lại bằng sim_scheduler.py
+# Số worker mỗi nền tảng của một chat (chỉnh bằng /config, lưu trong user_auth): UID được chia thành các nhóm rời nhau,
+# mỗi worker hỏi một nhóm. TOKEN_MAX_INFLIGHT giới hạn số request Golike đang chờ cùng lúc của một token, dù có bao nhiêu worker.
+WORKERS_PER_PLATFORM = int(os.environ.get("WORKERS_PER_PLATFORM", 1)); WORKERS_MAX = int(os.environ.get("WORKERS_MAX", 8))
+TOKEN_MAX_INFLIGHT = int(os.environ.get("TOKEN_MAX_INFLIGHT", 4))
+# Dừng worker: mỗi worker có stop event riêng (ngắt sleep ngay), lời gọi complete-jobs đang chạy được làm xong (drain) rồi mới thoát.
+# /stopjob chờ tối đa WORKER_STOP_TIMEOUT giây; worker chưa thoát kịp được watchdog theo dõi (quét mỗi WORKER_WATCHDOG_INTERVAL giây).
+WORKER_STOP_TIMEOUT = float(os.environ.get("WORKER_STOP_TIMEOUT", 8)); WORKER_WATCHDOG_INTERVAL = float(os.environ.get("WORKER_WATCHDOG_INTERVAL", 30))
+
+
+# ==============================================================================
+# PHẦN QUẢN LÝ PERSISTENT DATA BẰNG SQLITE3
+# ==============================================================================
+
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", 4))
+# "sqlite" (mặc định, file DB_FILE), "postgres" (cần DATABASE_URL, dùng chung được giữa các replica) hoặc "memory".
+STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "postgres" if os.environ.get("DATABASE_URL") else "sqlite").strip().lower()
+DATABASE_URL = os.environ.get("DATABASE_URL", "")
+# Lần đầu chạy với Postgres trống: chép dữ liệu từ user_tokens.db cũ sang (nếu file còn).
+STORAGE_IMPORT_SQLITE = os.environ.get("STORAGE_IMPORT_SQLITE", "1") == "1"
+# Cache user_auth trong RAM (LRU, hết hạn sau AUTH_CACHE_TTL giây). Chỉ an toàn khi node này là nơi duy nhất ghi DB,
+# nên mặc định tắt với Postgres (dùng chung giữa các replica) hoặc khi bật sharding (NODE_URL); AUTH_CACHE=1/0 để ép bật/tắt.
+AUTH_CACHE_SIZE = int(os.environ.get("AUTH_CACHE_SIZE", 10000)); AUTH_CACHE_TTL = float(os.environ.get("AUTH_CACHE_TTL", 60))
+# Sổ cái job được ghi theo lô bởi một thread nền; worker chỉ đẩy vào hàng đợi (đầy thì bỏ dòng, không chờ đĩa).
+LEDGER_BATCH_SIZE = int(os.environ.get("LEDGER_BATCH_SIZE", 200)); LEDGER_FLUSH_INTERVAL = float(os.environ.get("LEDGER_FLUSH_INTERVAL", 2))
+LEDGER_QUEUE_MAX = int(os.environ.get("LEDGER_QUEUE_MAX", 20000))
+# Warm restart: định kỳ chụp trạng thái các chat đang chạy, khởi động lại thì tự chạy tiếp (giãn cách từng chat).
+SNAPSHOT_INTERVAL = float(os.environ.get("SNAPSHOT_INTERVAL", 15)); RESUME_STAGGER = float(os.environ.get("RESUME_STAGGER", 1))
+SNAPSHOT_MAX_AGE = float(os.environ.get("SNAPSHOT_MAX_AGE", 300))   # chat không đổi gì vẫn được ghi lại sau chừng này giây (làm mới bộ đếm scheduler)
+RESUME_ON_BOOT = os.environ.get("RESUME_ON_BOOT", "1") == "1"
+# Circuit breaker cho Golike: BREAKER_FAILURES lỗi liên tiếp thì ngắt BREAKER_OPEN_SECONDS giây (gấp đôi mỗi lần thử lại hỏng,
+# tối đa BREAKER_MAX_OPEN). Request gửi khi endpoint đang lỗi phải có token của retry budget (nạp RETRY_BUDGET_PER_MIN/phút
+# + RETRY_BUDGET_RATIO cho mỗi request thành công), nên khi Golike sập chỉ tốn vài request thăm dò mỗi phút.
+BREAKER_FAILURES = int(os.environ.get("BREAKER_FAILURES", 5)); BREAKER_OPEN_SECONDS = float(os.environ.get("BREAKER_OPEN_SECONDS", 15))
+BREAKER_MAX_OPEN = float(os.environ.get("BREAKER_MAX_OPEN", 300))
+RETRY_BUDGET_PER_MIN = float(os.environ.get("RETRY_BUDGET_PER_MIN", 6)); RETRY_BUDGET_RATIO = float(os.environ.get("RETRY_BUDGET_RATIO", 0.1))
+# Chat đã dừng chỉ được giữ trong RAM tối đa STATE_CACHE_MAX chat / STATE_IDLE_TTL giây không dùng (chat đang chạy luôn được giữ).
+STATE_CACHE_MAX = int(os.environ.get("STATE_CACHE_MAX", 1000)); STATE_IDLE_TTL = float(os.environ.get("STATE_IDLE_TTL", 1800))
+# Sharding nhiều replica: bật khi có NODE_URL (địa chỉ nội bộ các node gọi nhau). Chat được chia theo consistent hashing,
+# quyền chạy giữ bằng lease trong DB (gia hạn mỗi SHARD_HEARTBEAT giây, hết hạn sau SHARD_LEASE_TTL giây thì node khác nhận).
+NODE_URL = os.environ.get("NODE_URL", "").rstrip('/')
+NODE_ID = os.environ.get("NODE_ID") or f"{os.environ.get('HOSTNAME', 'node')}-{os.getpid()}"
+SHARD_HEARTBEAT = float(os.environ.get("SHARD_HEARTBEAT", 10)); SHARD_LEASE_TTL = float(os.environ.get("SHARD_LEASE_TTL", 30))
+SHARD_VNODES = int(os.environ.get("SHARD_VNODES", 64)); SHARD_SECRET = os.environ.get("SHARD_SECRET", "")
+
+SQL_CREATE_USER_AUTH = """
+    CREATE TABLE IF NOT EXISTS user_auth (
+        chat_id INTEGER PRIMARY KEY,
+        auth_token TEXT NOT NULL,
+        ig_enabled INTEGER DEFAULT 1,
+        th_enabled INTEGER DEFAULT 1,
+        ig_workers INTEGER DEFAULT 1,
+        th_workers INTEGER DEFAULT 1
+    )
+"""
+# DB tạo trước khi có cột số worker: thêm cột khi khởi động (cột -> câu ALTER).
+SQL_MIGRATE_USER_AUTH = (("ig_workers", "ALTER TABLE user_auth ADD COLUMN ig_workers INTEGER DEFAULT 1"),
+                         ("th_workers", "ALTER TABLE user_auth ADD COLUMN th_workers INTEGER DEFAULT 1"))
+SQL_SELECT_AUTH = "SELECT auth_token, ig_enabled, th_enabled, ig_workers, th_workers FROM user_auth WHERE chat_id = ?"
+SQL_SELECT_ALL_AUTH = "SELECT chat_id, auth_token, ig_enabled, th_enabled, ig_workers, th_workers FROM user_auth"
+SQL_COUNT_AUTH = "SELECT COUNT(*) FROM user_auth"
+SQL_UPSERT_AUTH = """
+    INSERT INTO user_auth (chat_id, auth_token, ig_enabled, th_enabled, ig_workers, th_workers) 
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(chat_id) DO UPDATE SET
+        auth_token = excluded.auth_token,
+        ig_enabled = excluded.ig_enabled,
+        th_enabled = excluded.th_enabled,
+        ig_workers = excluded.ig_workers,
+        th_workers = excluded.th_workers
+"""
+SQL_DELETE_AUTH = "DELETE FROM user_auth WHERE chat_id = ?"
+
+# Sổ cái job: mỗi job hoàn thành/thất bại một dòng (chỉ thêm, không sửa) + bảng tổng hợp theo giờ/ngày
+# được cộng dồn ngay khi ghi lô, nên /history chỉ đọc bảng tổng hợp theo khoá chính, không quét sổ cái.
+SQL_CREATE_LEDGER = ("""
+    CREATE TABLE IF NOT EXISTS job_ledger (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        chat_id INTEGER NOT NULL,
+        platform TEXT NOT NULL,
+        account_id TEXT NOT NULL,
+        job_id TEXT,
+        price INTEGER NOT NULL DEFAULT 0,
+        success INTEGER NOT NULL,
+        latency_ms INTEGER,
+        created_at REAL NOT NULL
+    )
+""", "CREATE INDEX IF NOT EXISTS idx_job_ledger_chat_time ON job_ledger (chat_id, created_at)", """
+    CREATE TABLE IF NOT EXISTS job_rollup (
+        chat_id INTEGER NOT NULL,
+        period TEXT NOT NULL,
+        bucket_start INTEGER NOT NULL,
+        platform TEXT NOT NULL,
+        success INTEGER NOT NULL DEFAULT 0,
+        failed INTEGER NOT NULL DEFAULT 0,
+        xu INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (chat_id, period, bucket_start, platform)
+    )
+""")
+SQL_INSERT_LEDGER = "INSERT INTO job_ledger (chat_id, platform, account_id, job_id, price, success, latency_ms, created_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)"
+SQL_UPSERT_ROLLUP = """
+    INSERT INTO job_rollup (chat_id, period, bucket_start, platform, success, failed, xu)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(chat_id, period, bucket_start, platform) DO UPDATE SET
+        success = job_rollup.success + excluded.success,
+        failed = job_rollup.failed + excluded.failed,
+        xu = job_rollup.xu + excluded.xu
+"""
+SQL_SELECT_ROLLUPS = "SELECT bucket_start, platform, success, failed, xu FROM job_rollup WHERE chat_id = ? AND period = ? AND bucket_start >= ? ORDER BY bucket_start DESC"
+SQL_CREATE_SNAPSHOT = """
+    CREATE TABLE IF NOT EXISTS job_snapshot (
+        chat_id INTEGER PRIMARY KEY,
+        payload TEXT NOT NULL,
+        updated_at REAL NOT NULL
+    )
+"""
+SQL_UPSERT_SNAPSHOT = """
+    INSERT INTO job_snapshot (chat_id, payload, updated_at) VALUES (?, ?, ?)
+    ON CONFLICT(chat_id) DO UPDATE SET payload = excluded.payload, updated_at = excluded.updated_at
+"""
+SQL_SELECT_SNAPSHOTS = "SELECT chat_id, payload, updated_at FROM job_snapshot"
+SQL_DELETE_SNAPSHOT = "DELETE FROM job_snapshot WHERE chat_id = ?"
+# Sharding: node còn sống (heartbeat) + lease chat -> node. Lease chỉ được giành khi chưa có, đã hết hạn hoặc đang là của mình.
+SQL_CREATE_SHARD = ("""
+    CREATE TABLE IF NOT EXISTS shard_node (
+        node_id TEXT PRIMARY KEY,
+        url TEXT NOT NULL,
+        heartbeat_at REAL NOT NULL
+    )
+""", """
+    CREATE TABLE IF NOT EXISTS chat_lease (
+        chat_id INTEGER PRIMARY KEY,
+        node_id TEXT NOT NULL,
+        expires_at REAL NOT NULL
+    )
+""")
+SQL_UPSERT_NODE = """
+    INSERT INTO shard_node (node_id, url, heartbeat_at) VALUES (?, ?, ?)
+    ON CONFLICT(node_id) DO UPDATE SET url = excluded.url, heartbeat_at = excluded.heartbeat_at
+"""
+SQL_SELECT_LIVE_NODES = "SELECT node_id, url FROM shard_node WHERE heartbeat_at >= ?"
+SQL_DELETE_NODE = "DELETE FROM shard_node WHERE node_id = ?"
+SQL_ACQUIRE_LEASE = """
+    INSERT INTO chat_lease (chat_id, node_id, expires_at) VALUES (?, ?, ?)
+    ON CONFLICT(chat_id) DO UPDATE SET node_id = excluded.node_id, expires_at = excluded.expires_at
+    WHERE chat_lease.node_id = excluded.node_id OR chat_lease.expires_at < ?
+"""
+SQL_RENEW_LEASES = "UPDATE chat_lease SET expires_at = ? WHERE node_id = ?"
+SQL_RELEASE_LEASE = "DELETE FROM chat_lease WHERE chat_id = ? AND node_id = ?"
+SQL_RELEASE_NODE_LEASES = "DELETE FROM chat_lease WHERE node_id = ?"
+SQL_SELECT_LIVE_LEASES = "SELECT chat_id, node_id FROM chat_lease WHERE expires_at >= ?"
+
+PG_CREATE_USER_AUTH = """
+    CREATE TABLE IF NOT EXISTS user_auth (
+        chat_id BIGINT PRIMARY KEY,
+        auth_token TEXT NOT NULL,
+        ig_enabled SMALLINT DEFAULT 1,
+        th_enabled SMALLINT DEFAULT 1,
+        ig_workers SMALLINT DEFAULT 1,
+        th_workers SMALLINT DEFAULT 1
+    )
+"""
+PG_MIGRATE_USER_AUTH = tuple(sql.replace("ADD COLUMN", "ADD COLUMN IF NOT EXISTS").replace("INTEGER", "SMALLINT") for _, sql in SQL_MIGRATE_USER_AUTH)
+PG_UPSERT_AUTH = """
+    INSERT INTO user_auth (chat_id, auth_token, ig_enabled, th_enabled, ig_workers, th_workers) VALUES %s
+    ON CONFLICT (chat_id) DO UPDATE SET
+        auth_token = EXCLUDED.auth_token,
+        ig_enabled = EXCLUDED.ig_enabled,
+        th_enabled = EXCLUDED.th_enabled,
+        ig_workers = EXCLUDED.ig_workers,
+        th_workers = EXCLUDED.th_workers
+"""
+
+PG_CREATE_LEDGER = ("""
+    CREATE TABLE IF NOT EXISTS job_ledger (
+        id BIGSERIAL PRIMARY KEY,
+        chat_id BIGINT NOT NULL,
+        platform TEXT NOT NULL,
+        account_id TEXT NOT NULL,
+        job_id TEXT,
+        price INTEGER NOT NULL DEFAULT 0,
+        success SMALLINT NOT NULL,
+        latency_ms INTEGER,
+        created_at DOUBLE PRECISION NOT NULL
+    )
+""", SQL_CREATE_LEDGER[1], SQL_CREATE_LEDGER[2].replace("chat_id INTEGER", "chat_id BIGINT").replace("bucket_start INTEGER", "bucket_start BIGINT"))
+PG_INSERT_LEDGER = "INSERT INTO job_ledger (chat_id, platform, account_id, job_id, price, success, latency_ms, created_at) VALUES %s"
+PG_UPSERT_ROLLUP = """
+    INSERT INTO job_rollup (chat_id, period, bucket_start, platform, success, failed, xu) VALUES %s
+    ON CONFLICT (chat_id, period, bucket_start, platform) DO UPDATE SET
+        success = job_rollup.success + EXCLUDED.success,
+        failed = job_rollup.failed + EXCLUDED.failed,
+        xu = job_rollup.xu + EXCLUDED.xu
+"""
+PG_CREATE_SNAPSHOT = SQL_CREATE_SNAPSHOT.replace("chat_id INTEGER", "chat_id BIGINT").replace("updated_at REAL", "updated_at DOUBLE PRECISION")
+PG_CREATE_SHARD = (SQL_CREATE_SHARD[0].replace("heartbeat_at REAL", "heartbeat_at DOUBLE PRECISION"),
+                   SQL_CREATE_SHARD[1].replace("chat_id INTEGER", "chat_id BIGINT").replace("expires_at REAL", "expires_at DOUBLE PRECISION"))
+PG_UPSERT_SNAPSHOT = """
+    INSERT INTO job_snapshot (chat_id, payload, updated_at) VALUES %s
+    ON CONFLICT (chat_id) DO UPDATE SET payload = EXCLUDED.payload, updated_at = EXCLUDED.updated_at
+"""
+
+ROLLUP_PERIODS = {'hour': 3600, 'day': 86400}
+
+def rollup_bucket(period, ts):
+    # Mốc ngày tính theo múi giờ hiển thị (BOT_TZ_OFFSET_HOURS) để "hôm nay" khớp với người dùng.
+    offset = TZ_OFFSET_HOURS * 3600; size = ROLLUP_PERIODS[period]
+    return int((ts + offset) // size * size - offset)
+
+def ledger_rollup_deltas(rows):
+    # Gộp một lô dòng sổ cái thành các delta (chat_id, period, bucket_start, platform, success, failed, xu).
+    deltas = {}
+    for chat_id, platform, _, _, price, success, _, created_at in rows:
+        for period in ROLLUP_PERIODS:
+            key = (chat_id, period, rollup_bucket(period, created_at), platform); delta = deltas.setdefault(key, [0, 0, 0])
+            if success: delta[0] += 1; delta[2] += price
+            else: delta[1] += 1
+    return [key + tuple(delta) for key, delta in deltas.items()]
+
+
+class StorageBackend:
+    # Giao diện lưu trữ. Row user_auth luôn là tuple (chat_id, auth_token, ig_enabled, th_enabled, ig_workers, th_workers), cờ dạng 0/1.
+    name = "base"
+    def init(self): raise NotImplementedError
+    def fetch_auth(self, chat_id): raise NotImplementedError          # -> (auth_token, ig, th, ig_workers, th_workers) hoặc None
+    def fetch_all_auth(self): raise NotImplementedError               # -> list row
+    def count_auth(self): raise NotImplementedError
+    def upsert_auth(self, rows): raise NotImplementedError            # ghi theo lô
+    def delete_auth(self, chat_id): raise NotImplementedError
+    def append_jobs(self, rows, rollups): raise NotImplementedError   # thêm dòng sổ cái + cộng delta tổng hợp, cùng transaction
+    def fetch_rollups(self, chat_id, period, since): raise NotImplementedError   # -> [(bucket_start, platform, success, failed, xu)]
+    def save_snapshots(self, rows): raise NotImplementedError   # rows: [(chat_id, payload_json, updated_at)]
+    def fetch_snapshots(self): raise NotImplementedError        # -> [(chat_id, payload_json, updated_at)]
+    def delete_snapshot(self, chat_id): raise NotImplementedError
+    def heartbeat_node(self, node_id, url, now): raise NotImplementedError
+    def live_nodes(self, since): raise NotImplementedError               # -> [(node_id, url)]
+    def remove_node(self, node_id): raise NotImplementedError            # xoá node + trả mọi lease của node
+    def acquire_lease(self, chat_id, node_id, expires_at, now): raise NotImplementedError   # -> True nếu giữ được lease
+    def renew_leases(self, node_id, expires_at): raise NotImplementedError
+    def release_lease(self, chat_id, node_id): raise NotImplementedError
+    def live_leases(self, now): raise NotImplementedError                # -> [(chat_id, node_id)]
+    def stats(self): return {}
+
+
+class SQLiteBackend(StorageBackend):
+    # Pool connection WAL dùng lại giữa các handler. Các câu SQL là hằng số nên được sqlite3
+    # giữ sẵn dạng prepared trong statement cache của từng connection.
+    name = "sqlite"
+
+    def __init__(self, path, pool_size):
+        self.path = path; self.pool = queue.LifoQueue(maxsize=pool_size)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False, cached_statements=64)
+        conn.execute("PRAGMA journal_mode=WAL"); conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    @contextmanager
+    def connection(self):
+        try: conn = self.pool.get_nowait()
+        except queue.Empty: conn = self._connect()
+        try:
+            with conn: yield conn   # commit khi thành công, rollback khi lỗi
+        finally:
+            try: self.pool.put_nowait(conn)
+            except queue.Full: conn.close()
+
+    def init(self):
+        with self.connection() as conn:
+            conn.execute(SQL_CREATE_USER_AUTH); conn.execute(SQL_CREATE_SNAPSHOT)
+            columns = {row[1] for row in conn.execute("PRAGMA table_info(user_auth)")}
+            for column, sql in SQL_MIGRATE_USER_AUTH:
+                if column not in columns: conn.execute(sql)
+            for sql in SQL_CREATE_LEDGER + SQL_CREATE_SHARD: conn.execute(sql)
+
+    def fetch_auth(self, chat_id):
+        with self.connection() as conn: return conn.execute(SQL_SELECT_AUTH, (chat_id,)).fetchone()
+
+    def fetch_all_auth(self):
+        with self.connection() as conn: return conn.execute(SQL_SELECT_ALL_AUTH).fetchall()
+
+    def count_auth(self):
+        with self.connection() as conn: return conn.execute(SQL_COUNT_AUTH).fetchone()[0]
+
+    def upsert_auth(self, rows):
+        with self.connection() as conn: conn.executemany(SQL_UPSERT_AUTH, rows)
+
+    def delete_auth(self, chat_id):
+        with self.connection() as conn: conn.execute(SQL_DELETE_AUTH, (chat_id,))
+
+    def append_jobs(self, rows, rollups):
+        with self.connection() as conn: conn.executemany(SQL_INSERT_LEDGER, rows); conn.executemany(SQL_UPSERT_ROLLUP, rollups)
+
+    def fetch_rollups(self, chat_id, period, since):
+        with self.connection() as conn: return conn.execute(SQL_SELECT_ROLLUPS, (chat_id, period, since)).fetchall()
+
+    def save_snapshots(self, rows):
+        with self.connection() as conn: conn.executemany(SQL_UPSERT_SNAPSHOT, rows)
+
+    def fetch_snapshots(self):
+        with self.connection() as conn: return conn.execute(SQL_SELECT_SNAPSHOTS).fetchall()
+
+    def delete_snapshot(self, chat_id):
+        with self.connection() as conn: conn.execute(SQL_DELETE_SNAPSHOT, (chat_id,))
+
+    def heartbeat_node(self, node_id, url, now):
+        with self.connection() as conn: conn.execute(SQL_UPSERT_NODE, (node_id, url, now))
+
+    def live_nodes(self, since):
+        with self.connection() as conn: return conn.execute(SQL_SELECT_LIVE_NODES, (since,)).fetchall()
+
+    def remove_node(self, node_id):
+        with self.connection() as conn: conn.execute(SQL_RELEASE_NODE_LEASES, (node_id,)); conn.execute(SQL_DELETE_NODE, (node_id,))
+
+    def acquire_lease(self, chat_id, node_id, expires_at, now):
+        with self.connection() as conn: return conn.execute(SQL_ACQUIRE_LEASE, (chat_id, node_id, expires_at, now)).rowcount > 0
+
+    def renew_leases(self, node_id, expires_at):
+        with self.connection() as conn: conn.execute(SQL_RENEW_LEASES, (expires_at, node_id))
+
+    def release_lease(self, chat_id, node_id):
+        with self.connection() as conn: conn.execute(SQL_RELEASE_LEASE, (chat_id, node_id))
+
+    def live_leases(self, now):
+        with self.connection() as conn: return conn.execute(SQL_SELECT_LIVE_LEASES, (now,)).fetchall()
+
+    def stats(self): return {'idle_connections': self.pool.qsize()}
+
+
+class PostgresBackend(StorageBackend):
+    name = "postgres"
+
+    def __init__(self, dsn, min_connections, max_connections):
+        import psycopg2.pool, psycopg2.extras
+        self.extras = psycopg2.extras; self.waited = 0
+        self.pool = psycopg2.pool.ThreadedConnectionPool(min_connections, max_connections, dsn)
+        # ThreadedConnectionPool ném PoolError khi hết connection thay vì chờ: giới hạn số người mượn bằng semaphore.
+        self.slots = threading.BoundedSemaphore(max_connections)
+
+    @contextmanager
+    def connection(self):
+        if not self.slots.acquire(blocking=False): self.waited += 1; self.slots.acquire()
+        try:
+            conn = self.pool.getconn()
+            try:
+                with conn: yield conn   # psycopg2: commit khi thành công, rollback khi lỗi (không đóng connection)
+            finally: self.pool.putconn(conn)
+        finally: self.slots.release()
+
+    def _sql(self, sql): return sql.replace("?", "%s")
+
+    def init(self):
+        with self.connection() as conn, conn.cursor() as cur:
+            cur.execute(PG_CREATE_USER_AUTH); cur.execute(PG_CREATE_SNAPSHOT)
+            for sql in PG_MIGRATE_USER_AUTH + PG_CREATE_LEDGER + PG_CREATE_SHARD: cur.execute(sql)
+
+    def fetch_auth(self, chat_id):
+        with self.connection() as conn, conn.cursor() as cur: cur.execute(self._sql(SQL_SELECT_AUTH), (chat_id,)); return cur.fetchone()
+
+    def fetch_all_auth(self):
+        with self.connection() as conn, conn.cursor() as cur: cur.execute(SQL_SELECT_ALL_AUTH); return cur.fetchall()
+
+    def count_auth(self):
+        with self.connection() as conn, conn.cursor() as cur: cur.execute(SQL_COUNT_AUTH); return cur.fetchone()[0]
+
+    def upsert_auth(self, rows):
+        if not rows: return
+        # Một round-trip cho cả lô; nếu trùng chat_id trong lô thì giữ bản cuối (Postgres không cho ON CONFLICT 2 lần/1 lệnh).
+        rows = list({row[0]: row for row in rows}.values())
+        with self.connection() as conn, conn.cursor() as cur: self.extras.execute_values(cur, PG_UPSERT_AUTH, rows, page_size=500)
+
+    def delete_auth(self, chat_id):
+        with self.connection() as conn, conn.cursor() as cur: cur.execute(self._sql(SQL_DELETE_AUTH), (chat_id,))
+
+    def append_jobs(self, rows, rollups):
+        with self.connection() as conn, conn.cursor() as cur:
+            self.extras.execute_values(cur, PG_INSERT_LEDGER, rows, page_size=500)
+            self.extras.execute_values(cur, PG_UPSERT_ROLLUP, rollups, page_size=500)
+
+    def fetch_rollups(self, chat_id, period, since):
+        with self.connection() as conn, conn.cursor() as cur: cur.execute(self._sql(SQL_SELECT_ROLLUPS), (chat_id, period, since)); return cur.fetchall()
+
+    def save_snapshots(self, rows):
+        with self.connection() as conn, conn.cursor() as cur: self.extras.execute_values(cur, PG_UPSERT_SNAPSHOT, rows)
+
+    def fetch_snapshots(self):
+        with self.connection() as conn, conn.cursor() as cur: cur.execute(SQL_SELECT_SNAPSHOTS); return cur.fetchall()
+
+    def delete_snapshot(self, chat_id):
+        with self.connection() as conn, conn.cursor() as cur: cur.execute(self._sql(SQL_DELETE_SNAPSHOT), (chat_id,))
+
+    def heartbeat_node(self, node_id, url, now):
+        with self.connection() as conn, conn.cursor() as cur: cur.execute(self._sql(SQL_UPSERT_NODE), (node_id, url, now))
+
+    def live_nodes(self, since):
+        with self.connection() as conn, conn.cursor() as cur: cur.execute(self._sql(SQL_SELECT_LIVE_NODES), (since,)); return cur.fetchall()
+
+    def remove_node(self, node_id):
+        with self.connection() as conn, conn.cursor() as cur: cur.execute(self._sql(SQL_RELEASE_NODE_LEASES), (node_id,)); cur.execute(self._sql(SQL_DELETE_NODE), (node_id,))
+
+    def acquire_lease(self, chat_id, node_id, expires_at, now):
+        with self.connection() as conn, conn.cursor() as cur: cur.execute(self._sql(SQL_ACQUIRE_LEASE), (chat_id, node_id, expires_at, now)); return cur.rowcount > 0
+
+    def renew_leases(self, node_id, expires_at):
+        with self.connection() as conn, conn.cursor() as cur: cur.execute(self._sql(SQL_RENEW_LEASES), (expires_at, node_id))
+
+    def release_lease(self, chat_id, node_id):
+        with self.connection() as conn, conn.cursor() as cur: cur.execute(self._sql(SQL_RELEASE_LEASE), (chat_id, node_id))
+
+    def live_leases(self, now):
+        with self.connection() as conn, conn.cursor() as cur: cur.execute(self._sql(SQL_SELECT_LIVE_LEASES), (now,)); return cur.fetchall()
+
+    def stats(self): return {'max_connections': self.pool.maxconn, 'pool_waits': self.waited}
+
+
+class MemoryBackend(StorageBackend):
+    # Backend trong RAM: thay thế SQLite/Postgres khi chạy offline hoặc thử nghiệm, không bền qua restart.
+    name = "memory"
+
+    def __init__(self): self.rows = {}; self.ledger = []; self.rollups = {}; self.snapshots = {}; self.nodes = {}; self.leases = {}; self.lock = threading.Lock()
+    def init(self): pass
+
+    def fetch_auth(self, chat_id):
+        with self.lock: row = self.rows.get(chat_id)
+        return row[1:] if row else None
+
+    def fetch_all_auth(self):
+        with self.lock: return list(self.rows.values())
+
+    def count_auth(self):
+        with self.lock: return len(self.rows)
+
+    def upsert_auth(self, rows):
+        with self.lock:
+            for row in rows: self.rows[row[0]] = tuple(row)
+
+    def delete_auth(self, chat_id):
+        with self.lock: self.rows.pop(chat_id, None)
+
+    def append_jobs(self, rows, rollups):
+        with self.lock:
+            self.ledger.extend(rows)
+            for *key, success, failed, xu in rollups:
+                total = self.rollups.setdefault(tuple(key), [0, 0, 0]); total[0] += success; total[1] += failed; total[2] += xu
+
+    def fetch_rollups(self, chat_id, period, since):
+        with self.lock:
+            rows = [(key[2], key[3], *total) for key, total in self.rollups.items() if key[0] == chat_id and key[1] == period and key[2] >= since]
+        return sorted(rows, reverse=True)
+
+    def save_snapshots(self, rows):
+        with self.lock: self.snapshots.update({chat_id: (chat_id, payload, updated_at) for chat_id, payload, updated_at in rows})
+
+    def fetch_snapshots(self):
+        with self.lock: return list(self.snapshots.values())
+
+    def delete_snapshot(self, chat_id):
+        with self.lock: self.snapshots.pop(chat_id, None)
+
+    def heartbeat_node(self, node_id, url, now):
+        with self.lock: self.nodes[node_id] = (url, now)
+
+    def live_nodes(self, since):
+        with self.lock: return [(node_id, url) for node_id, (url, heartbeat_at) in self.nodes.items() if heartbeat_at >= since]
+
+    def remove_node(self, node_id):
+        with self.lock:
+            self.nodes.pop(node_id, None); self.leases = {c: lease for c, lease in self.leases.items() if lease[0] != node_id}
+
+    def acquire_lease(self, chat_id, node_id, expires_at, now):
+        with self.lock:
+            holder = self.leases.get(chat_id)
+            if holder is not None and holder[0] != node_id and holder[1] >= now: return False
+            self.leases[chat_id] = (node_id, expires_at); return True
+
+    def renew_leases(self, node_id, expires_at):
+        with self.lock: self.leases.update({c: (node_id, expires_at) for c, lease in self.leases.items() if lease[0] == node_id})
+
+    def release_lease(self, chat_id, node_id):
+        with self.lock:
+            if self.leases.get(chat_id, (None,))[0] == node_id: del self.leases[chat_id]
+
+    def live_leases(self, now):
+        with self.lock: return [(c, lease[0]) for c, lease in self.leases.items() if lease[1] >= now]
+
+
+class CachedStore:
+    # Cache đọc-xuyên (read-through) cho user_auth đặt trước mọi backend, bị xoá khi ghi/xoá.
+    # LRU tối đa `cache_size` dòng, mỗi dòng sống `cache_ttl` giây; không cache "không có token" (node khác có thể vừa ghi).
+    # cache_size=0: tắt hẳn, mọi lần đọc đi thẳng backend.
+    def __init__(self, backend, cache_size=AUTH_CACHE_SIZE, cache_ttl=AUTH_CACHE_TTL):
+        self.backend = backend; self.cache_size = cache_size; self.cache_ttl = cache_ttl
+        self.cache = OrderedDict(); self.cache_lock = threading.Lock(); self.generation = 0   # chat_id -> (row, hết hạn lúc)
+        self.cache_hits = 0; self.cache_misses = 0
+
+    def init(self):
+        self.backend.init()
+        if STORAGE_IMPORT_SQLITE and self.backend.name == "postgres" and os.path.exists(DB_FILE) and self.backend.count_auth() == 0:
+            source = SQLiteBackend(DB_FILE, 1); source.init(); rows = source.fetch_all_auth(); self.save_auth_many(rows)
+            print(f"✅ Đã chuyển {len(rows)} token từ {DB_FILE} sang Postgres.")
+
+    def get_auth(self, chat_id):
+        if not self.cache_size: return self.backend.fetch_auth(chat_id)
+        now = time.monotonic()
+        with self.cache_lock:
+            entry = self.cache.get(chat_id); generation = self.generation
+            if entry is not None and entry[1] > now: self.cache.move_to_end(chat_id); self.cache_hits += 1; return entry[0]
+            self.cache_misses += 1
+        row = self.backend.fetch_auth(chat_id)
+        with self.cache_lock:
+            # Bỏ qua nếu đã có lệnh ghi chen vào giữa lúc đọc, tránh cache lại dữ liệu cũ.
+            if row is None: self.cache.pop(chat_id, None)
+            elif generation == self.generation:
+                self.cache[chat_id] = (row, now + self.cache_ttl); self.cache.move_to_end(chat_id)
+                while len(self.cache) > self.cache_size: self.cache.popitem(last=False)
+        return row
+
+    def save_auth(self, chat_id, auth_token, ig_enabled, th_enabled, ig_workers=1, th_workers=1):
+        self.save_auth_many([(chat_id, auth_token, ig_enabled, th_enabled, ig_workers, th_workers)])
+
+    def save_auth_many(self, rows):
+        rows = [(chat_id, auth_token, int(bool(ig)), int(bool(th)), clamp_workers(ig_w), clamp_workers(th_w)) for chat_id, auth_token, ig, th, ig_w, th_w in rows]
+        try: self.backend.upsert_auth(rows)
+        finally: self.invalidate(*[row[0] for row in rows])
+
+    def delete_auth(self, chat_id):
+        try: self.backend.delete_auth(chat_id)
+        finally: self.invalidate(chat_id)
+
+    def append_jobs(self, rows): self.backend.append_jobs(rows, ledger_rollup_deltas(rows))
+
+    def fetch_rollups(self, chat_id, period, since): return self.backend.fetch_rollups(chat_id, period, since)
+
+    def save_snapshots(self, rows): self.backend.save_snapshots(rows)
+
+    def fetch_snapshots(self): return self.backend.fetch_snapshots()
+
+    def delete_snapshot(self, chat_id): self.backend.delete_snapshot(chat_id)
+
+    # Sharding: node/lease luôn đọc thẳng DB (không cache) vì các node khác cùng ghi.
+    def heartbeat_node(self, node_id, url, now): self.backend.heartbeat_node(node_id, url, now)
+
+    def live_nodes(self, since): return self.backend.live_nodes(since)
+
+    def remove_node(self, node_id): self.backend.remove_node(node_id)
+
+    def acquire_lease(self, chat_id, node_id, expires_at, now): return self.backend.acquire_lease(chat_id, node_id, expires_at, now)
+
+    def renew_leases(self, node_id, expires_at): self.backend.renew_leases(node_id, expires_at)
+
+    def release_lease(self, chat_id, node_id): self.backend.release_lease(chat_id, node_id)
+
+    def live_leases(self, now): return self.backend.live_leases(now)
+
+    def invalidate(self, *chat_ids):
+        with self.cache_lock:
+            self.generation += 1
+            for chat_id in chat_ids: self.cache.pop(chat_id, None)
+
+    def stats(self):
+        with self.cache_lock: cache = {'cache_enabled': bool(self.cache_size), 'cached_rows': len(self.cache), 'cache_hits': self.cache_hits, 'cache_misses': self.cache_misses}
+        return {'backend': self.backend.name, **cache, **self.backend.stats()}
+
+
+def create_store():
+    if STORAGE_BACKEND == "postgres":
+        if not DATABASE_URL: raise RuntimeError("STORAGE_BACKEND=postgres nhưng DATABASE_URL chưa được thiết lập.")
+        backend = PostgresBackend(DATABASE_URL, 0, max(DB_POOL_SIZE, 2))   # minconn=0: chưa kết nối lúc import
+    elif STORAGE_BACKEND == "memory": backend = MemoryBackend()
+    else: backend = SQLiteBackend(DB_FILE, DB_POOL_SIZE)
+    cache_default = "0" if STORAGE_BACKEND == "postgres" or NODE_URL else "1"
+    return CachedStore(backend, AUTH_CACHE_SIZE if os.environ.get("AUTH_CACHE", cache_default) == "1" else 0)
+
+STORE = create_store()
+
+def init_db():
+    try:
+        STORE.init()
+        print(f"✅ Database ({STORE.backend.name}) khởi tạo thành công.")
+    except Exception as e:
+        print(f"❌ Lỗi khởi tạo Database: {e}")
+
+def clamp_workers(count):
+    try: return max(1, min(int(count), WORKERS_MAX))
+    except (TypeError, ValueError): return max(1, min(WORKERS_PER_PLATFORM, WORKERS_MAX))
+
+def default_concurrency(): return {'instagram': clamp_workers(WORKERS_PER_PLATFORM), 'threads': clamp_workers(WORKERS_PER_PLATFORM)}
+
+def get_auth_data(chat_id: int) -> Optional[dict]:
+    try:
+        row = STORE.get_auth(chat_id)
+        if row: return {'auth_token': row[0],'platform_config': {'instagram': bool(row[1]), 'threads': bool(row[2])},
+                        'concurrency': {'instagram': clamp_workers(row[3]), 'threads': clamp_workers(row[4])}}
+    except Exception as e: print(f"❌ Lỗi đọc Database cho chat_id {chat_id}: {e}")
+    return None
+
+def save_auth_data(chat_id: int, auth_token: str, ig_enabled: bool, th_enabled: bool, concurrency: Optional[dict] = None):
+    concurrency = concurrency or default_concurrency()
+    try: STORE.save_auth(chat_id, auth_token, ig_enabled, th_enabled, concurrency['instagram'], concurrency['threads'])
+    except Exception as e: print(f"❌ Lỗi ghi Database cho chat_id {chat_id}: {e}")
+
+def delete_auth_data(chat_id: int):
+    try: STORE.delete_auth(chat_id)
+    except Exception as e: print(f"❌ Lỗi xóa Database cho chat_id {chat_id}: {e}")
+
+
+class JobLedgerWriter:
+    def __init__(self, batch_size, flush_interval, max_pending):
+        self.batch_size = batch_size; self.flush_interval = flush_interval
+        self.queue = queue.Queue(maxsize=max_pending); self.thread = None; self.lock = threading.Lock()
+        self.written = 0; self.dropped = 0; self.failed_batches = 0
+
+    def append(self, chat_id, platform, account_id, job_id, price, success, latency):
+        if self.thread is None or not self.thread.is_alive():
+            with self.lock:
+                if self.thread is None or not self.thread.is_alive():
+                    self.thread = threading.Thread(target=self._run, daemon=True, name="LEDGER_WRITER"); self.thread.start()
+        row = (chat_id, platform, str(account_id), None if job_id is None else str(job_id), int(price or 0), int(bool(success)),
+               None if latency is None else int(latency * 1000), time.time())
+        try: self.queue.put_nowait(row)
+        except queue.Full: self.dropped += 1
+
+    def _drain(self, batch, deadline):
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0: break
+            try: batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty: break
+
+    def _write(self, batch):
+        for attempt in range(3):
+            try: STORE.append_jobs(batch); self.written += len(batch); return
+            except Exception as e: print(f"❌ Lỗi ghi sổ cái job (lần {attempt + 1}, {len(batch)} dòng): {e}"); time.sleep(1)
+        self.failed_batches += 1; self.dropped += len(batch)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]; self._drain(batch, time.monotonic() + self.flush_interval)
+            self._write(batch)
+
+    def flush(self):
+        # Ghi nốt mọi dòng còn trong hàng đợi (gọi khi thoát tiến trình).
+        batch = []
+        while True:
+            try: batch.append(self.queue.get_nowait())
+            except queue.Empty: break
+        for i in range(0, len(batch), self.batch_size): self._write(batch[i:i + self.batch_size])
+
+    def stats(self): return {'pending': self.queue.qsize(), 'written': self.written, 'dropped': self.dropped, 'failed_batches': self.failed_batches}
+
+
+LEDGER = JobLedgerWriter(LEDGER_BATCH_SIZE, LEDGER_FLUSH_INTERVAL, LEDGER_QUEUE_MAX)
+atexit.register(LEDGER.flush)
+
+
+# ==============================================================================
+# PHẦN METRICS: HISTOGRAM ĐỘ TRỄ + BỘ ĐẾM KẾT QUẢ CHO MỌI LỜI GỌI GOLIKE/TELEGRAM
+# ==============================================================================
+
+METRIC_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class Metrics:
+    # Mỗi thread ghi vào bảng riêng (threading.local), không có khoá chung cho từng mẫu; chỉ khi thread
+    # ghi lần đầu mới khoá để đăng ký bảng. /metrics cộng dồn các bảng lúc scrape, bảng của thread đã chết
+    # được gộp vào `retired` để danh sách không phình theo số thread từng chạy.
+    def __init__(self, buckets):
+        self.buckets = buckets; self.local = threading.local(); self.lock = threading.Lock()
+        self.shards = []; self.retired = {'hist': {}, 'counters': {}}
+
+    def _shard(self):
+        shard = getattr(self.local, 'shard', None)
+        if shard is None:
+            shard = self.local.shard = {'hist': {}, 'counters': {}}
+            with self.lock: self.shards.append((threading.current_thread(), shard))
+        return shard
+
+    def observe(self, name, labels, seconds):
+        hist = self._shard()['hist']; key = (name, labels); entry = hist.get(key)
+        if entry is None: entry = hist[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound: entry[0][i] += 1; break
+        entry[1] += seconds; entry[2] += 1
+
+    def inc(self, name, labels, value=1):
+        counters = self._shard()['counters']; key = (name, labels)
+        counters[key] = counters.get(key, 0) + value
+
+    @staticmethod
+    def _merge(into, shard):
+        for key, (buckets, total, count) in list(shard['hist'].items()):
+            entry = into['hist'].setdefault(key, [[0] * len(buckets), 0.0, 0])
+            entry[0] = [a + b for a, b in zip(entry[0], buckets)]; entry[1] += total; entry[2] += count
+        for key, value in list(shard['counters'].items()): into['counters'][key] = into['counters'].get(key, 0) + value
+
+    def collect(self):
+        with self.lock:
+            for thread, shard in [item for item in self.shards if not item[0].is_alive()]:
+                self._merge(self.retired, shard); self.shards.remove((thread, shard))
+            shards = [shard for _, shard in self.shards]
+            merged = {'hist': {}, 'counters': {}}; self._merge(merged, self.retired)
+        for shard in shards: self._merge(merged, shard)
+        return merged
+
+    def render(self, gauges=()):
+        merged = self.collect(); lines = []; typed = set()
+        fmt = lambda labels, extra=(): "{" + ",".join(f'{k}="{v}"' for k, v in labels + extra) + "}" if labels + extra else ""
+        for (name, labels), (buckets, total, count) in sorted(merged['hist'].items()):
+            if name not in typed: lines.append(f"# TYPE {name} histogram"); typed.add(name)
+            cumulative = 0
+            for bound, n in zip(self.buckets, buckets):
+                cumulative += n; lines.append(f"{name}_bucket{fmt(labels, (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_bucket{fmt(labels, (('le', '+Inf'),))} {count}")
+            lines.append(f"{name}_sum{fmt(labels)} {total:.6f}"); lines.append(f"{name}_count{fmt(labels)} {count}")
+        for (name, labels), value in sorted(merged['counters'].items()):
+            if name not in typed: lines.append(f"# TYPE {name} counter"); typed.add(name)
+            lines.append(f"{name}{fmt(labels)} {value}")
+        for name, value in gauges:
+            lines.append(f"# TYPE {name} gauge"); lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics(METRIC_BUCKETS)
+
+def is_timeout_error(error): return any('timeout' in cls.__name__.lower() for cls in type(error).__mro__)
+
+def record_golike_call(endpoint, platform, seconds, outcome):
+    METRICS.observe('golike_request_seconds', (('endpoint', endpoint), ('platform', platform)), seconds)
+    METRICS.inc('golike_requests_total', (('endpoint', endpoint), ('platform', platform), ('outcome', outcome)))
+
+def record_telegram_call(method, seconds, outcome):
+    METRICS.observe('telegram_request_seconds', (('method', method),), seconds)
+    METRICS.inc('telegram_requests_total', (('method', method), ('outcome', outcome)))
+
+def tg_answer(callback_query_id, *args, **kwargs):
+    # answer_callback_query gọi thẳng (không qua hàng đợi) để nút bấm phản hồi ngay, nhưng vẫn được đo.
+    started = time.perf_counter()
+    try: result = bot.answer_callback_query(callback_query_id, *args, **kwargs)
+    except Exception: record_telegram_call('answer_callback_query', time.perf_counter() - started, 'error'); raise
+    record_telegram_call('answer_callback_query', time.perf_counter() - started, 'ok'); return result
+
+
+# ==============================================================================
+# PHẦN PROFILER LẤY MẪU STACK (CHỈ CHẠY KHI ĐƯỢC GỌI: /profile HOẶC GET /profile)
+# ==============================================================================
+
+# Thread worker, engine asyncio, refresher dashboard, worker xử lý webhook và các thread gửi Telegram.
+PROFILE_THREAD_PREFIXES = ('INSTA_WORKER', 'THREAD_WORKER', 'ASYNC_JOB_ENGINE', 'STATUS_REFRESHER', 'UPDATE_WORKER', 'TG_OUTBOX', 'TG_SENDER')
+
+class SamplingProfiler:
+    # Mỗi `interval` giây đọc stack của các thread có tên khớp tiền tố bằng sys._current_frames(), gộp thành collapsed stack
+    # ("THREAD;hàm (file:dòng);... số_mẫu", đọc được bằng flamegraph.pl / speedscope). Không cài hook nào:
+    # khi không có phiên đo thì không tốn gì. Mỗi lúc chỉ một phiên, chạy trên chính thread gọi profile().
+    def __init__(self):
+        self.lock = threading.Lock(); self.running = False; self.runs = 0; self.last_samples = 0
+
+    def profile(self, seconds, interval=PROFILE_INTERVAL, prefixes=PROFILE_THREAD_PREFIXES):
+        # -> (counts {stack: số mẫu}, số lần lấy mẫu). Ném RuntimeError nếu đang có phiên khác.
+        with self.lock:
+            if self.running: raise RuntimeError("Profiler đang chạy một phiên khác.")
+            self.running = True
+        try: counts, samples = self._sample(min(seconds, PROFILE_MAX_SECONDS), max(interval, 0.001), tuple(prefixes))
+        finally:
+            with self.lock: self.running = False; self.runs += 1
+        self.last_samples = samples
+        return counts, samples
+
+    def _sample(self, seconds, interval, prefixes):
+        counts = {}; samples = 0; me = threading.get_ident(); names = {}; refresh_names_at = 0
+        deadline = time.monotonic() + seconds
+        while True:
+            now = time.monotonic()
+            if now >= deadline: break
+            if now >= refresh_names_at: names = {t.ident: t.name for t in threading.enumerate()}; refresh_names_at = now + 1
+            for ident, frame in sys._current_frames().items():
+                name = names.get(ident)
+                if ident == me or name is None or not name.startswith(prefixes): continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code; stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"); frame = frame.f_back
+                stack.append(re.sub(r'_\d+$', '', name))   # INSTA_WORKER_3 -> INSTA_WORKER: gộp các worker cùng loại
+                key = ';'.join(reversed(stack)); counts[key] = counts.get(key, 0) + 1
+            samples += 1; time.sleep(interval)
+        return counts, samples
+
+    def stats(self): return {'running': self.running, 'runs': self.runs, 'last_samples': self.last_samples}
+
+
+def collapsed_stacks(counts):
+    return "".join(f"{stack} {count}\n" for stack, count in sorted(counts.items(), key=lambda item: -item[1]))
+
+def profile_summary(counts, limit=5):
+    # Các hàm lá tốn nhiều mẫu nhất (self time), dạng text ngắn cho Telegram.
+    leaves = {}; total = sum(counts.values()) or 1
+    for stack, count in counts.items(): leaf = stack.rsplit(';', 1)[-1]; leaves[leaf] = leaves.get(leaf, 0) + count
+    return "\n".join(f"{count * 100 / total:5.1f}% {leaf}" for leaf, count in sorted(leaves.items(), key=lambda item: -item[1])[:limit])
+
+
+PROFILER = SamplingProfiler()
+
+
+# ==============================================================================
+# PHẦN CHỐNG QUÁ TẢI GOLIKE: PHÂN LOẠI PHẢN HỒI, CIRCUIT BREAKER (ENDPOINT + TOKEN), RETRY BUDGET
+# ==============================================================================
+
+class GatewayUnavailable(Exception):
+    # Request bị chặn trước khi gửi (breaker đang mở / hết retry budget). `wait`: số giây nên chờ trước khi thử lại.
+    def __init__(self, wait, reason): super().__init__(reason); self.wait = wait; self.reason = reason
+
+
+CHALLENGE_MARKERS = ('just a moment', 'cf-chl', 'cloudflare', 'attention required', 'captcha')
+ENDPOINT_FAILURES = {'timeout', 'network_error', 'server_error', 'challenge', 'bad_response'}   # lỗi phía gateway/mạng
+TOKEN_FAILURES = {'auth_error', 'rate_limited'}                                                  # lỗi của riêng một token
+
+def classify_golike_response(status, text):
+    # -> (outcome, data). data là dict JSON hoặc None (trang HTML lỗi, Cloudflare challenge, body hỏng...).
+    if status == 429: return 'rate_limited', None
+    try: data = json.loads(text) if text else None
+    except ValueError: data = None
+    if not isinstance(data, dict):
+        head = (text or '')[:2048].lower()
+        if any(marker in head for marker in CHALLENGE_MARKERS): return 'challenge', None
+        if status in (401, 403): return 'auth_error', None
+        return ('server_error' if status >= 500 else 'bad_response'), None
+    if status in (401, 403): return 'auth_error', data
+    if status >= 500: return 'server_error', data
+    return ('http_error' if status >= 400 else 'ok'), data
+
+
+class CircuitBreaker:
+    # closed -> (failure_threshold lỗi liên tiếp) -> open -> (hết open_for giây) -> half_open: chỉ cho 1 request thăm dò.
+    # Thăm dò thành công -> closed; thất bại -> open lại với open_for gấp đôi (tối đa max_open). Không tự khoá: dùng trong lock của GolikeGuard.
+    __slots__ = ('threshold', 'base_open', 'max_open', 'state', 'failures', 'open_for', 'opened_until', 'reopen_at_wall', 'probe_started', 'trips')
+
+    def __init__(self, threshold, base_open, max_open):
+        self.threshold = threshold; self.base_open = base_open; self.max_open = max_open
+        self.state = 'closed'; self.failures = 0; self.open_for = base_open; self.opened_until = 0.0; self.reopen_at_wall = 0.0
+        self.probe_started = None; self.trips = 0
+
+    def peek(self, now):
+        # Số giây phải chờ (0 = được gửi), không đổi trạng thái.
+        if self.state == 'open': return max(0.0, self.opened_until - now)
+        if self.state == 'half_open' and self.probe_started is not None and now - self.probe_started < 30: return 1.0
+        return 0.0
+
+    def claim(self, now):
+        if self.state == 'open': self.state = 'half_open'; self.probe_started = None
+        if self.state == 'half_open': self.probe_started = now
+
+    def record(self, ok, now):
+        if ok: self.state = 'closed'; self.failures = 0; self.open_for = self.base_open; self.probe_started = None; return
+        self.failures += 1
+        if self.state == 'half_open' or self.failures >= self.threshold:
+            if self.state == 'half_open': self.open_for = min(self.open_for * 2, self.max_open)
+            self.state = 'open'; self.opened_until = now + self.open_for; self.reopen_at_wall = time.time() + self.open_for
+            self.probe_started = None; self.trips += 1
+
+    def release_probe(self):
+        if self.state == 'half_open': self.probe_started = None
+
+
+class RetryBudget:
+    # Token bucket cho request "thử lại" (gửi khi endpoint đang lỗi). Không tự khoá.
+    __slots__ = ('tokens', 'capacity', 'per_second', 'ratio', 'updated')
+
+    def __init__(self, per_minute, ratio, now):
+        self.capacity = max(per_minute, 1.0); self.tokens = self.capacity; self.per_second = per_minute / 60.0; self.ratio = ratio; self.updated = now
+
+    def wait(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.per_second); self.updated = now
+        if self.tokens >= 1: return 0.0
+        return (1 - self.tokens) / self.per_second if self.per_second else 60.0
+
+    def spend(self): self.tokens -= 1
+
+    def deposit(self): self.tokens = min(self.capacity, self.tokens + self.ratio)
+
+
+class GolikeGuard:
+    # Một breaker + retry budget cho mỗi endpoint (vd "instagram/jobs") và một breaker cho mỗi token, dùng chung cho mọi worker.
+    def __init__(self, threshold, base_open, max_open, budget_per_minute, budget_ratio, max_tokens=10000):
+        self.threshold = threshold; self.base_open = base_open; self.max_open = max_open
+        self.budget_per_minute = budget_per_minute; self.budget_ratio = budget_ratio; self.max_tokens = max_tokens
+        self.lock = threading.Lock(); self.endpoints = {}; self.tokens = OrderedDict()
+        self.blocked = 0; self.retries = 0
+
+    def _endpoint(self, key, now):
+        entry = self.endpoints.get(key)
+        if entry is None: entry = self.endpoints[key] = (CircuitBreaker(self.threshold, self.base_open, self.max_open), RetryBudget(self.budget_per_minute, self.budget_ratio, now))
+        return entry
+
+    def _token(self, token, create=True):
+        fingerprint = token_fingerprint(token); breaker = self.tokens.get(fingerprint)
+        if breaker is None and create:
+            breaker = self.tokens[fingerprint] = CircuitBreaker(self.threshold, self.base_open, self.max_open)
+            if len(self.tokens) > self.max_tokens:
+                for old in [f for f, b in self.tokens.items() if b.state == 'closed' and not b.failures][:len(self.tokens) - self.max_tokens]: del self.tokens[old]
+        elif breaker is not None: self.tokens.move_to_end(fingerprint)
+        return breaker
+
+    def wait_time(self, key, token):
+        now = time.monotonic()
+        with self.lock:
+            breaker, _ = self._endpoint(key, now); token_breaker = self._token(token, create=False)
+            return max(breaker.peek(now), token_breaker.peek(now) if token_breaker else 0.0)
+
+    def acquire(self, key, token):
+        now = time.monotonic()
+        with self.lock:
+            breaker, budget = self._endpoint(key, now); token_breaker = self._token(token)
+            wait = breaker.peek(now)
+            if wait: self.blocked += 1; raise GatewayUnavailable(wait, f"{key} đang tạm ngắt")
+            wait = token_breaker.peek(now)
+            if wait: self.blocked += 1; raise GatewayUnavailable(wait, "token đang tạm ngắt")
+            retry = breaker.failures > 0 or breaker.state == 'half_open'
+            if retry:
+                wait = budget.wait(now)
+                if wait: self.blocked += 1; raise GatewayUnavailable(wait, f"{key} hết lượt thử lại")
+                budget.spend(); self.retries += 1
+            breaker.claim(now); token_breaker.claim(now)
+
+    def release(self, key, token, outcome):
+        now = time.monotonic()
+        with self.lock:
+            breaker, budget = self._endpoint(key, now); token_breaker = self._token(token)
+            if outcome == 'cancelled': breaker.release_probe(); token_breaker.release_probe(); return
+            endpoint_ok = outcome not in ENDPOINT_FAILURES
+            breaker.record(endpoint_ok, now)
+            if endpoint_ok:
+                budget.deposit(); token_breaker.record(outcome not in TOKEN_FAILURES, now)
+            else: token_breaker.release_probe()
+
+    def describe(self, token, platforms):
+        # Một dòng cho dashboard; chỉ đổi khi trạng thái breaker đổi (giờ mở lại là mốc cố định, không đếm ngược).
+        now = time.monotonic(); problems = []
+        fmt = lambda breaker: datetime.fromtimestamp(breaker.reopen_at_wall, DISPLAY_TZ).strftime('%H:%M:%S')
+        with self.lock:
+            for key, (breaker, _) in sorted(self.endpoints.items()):
+                if key.split('/')[0] not in platforms: continue
+                if breaker.state != 'closed': problems.append(f"⛔ {key} ngắt tới {fmt(breaker)}" if breaker.peek(now) else f"🔄 {key} đang thử lại")
+                elif breaker.failures: problems.append(f"⚠️ {key} lỗi {breaker.failures} lần")
+            token_breaker = self._token(token, create=False)
+            if token_breaker is not None and token_breaker.state != 'closed': problems.append(f"🔑 token bị từ chối, thử lại lúc {fmt(token_breaker)}")
+        return "🛡️ Golike: " + (" | ".join(problems) if problems else "✅ ổn định")
+
+    def stats(self):
+        with self.lock:
+            return {'open_endpoints': sum(1 for b, _ in self.endpoints.values() if b.state != 'closed'),
+                    'open_tokens': sum(1 for b in self.tokens.values() if b.state != 'closed'),
+                    'trips': sum(b.trips for b, _ in self.endpoints.values()) + sum(b.trips for b in self.tokens.values()),
+                    'blocked': self.blocked, 'retries': self.retries}
+
+
+GOLIKE_GUARD = GolikeGuard(BREAKER_FAILURES, BREAKER_OPEN_SECONDS, BREAKER_MAX_OPEN, RETRY_BUDGET_PER_MIN, RETRY_BUDGET_RATIO)
+
+
+class TokenInflightLimiter:
+    # Tối đa `limit` request Golike đang chờ cùng lúc cho mỗi token (tính chung mọi worker/chat dùng token đó, cả thread lẫn asyncio).
+    # Semaphore chỉ tồn tại khi còn người dùng. Worker thread chờ bằng hold(), task asyncio bằng hold_async() (không chặn event loop).
+    ASYNC_POLL = 0.02   # giây giữa hai lần thử lấy chỗ của task asyncio
+
+    def __init__(self, limit):
+        self.limit = limit; self.lock = threading.Lock(); self.entries = {}   # fingerprint -> [semaphore, users]
+        self.waited = 0
+
+    def _enter(self, token):
+        fingerprint = token_fingerprint(token)
+        with self.lock:
+            entry = self.entries.get(fingerprint)
+            if entry is None: entry = self.entries[fingerprint] = [threading.BoundedSemaphore(self.limit), 0]
+            entry[1] += 1
+        return fingerprint, entry
+
+    def _exit(self, fingerprint, entry):
+        with self.lock:
+            entry[1] -= 1
+            if entry[1] == 0 and self.entries.get(fingerprint) is entry: del self.entries[fingerprint]
+
+    @contextmanager
+    def hold(self, token):
+        fingerprint, entry = self._enter(token)
+        try:
+            if not entry[0].acquire(blocking=False): self.waited += 1; entry[0].acquire()
+            try: yield
+            finally: entry[0].release()
+        finally: self._exit(fingerprint, entry)
+
+    @asynccontextmanager
+    async def hold_async(self, token):
+        fingerprint, entry = self._enter(token)
+        try:
+            if not entry[0].acquire(blocking=False):
+                self.waited += 1
+                while not entry[0].acquire(blocking=False): await asyncio.sleep(self.ASYNC_POLL)
+            try: yield
+            finally: entry[0].release()
+        finally: self._exit(fingerprint, entry)
+
+    def stats(self):
+        with self.lock: return {'limit': self.limit, 'tokens': len(self.entries), 'waited': self.waited}
+
+
+GOLIKE_INFLIGHT = TokenInflightLimiter(TOKEN_MAX_INFLIGHT)
+
+def golike_request(scraper, method, url, endpoint, platform, **kwargs):
+    # -> (response, data, outcome, giây). data None: lỗi mạng/phản hồi không dùng được, metric đã được ghi ở đây.
+    # Ném GatewayUnavailable (không gửi gì) khi breaker đang mở hoặc hết retry budget.
+    key = f"{platform}/{endpoint}"; token = (kwargs.get('headers') or {}).get('authorization', '')
+    with GOLIKE_INFLIGHT.hold(token):
+        GOLIKE_GUARD.acquire(key, token); started = time.perf_counter()
+        try: response = scraper.request(method, url, **kwargs); error = None
+        except Exception as e: response = None; error = e
+        elapsed = time.perf_counter() - started
+    if error is not None:
+        outcome = 'timeout' if is_timeout_error(error) else 'network_error'
+        GOLIKE_GUARD.release(key, token, outcome); record_golike_call(endpoint, platform, elapsed, outcome); return None, None, outcome, elapsed
+    outcome, data = classify_golike_response(response.status_code, response.text)
+    GOLIKE_GUARD.release(key, token, outcome)
+    if data is None: record_golike_call(endpoint, platform, elapsed, outcome)
+    return response, data, outcome, elapsed
+
+
+# ==============================================================================
+# PHẦN GỬI TIN TELEGRAM: MỘT HÀNG ĐỢI CHUNG, TOKEN BUCKET THEO CHAT VÀ TOÀN CỤC
+# ==============================================================================
+
+class OutboxFullError(Exception): pass
+
+
+class TokenBucket:
+    # Không tự khoá: chỉ dùng bên trong lock của TelegramOutbox.
+    def __init__(self, rate, burst):
+        self.rate = rate; self.capacity = burst; self.tokens = float(burst); self.updated = time.monotonic()
+
+    def delay(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate); self.updated = now
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self): self.tokens -= 1
+
+
+class OutboundCall:
+    __slots__ = ('chat_id', 'method', 'args', 'kwargs', 'coalesce_key', 'future', 'attempts', 'enqueued_at')
+
+    def __init__(self, chat_id, method, args, kwargs, coalesce_key):
+        self.chat_id = chat_id; self.method = method; self.args = args; self.kwargs = kwargs; self.coalesce_key = coalesce_key
+        self.future = Future(); self.attempts = 0; self.enqueued_at = time.monotonic()
+
+
+def telegram_retry_after(error):
+    if getattr(error, 'error_code', None) != 429: return None
+    return ((getattr(error, 'result_json', None) or {}).get('parameters') or {}).get('retry_after', 1)
+
+
+class TelegramOutbox:
+    # Mọi lời gọi gửi/sửa/xoá tin nhắn đi qua đây. Mỗi chat chỉ có 1 lời gọi đang chạy (giữ thứ tự),
+    # các lệnh sửa cùng một tin nhắn đang chờ được gộp lại để chỉ gửi nội dung mới nhất.
+    def __init__(self, per_chat_rate, per_chat_burst, global_rate, global_burst, max_pending, workers):
+        self.per_chat_rate = per_chat_rate; self.per_chat_burst = per_chat_burst; self.max_pending = max_pending; self.workers = workers
+        self.cond = threading.Condition(); self.thread = None; self.executor = None; self.closed = False
+        self.queues = OrderedDict()      # chat_id -> deque[OutboundCall], chỉ chứa chat còn tin chờ
+        self.pending_keys = {}           # coalesce_key -> OutboundCall đang chờ
+        self.chat_buckets = {}; self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.backoff_until = {}; self.busy = set(); self.depth = 0
+        self.sent = 0; self.failed = 0; self.dropped = 0; self.coalesced = 0; self.rate_limited = 0
+
+    def _ensure_started(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.executor = self.executor or ThreadPoolExecutor(self.workers, thread_name_prefix="TG_SENDER")
+            self.thread = threading.Thread(target=self._run, daemon=True, name="TG_OUTBOX"); self.thread.start()
+
+    def submit(self, chat_id, method, /, *args, coalesce_key=None, **kwargs):
+        with self.cond:
+            self._ensure_started()
+            if coalesce_key is not None and coalesce_key in self.pending_keys:
+                call = self.pending_keys[coalesce_key]; call.args = args; call.kwargs = kwargs; self.coalesced += 1
+                return call.future
+            call = OutboundCall(chat_id, method, args, kwargs, coalesce_key)
+            if self.closed: call.future.set_exception(RuntimeError("Hàng đợi Telegram đã đóng")); return call.future
+            if self.depth >= self.max_pending:
+                self.dropped += 1; call.future.set_exception(OutboxFullError(f"Hàng đợi Telegram đầy ({self.max_pending})")); return call.future
+            self.queues.setdefault(chat_id, deque()).append(call); self.depth += 1
+            if coalesce_key is not None: self.pending_keys[coalesce_key] = call
+            self.cond.notify()
+            return call.future
+
+    def _next_call(self, now):
+        wait = None
+        for chat_id, pending in self.queues.items():
+            if chat_id in self.busy: continue
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None: bucket = self.chat_buckets[chat_id] = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+            delay = max(bucket.delay(now), self.backoff_until.get(chat_id, 0) - now)
+            if delay > 0: wait = delay if wait is None else min(wait, delay); continue
+            global_delay = self.global_bucket.delay(now)
+            if global_delay > 0: return None, global_delay
+            call = pending.popleft(); self.depth -= 1
+            if not pending: del self.queues[chat_id]
+            else: self.queues.move_to_end(chat_id)   # xoay vòng công bằng giữa các chat
+            if call.coalesce_key is not None and self.pending_keys.get(call.coalesce_key) is call: del self.pending_keys[call.coalesce_key]
+            bucket.take(); self.global_bucket.take(); self.busy.add(chat_id); self.backoff_until.pop(chat_id, None)
+            return call, 0
+        return None, wait
+
+    def _run(self):
+        while True:
+            with self.cond:
+                if self.closed: return
+                call, wait = self._next_call(time.monotonic())
+                if call is None:
+                    self.cond.wait(wait); continue
+                # Dọn bucket của các chat đã im lặng (bucket đầy lại sau burst/rate giây).
+                if len(self.chat_buckets) > 10000: self.chat_buckets = {c: b for c, b in self.chat_buckets.items() if c in self.queues or c in self.busy}
+            try: self.executor.submit(self._execute, call)
+            except RuntimeError as e:   # executor đã đóng (tiến trình đang thoát): báo lỗi cho người gọi thay vì in traceback
+                with self.cond: self.busy.discard(call.chat_id); self.failed += 1
+                call.future.set_exception(e); return
+
+    def shutdown(self, timeout=5):
+        # Ngừng nhận lời gọi mới, dừng thread điều phối, chờ các lời gọi đang gửi xong (tối đa `timeout`) rồi đóng executor.
+        with self.cond: self.closed = True; self.cond.notify_all()
+        if self.thread is not None: self.thread.join(timeout)
+        if self.executor is not None: self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def _execute(self, call):
+        call.attempts += 1; started = time.perf_counter()
+        try: result = getattr(bot, call.method)(*call.args, **call.kwargs)
+        except Exception as e:
+            retry_after = telegram_retry_after(e)
+            record_telegram_call(call.method, time.perf_counter() - started, 'rate_limited' if retry_after is not None else 'error')
+            with self.cond:
+                self.busy.discard(call.chat_id)
+                if retry_after is not None and call.attempts <= TG_MAX_RETRIES:
+                    self.rate_limited += 1; self.backoff_until[call.chat_id] = time.monotonic() + retry_after
+                    newer = self.pending_keys.get(call.coalesce_key) if call.coalesce_key is not None else None
+                    if newer is None:
+                        self.queues.setdefault(call.chat_id, deque()).appendleft(call); self.depth += 1
+                        if call.coalesce_key is not None: self.pending_keys[call.coalesce_key] = call
+                        self.cond.notify(); return
+                    # Đã có bản sửa mới hơn đang chờ: bỏ bản cũ, người gọi nhận kết quả của bản mới.
+                    self.coalesced += 1; self.cond.notify()
+                else: newer = None; self.failed += 1; self.cond.notify()
+            if newer is not None: newer.future.add_done_callback(lambda f: _copy_future(f, call.future))
+            else: call.future.set_exception(e)
+            return
+        record_telegram_call(call.method, time.perf_counter() - started, 'ok')
+        with self.cond: self.busy.discard(call.chat_id); self.sent += 1; self.cond.notify()
+        call.future.set_result(result)
+
+    def stats(self):
+        with self.cond:
+            return {'queue_depth': self.depth, 'chats_waiting': len(self.queues), 'in_flight': len(self.busy), 'sent': self.sent, 'failed': self.failed,
+                    'dropped': self.dropped, 'coalesced': self.coalesced, 'rate_limited': self.rate_limited}
+
+
+def _copy_future(source, target):
+    if source.exception() is not None: target.set_exception(source.exception())
+    else: target.set_result(source.result())
+
+
+OUTBOX = TelegramOutbox(TG_PER_CHAT_RATE, TG_PER_CHAT_BURST, TG_GLOBAL_RATE, TG_GLOBAL_BURST, TG_OUTBOX_MAX, TG_OUTBOX_WORKERS)
+
+def tg_send(chat_id, text, **kwargs): return OUTBOX.submit(chat_id, 'send_message', chat_id, text, **kwargs)
+
+def tg_edit(chat_id, message_id, text, **kwargs):
+    return OUTBOX.submit(chat_id, 'edit_message_text', coalesce_key=('edit', chat_id, message_id), chat_id=chat_id, message_id=message_id, text=text, **kwargs)
+
+def tg_delete(chat_id, message_id): return OUTBOX.submit(chat_id, 'delete_message', chat_id, message_id)
+
+
+# ==============================================================================
+# 2. CLASS QUẢN LÝ TRẠNG THÁI VÀ LOG
+# ==============================================================================
+
+class JobStateRegistry:
+    # Thay cho dict chat_id -> UserJobState (giữ nguyên cách dùng get/[]/in/del/values). Chat đang chạy không bao giờ bị bỏ;
+    # chat đã dừng nằm trong LRU, quá max_idle chat hoặc idle_ttl giây không dùng thì bỏ khỏi RAM.
+    # Lần truy cập sau, handler thấy None và dựng lại từ Database như trước.
+    def __init__(self, max_idle, idle_ttl):
+        self.max_idle = max_idle; self.idle_ttl = idle_ttl
+        self.lock = threading.Lock(); self.states = OrderedDict()   # chat_id -> [state, lần dùng cuối (monotonic)]
+        self.last_sweep = time.monotonic(); self.evicted = 0
+
+    def get(self, chat_id, default=None):
+        with self.lock:
+            entry = self.states.get(chat_id)
+            if entry is None: return default
+            entry[1] = time.monotonic(); self.states.move_to_end(chat_id)
+            if entry[1] - self.last_sweep > 60: self._evict(entry[1])
+            return entry[0]
+
+    def __getitem__(self, chat_id):
+        state = self.get(chat_id)
+        if state is None: raise KeyError(chat_id)
+        return state
+
+    def __setitem__(self, chat_id, state):
+        with self.lock:
+            now = time.monotonic(); self.states[chat_id] = [state, now]; self.states.move_to_end(chat_id)
+            if len(self.states) > self.max_idle or now - self.last_sweep > 60: self._evict(now)
+
+    def __delitem__(self, chat_id):
+        with self.lock: del self.states[chat_id]
+
+    def pop(self, chat_id, default=None):
+        with self.lock: entry = self.states.pop(chat_id, None)
+        return default if entry is None else entry[0]
+
+    def __contains__(self, chat_id):
+        with self.lock: return chat_id in self.states
+
+    def __len__(self): return len(self.states)
+
+    def values(self):
+        with self.lock: return [entry[0] for entry in self.states.values()]
+
+    def items(self):
+        with self.lock: return [(chat_id, entry[0]) for chat_id, entry in self.states.items()]
+
+    def _evict(self, now):
+        # Duyệt từ chat lâu không dùng nhất; bỏ chat đã dừng khi quá hạn tuổi hoặc số chat đã dừng vượt max_idle.
+        self.last_sweep = now
+        idle = [chat_id for chat_id, (state, _) in self.states.items() if not state.is_running]
+        excess = len(idle) - self.max_idle
+        for chat_id in idle:
+            if excess <= 0 and now - self.states[chat_id][1] < self.idle_ttl: break
+            del self.states[chat_id]; excess -= 1; self.evicted += 1
+
+    def stats(self):
+        with self.lock:
+            running = sum(1 for state, _ in self.states.values() if state.is_running)
+            return {'states': len(self.states), 'running': running, 'idle': len(self.states) - running, 'evicted': self.evicted}
+
+
+USER_JOB_STATES = JobStateRegistry(STATE_CACHE_MAX, STATE_IDLE_TTL)
+
+
+class JobEngineRegistry:
+    # Dấu vân tay token -> state đang chạy worker cho token đó (host). Chat khác dùng cùng token không tạo worker riêng
+    # mà gắn vào host: dashboard đọc số liệu của host, host báo cập nhật cho mọi chat gắn vào. Engine chỉ dừng khi
+    # chat cuối cùng rời đi; chat chủ rời trước thì engine được chuyển sang chat gắn vào sớm nhất.
+    # Chỉ khử trùng trong một node: với sharding, các chat cùng token ở node khác nhau vẫn chạy riêng.
+    def __init__(self):
+        self.lock = threading.Lock(); self.hosts = {}; self.attached = 0; self.handovers = 0
+
+    def claim(self, state):
+        # -> None: state thành host (caller tự khởi động worker, lỗi thì gọi release). Ngược lại: host đã có, state được gắn vào.
+        fingerprint = token_fingerprint(state.auth_token)
+        with self.lock:
+            host = self.hosts.get(fingerprint)
+            if host is None or host is state: self.hosts[fingerprint] = state; return None
+            state.engine = host; state.is_running = True; host.subscribers += (state,); self.attached += 1
+        DASHBOARD_REFRESHER.watch(state); host.add_activity_log(f"🔗 Chat khác đã gắn vào engine ({len(host.subscribers) + 1} chat).")
+        return host
+
+    def release(self, host):
+        # Host dừng hẳn: bỏ đăng ký và tách mọi chat đang gắn. -> các state vừa bị tách.
+        with self.lock:
+            fingerprint = token_fingerprint(host.auth_token)
+            if self.hosts.get(fingerprint) is host: del self.hosts[fingerprint]
+            subscribers = host.subscribers; host.subscribers = ()
+            for subscriber in subscribers: subscriber.engine = None; subscriber.is_running = False
+        return subscribers
+
+    def detach(self, state):
+        # Chat gắn vào rời engine. -> host (None nếu không gắn).
+        with self.lock:
+            host = state.engine
+            if host is None: return None
+            state.engine = None; state.is_running = False; host.subscribers = tuple(s for s in host.subscribers if s is not state)
+        return host
+
+    def hand_over(self, host):
+        # Chat chủ rời nhưng engine còn chat khác dùng: state đang chạy được chuyển sang chat gắn vào sớm nhất
+        # (đổi chat_id + tin Status), chat chủ nhận một state mới đã dừng. -> state mới của chat chủ (None nếu không còn ai
+        # gắn hoặc không lấy được lease cho chat nhận: caller dừng engine). Sổ cái/lịch sử ghi sau đó thuộc chat nhận.
+        while True:
+            with self.lock:
+                if not host.subscribers: return None
+                successor = host.subscribers[0]
+            if not SHARDS.acquire(successor.chat_id): return None   # round-trip DB: làm ngoài lock
+            with self.lock:
+                if host.subscribers and host.subscribers[0] is successor:
+                    host.subscribers = host.subscribers[1:]; successor.engine = None; successor.is_running = False
+                    old_chat = host.chat_id; stopped = UserJobState(host.auth_token, old_chat, dict(host.platform_config), dict(host.concurrency))
+                    with host.lock: stopped.total_money, stopped.total_success, stopped.total_failed = host.total_money, host.total_success, host.total_failed
+                    stopped.last_status_message_id = host.last_status_message_id
+                    host.chat_id = successor.chat_id; host.last_status_message_id = successor.last_status_message_id; host.last_rendered_status = None
+                    self.handovers += 1; break
+            if successor.engine is not host: SHARDS.release(successor.chat_id)   # chat nhận vừa rời engine: trả lại lease
+        with user_states_lock: USER_JOB_STATES[old_chat] = stopped; USER_JOB_STATES[host.chat_id] = host
+        SNAPSHOTTER.forget(old_chat); SHARDS.release(old_chat)
+        host.add_activity_log("🔗 Chat chủ đã rời, engine tiếp tục chạy cho chat này."); host.signal_status_update()
+        return stopped
+
+    def stats(self):
+        with self.lock: return {'engines': len(self.hosts), 'shared': sum(1 for host in self.hosts.values() if host.subscribers),
+                                'attached': self.attached, 'handovers': self.handovers}
+
+
+JOB_ENGINES = JobEngineRegistry()
+
+def leave_job(job_state):
+    # Chat rời job đang chạy. -> (state hiện tại của chat, số worker đã dừng, số chat còn dùng engine).
+    if job_state.engine is not None:
+        host = JOB_ENGINES.detach(job_state); SHARDS.release(job_state.chat_id)
+        if host is not None: host.add_activity_log(f"🔗 Một chat đã rời engine (còn {len(host.subscribers) + 1} chat)."); host.signal_status_update()
+        return job_state, 0, (len(host.subscribers) + 1 if host is not None else 0)
+    stopped = JOB_ENGINES.hand_over(job_state) if job_state.subscribers else None
+    if stopped is not None: return stopped, 0, len(job_state.subscribers) + 1
+    return job_state, job_state.stop_workers(wait=False), 0   # không chờ worker thoát: gọi từ UPDATE_WORKER, watchdog dọn sau
+
+
+class ActivityRing:
+    # Vòng `size` bản ghi cấp phát sẵn: (seq, ts, kind, platform, account, amount, text), ghi đè bản cũ nhất.
+    # Chỉ lưu dữ liệu thô; chuỗi Markdown/JSON được dựng lúc hiển thị hoặc xuất. Ghi phải giữ lock của UserJobState,
+    # đọc không cần khoá: mỗi ô mang seq của nó nên ô vừa bị ghi đè trong lúc đọc sẽ bị bỏ qua.
+    __slots__ = ('slots', 'seq')
+
+    def __init__(self, size): self.slots = [None] * max(size, 1); self.seq = 0
+
+    def append(self, ts, kind, platform=None, account=None, amount=0, text=None):
+        self.slots[self.seq % len(self.slots)] = (self.seq, ts, kind, platform, account, amount, text); self.seq += 1
+
+    def __len__(self): return min(self.seq, len(self.slots))
+
+    def recent(self, limit=None, since=0):
+        # Duyệt các bản ghi còn trong vòng (cũ -> mới), seq >= since, tối đa `limit` bản mới nhất.
+        end = self.seq; size = len(self.slots); start = max(end - size, since, end - limit if limit else 0)
+        for seq in range(start, end):
+            record = self.slots[seq % size]
+            if record is not None and record[0] == seq: yield record
+
+
+ACTIVITY_LABELS = {'instagram': 'INSTA', 'threads': 'THREADS'}
+
+def format_activity(record):
+    _, ts, kind, platform, account, amount, text = record
+    timestamp = datetime.fromtimestamp(ts, DISPLAY_TZ).strftime("%H:%M:%S")
+    if kind == 'job_ok': text = f"✅ {ACTIVITY_LABELS.get(platform, platform)} `{account}` | +{amount} xu"
+    elif kind == 'job_failed': text = f"❌ {ACTIVITY_LABELS.get(platform, platform)} `{account}` thất bại."
+    return f"*{timestamp}*: {text}"
+
+def activity_jsonl(ring, since=0):
+    # Sinh từng dòng JSONL thẳng từ vòng sự kiện (dùng cho /export và route HTTP, không dựng list trung gian).
+    for seq, ts, kind, platform, account, amount, text in ring.recent(since=since):
+        yield json.dumps({'seq': seq, 'ts': round(ts, 3), 'time': datetime.fromtimestamp(ts, DISPLAY_TZ).isoformat(timespec='seconds'),
+                          'kind': kind, 'platform': platform, 'account': account, 'amount': amount, 'text': text}, ensure_ascii=False) + "\n"
+
+
+def worker_key(platform, worker_id): return f"{platform}#{worker_id}"
+
+def partition_accounts(accounts, workers):
+    # Chia UID thành tối đa `workers` nhóm rời nhau, xen kẽ theo thứ tự (nhóm lệch nhau nhiều nhất 1 UID).
+    workers = max(1, min(workers, len(accounts)))
+    return [accounts[index::workers] for index in range(workers)]
+
+
+class WorkerHandle:
+    # Một worker thread: stop event riêng (worker ngủ qua pause() nên dừng là thoát ngay, không chờ hết 8-15s).
+    # Thread không huỷ ngang được nên luôn drain: lời gọi đang chạy (kể cả complete-jobs) xong rồi worker mới thoát.
+    # AsyncWorkerHandle có cùng giao diện cho JOB_ENGINE=asyncio.
+    __slots__ = ('name', 'platform', 'worker_id', 'accounts', 'stop_event', 'busy', 'thread')
+
+    def __init__(self, platform, worker_id, accounts, name):
+        self.platform = platform; self.worker_id = worker_id; self.accounts = accounts; self.name = name
+        self.stop_event = threading.Event(); self.busy = False; self.thread = None
+
+    def start(self, target, job_state):
+        self.thread = threading.Thread(target=target, args=(job_state, self), daemon=True, name=self.name); self.thread.start()
+        return self
+
+    @property
+    def stopping(self): return self.stop_event.is_set()
+
+    def pause(self, seconds): return self.stop_event.wait(seconds)   # -> True nếu đã bị yêu cầu dừng
+
+    def is_alive(self): return self.thread is not None and self.thread.is_alive()
+
+    def stop(self, drain=True): self.stop_event.set()
+
+    def join(self, timeout):
+        if self.thread is not None: self.thread.join(timeout)
+        return not self.is_alive()
+
+
+class UserJobState:
+    # __slots__ + một lock chung; activity_log là ActivityRing (bản ghi thô, chỉ định dạng khi hiển thị).
+    # schedulers / worker_stats theo khoá worker "instagram#1", "threads#2"...; mỗi worker một nhóm UID riêng.
+    # Nhiều chat cùng token dùng chung một engine (xem JobEngineRegistry): `engine` là state đang chạy worker mà chat này gắn vào,
+    # `subscribers` (tuple, thay mới mỗi lần đổi) là các chat đang gắn vào state này.
+    __slots__ = ('auth_token', 'chat_id', 'is_running', 'threads', 'platform_config', 'concurrency', 'total_money', 'total_success', 'total_failed',
+                 'schedulers', 'worker_accounts', 'worker_stats', 'last_status_message_id', 'last_rendered_status', 'activity_log', 'lock', 'last_no_job_log',
+                 'engine', 'subscribers')
+
+    def __init__(self, auth_token, chat_id, platform_config: dict, concurrency: Optional[dict] = None):
+        self.auth_token = auth_token; self.chat_id = chat_id
+        self.is_running = False; self.threads = []
+        self.platform_config = platform_config 
+        self.concurrency = concurrency or default_concurrency()   # số worker mỗi nền tảng
+        self.total_money = 0; self.total_success = 0; self.total_failed = 0
+        self.schedulers = {}; self.worker_accounts = {}; self.worker_stats = {}   # worker_stats: khoá -> [số UID, job, xu, lúc bắt đầu, job/giờ tại job gần nhất]
+        self.last_status_message_id = None 
+        self.last_rendered_status = None    # (message_id, text) đã gửi gần nhất, để bỏ qua lần sửa trùng nội dung
+        self.activity_log = ActivityRing(ACTIVITY_LOG_SIZE)
+        self.lock = threading.Lock()
+        now = time.time(); self.last_no_job_log = {'instagram': now, 'threads': now}
+        self.engine = None; self.subscribers = ()
+
+    def signal_status_update(self):
+        DASHBOARD_REFRESHER.mark_dirty(self)
+        for subscriber in self.subscribers: DASHBOARD_REFRESHER.mark_dirty(subscriber)
+
+    def send_log_message(self, message):
+        timestamp = datetime.now(DISPLAY_TZ).strftime("%H:%M:%S"); log_message = f"`[{timestamp}] {message}`"
+        tg_send(self.chat_id, log_message, parse_mode='Markdown')
+            
+    def add_activity_log(self, message, kind='note', platform=None):
+        with self.lock: self.activity_log.append(time.time(), kind, platform, text=message)
+
+    def add_job_event(self, platform, account_name, success, amount):
+        with self.lock: self.activity_log.append(time.time(), 'job_ok' if success else 'job_failed', platform, account_name, amount)
+
+    def record_job_result(self, platform, account_name, success, money_earned, account_id=None, job_id=None, latency=None):
+        LEDGER.append(self.chat_id, platform, account_id if account_id is not None else account_name, job_id, money_earned if success else 0, success, latency)
+        if success:
+            METRICS.inc('golike_xu_earned_total', (('platform', platform),), money_earned)
+            with self.lock: self.total_money += money_earned; self.total_success += 1
+        else:
+            with self.lock: self.total_failed += 1
+        self.add_job_event(platform, account_name, success, money_earned if success else 0)
+
+    def get_next_account(self, accounts, platform, worker_id=1):
+        # -> (account, wait): account None + wait > 0 nghĩa là mọi UID đang cooldown, chờ `wait` giây.
+        key = worker_key(platform, worker_id)
+        with self.lock:
+            scheduler = self.schedulers.get(key)
+            if scheduler is None or scheduler.accounts is not accounts:
+                scheduler = self.schedulers[key] = ACCOUNT_SCHEDULERS.get(ACCOUNT_SCHEDULER, YieldAwareScheduler)(accounts)
+        return scheduler.next_account()
+
+    def requeue_account(self, platform, account, worker_id=1):
+        scheduler = self.schedulers.get(worker_key(platform, worker_id))
+        if scheduler is not None: scheduler.requeue(account)
+
+    def record_poll(self, platform, account, hit, earned=0, worker_id=1):
+        key = worker_key(platform, worker_id); scheduler = self.schedulers.get(key)
+        if scheduler is not None: scheduler.record(account, hit, earned)
+        with self.lock:
+            stats = self.worker_stats.get(key)
+            if stats is not None and hit:
+                # Tốc độ chỉ tính lại khi có job: dòng worker trên Status không đổi giữa các lượt hỏi trống (không phải sửa tin nhắn).
+                stats[1] += 1; stats[2] += earned; stats[4] = stats[1] * 3600 / max(time.monotonic() - stats[3], 60.0)
+        if SCHED_TRACE_FILE: trace_poll(platform, account['id'], hit, earned)
+
+    def snapshot(self):
+        # Trạng thái gọn để chạy tiếp sau khi khởi động lại (JSON được). Token không lưu ở đây, chỉ lưu dấu vân tay.
+        # Scheduler của các worker cùng nền tảng được gộp lại theo nền tảng, nên đổi số worker giữa 2 lần chạy vẫn nạp lại được.
+        # Chat chỉ gắn vào engine của chat khác: chỉ cần nhớ để gắn lại (engine chạy tiếp từ snapshot của chat chủ).
+        if self.engine is not None:
+            return {'token': token_fingerprint(self.auth_token), 'shared': True, 'platform_config': self.platform_config, 'concurrency': self.concurrency,
+                    'status_message_id': self.last_status_message_id}
+        with self.lock: totals = [self.total_money, self.total_success, self.total_failed]
+        schedulers = {}
+        for key, scheduler in list(self.schedulers.items()):
+            merged = schedulers.setdefault(key.split('#')[0], {})
+            for field, value in scheduler.export_state().items():
+                if field == 'accounts': merged.setdefault('accounts', {}).update(value)
+                else: merged.setdefault(field, value)
+        return {'token': token_fingerprint(self.auth_token), 'platform_config': self.platform_config, 'concurrency': self.concurrency,
+                'accounts': self.worker_accounts, 'status_message_id': self.last_status_message_id, 'totals': totals, 'schedulers': schedulers}
+
+    def restore(self, snapshot):
+        # Nạp lại bộ đếm + vị trí scheduler cho từng nhóm UID; start_workers dùng lại các nhóm này nếu chia ra giống hệt.
+        self.total_money, self.total_success, self.total_failed = snapshot['totals']
+        self.last_status_message_id = snapshot.get('status_message_id')
+        scheduler_cls = ACCOUNT_SCHEDULERS.get(ACCOUNT_SCHEDULER, YieldAwareScheduler)
+        for platform, accounts in snapshot['accounts'].items():
+            saved = snapshot.get('schedulers', {}).get(platform)
+            if not accounts or not saved or saved.get('strategy') != scheduler_cls.name: continue
+            for worker_id, partition in enumerate(partition_accounts(accounts, self.concurrency.get(platform, 1)), 1):
+                scheduler = self.schedulers[worker_key(platform, worker_id)] = scheduler_cls(partition); scheduler.restore_state(saved)
+
+    def generate_status_text(self):
+        # Chat gắn vào engine dùng chung hiển thị số liệu/log của engine đó (tin Status vẫn là của chat này).
+        source = self.engine if self.is_running and self.engine is not None else self
+        ig_config = '✅' if source.platform_config['instagram'] else '❌'; th_config = '✅' if source.platform_config['threads'] else '❌'
+        status = "*🤖 GOLIKE ROTATOR STATUS *\n"
+        if self.is_running:
+            workers = source.threads; alive = [w for w in workers if w.is_alive()]
+            ig_count = sum(1 for w in alive if w.platform == 'instagram'); th_count = len(alive) - ig_count
+            status += f"🟢 *Trạng thái:* ĐANG CHẠY\n"; status += f"Cấu hình: {ig_config} IG, {th_config} Threads\n"
+            status += f"Worker: `{len(alive)}/{len(workers)}` luồng sống (IG:{ig_count}, TH:{th_count})\n"
+            if source.subscribers: status += f"🔗 Engine dùng chung cho `{len(source.subscribers) + 1}` chat cùng token\n"
+            status += source.format_worker_stats() + "\n"
+        else:
+            status += f"🟡 *Trạng thái:* ĐÃ DỪNG\n"; status += f"Cấu hình: {ig_config} IG, {th_config} Threads\n"; status += f"Worker: `0` luồng\n\n"
+
+        with source.lock: money, success, failed = source.total_money, source.total_success, source.total_failed
+        status += f"💰 *TỔNG THU NHẬP:* `{money}` xu\n"; status += f"✅ Thành công: `{success}`\n"; status += f"❌ Thất bại: `{failed}`\n"
+        if self.is_running: status += GOLIKE_GUARD.describe(self.auth_token, [p for p, enabled in source.platform_config.items() if enabled]) + "\n"
+            
+        status += f"\n\n*🔔 LOG HOẠT ĐỘNG GẦN NHẤT (UTC{TZ_OFFSET_HOURS:+g}):*\n"
+        recent = '\n'.join(format_activity(record) for record in source.activity_log.recent(5))
+        status += recent or "Chưa có hoạt động nào..."
+
+        status += f"\n\n/stopjob để dừng, /config để cấu hình."
+        status += f"\n*Tự động cập nhật mỗi {GLOBAL_LOG_UPDATE_INTERVAL}s (sau khi có Job thành công: Ngay lập tức).*."
+        return status
+        
+    def update_status_message(self, text=None):
+        if not self.last_status_message_id: return None
+
+        text = text if text is not None else self.generate_status_text()
+        
+        keyboard = types.InlineKeyboardMarkup()
+        if self.is_running: 
+            keyboard.row(types.InlineKeyboardButton("⏹️ DỪNG JOB", callback_data="/stopjob"),
+                         types.InlineKeyboardButton("🔄 REFRESH (LẤY DỮ LIỆU)", callback_data="/status"))
+        else: 
+             keyboard.row(types.InlineKeyboardButton("▶️ START JOB", callback_data="/startjob"))
+        keyboard.row(types.InlineKeyboardButton("⚙️ CẤU HÌNH", callback_data="/config"), types.InlineKeyboardButton("🏠 MENU CHÍNH", callback_data="/start"))
+
+
+        message_id = self.last_status_message_id; self.last_rendered_status = (message_id, text)
+        def on_done(future):
+            e = future.exception()
+            if e is None or "message is not modified" in str(e): return
+            if self.last_rendered_status == (message_id, text): self.last_rendered_status = None
+            if "message to edit not found" in str(e).lower() and self.last_status_message_id == message_id: self.last_status_message_id = None
+        pending = tg_edit(self.chat_id, message_id, text, reply_markup=keyboard, parse_mode='Markdown')
+        pending.add_done_callback(on_done)
+        return pending
+
+    def format_worker_stats(self):
+        # Mỗi worker một dòng: số UID, tổng job + xu, job/giờ tính tại job gần nhất (không phụ thuộc lúc vẽ).
+        lines = []
+        with self.lock: stats = sorted((key, list(values)) for key, values in self.worker_stats.items())
+        for key, (uids, jobs, xu, _, rate) in stats:
+            platform, worker_id = key.split('#')
+            lines.append(f"`{'IG' if platform == 'instagram' else 'TH'}#{worker_id}` {uids} UID | {jobs} job (~{rate:.0f}/giờ) | +{xu} xu")
+        return '\n'.join(lines)
+
+    def start_workers(self, instagram_accounts, threads_accounts):
+        self.is_running = True; num_started = 0; self.threads = [] 
+        self.worker_accounts = {'instagram': instagram_accounts if self.platform_config['instagram'] else [],
+                                'threads': threads_accounts if self.platform_config['threads'] else []}
+        now = time.monotonic(); labels = {'instagram': 'IG', 'threads': 'Threads'}
+        with self.lock: self.worker_stats = {}
+
+        for platform, accounts in (('instagram', instagram_accounts), ('threads', threads_accounts)):
+            if not self.platform_config[platform] or not accounts: continue
+            partitions = partition_accounts(accounts, self.concurrency.get(platform, 1))
+            for worker_id, partition in enumerate(partitions, 1):
+                key = worker_key(platform, worker_id); restored = self.schedulers.get(key)
+                # Dùng lại đúng list object của scheduler đã nạp từ snapshot để worker không tạo scheduler mới.
+                if restored is not None and [a['id'] for a in restored.accounts] == [a['id'] for a in partition]: partition = restored.accounts
+                try: worker = self._spawn_worker(platform, worker_id, partition)
+                except RuntimeError as e: print(f"❌ Không khởi động được worker {key} chat_id {self.chat_id}: {e}"); continue
+                with self.lock: self.worker_stats[key] = [len(partition), 0, 0, now, 0.0]
+                self.threads.append(worker); num_started += 1
+            self.add_activity_log(f"Đã khởi chạy {len(partitions)} {labels[platform]} Worker ({len(accounts)} UID)")
+        
+        if not self.threads: self.is_running = False; self.add_activity_log("❌ Không có Worker nào được khởi chạy.")
+        else: DASHBOARD_REFRESHER.watch(self); WORKER_WATCHDOG.ensure_started()
+        return num_started
+
+    def _spawn_worker(self, platform, worker_id, accounts):
+        prefix, target = WORKER_TARGETS[platform]
+        if JOB_ENGINE == "asyncio":
+            worker = AsyncWorkerHandle(platform, worker_id, accounts, f"{prefix}_{worker_id}:{self.chat_id}"); return ASYNC_ENGINE.spawn(worker, async_worker_loop(self, worker))
+        return WorkerHandle(platform, worker_id, accounts, f"{prefix}_{worker_id}").start(target, self)
+
+    def live_workers(self):
+        # -> (số worker còn sống, số worker của lần chạy hiện tại)
+        workers = self.threads; return sum(1 for w in workers if w.is_alive()), len(workers)
+
+    def restart_dead_workers(self):
+        # Worker chết giữa chừng (không phải do bị dừng) được khởi động lại cho đúng nhóm UID đó. -> tên các worker đã thay.
+        # Chỉ gom worker chết trong lock; tạo worker mới ngoài lock (spawn asyncio chờ event loop, loop có thể đang chờ chính lock này).
+        restarted = []
+        with self.lock:
+            if not self.is_running: return restarted
+            dead = [w for w in self.threads if not w.is_alive() and not w.stopping]
+        for worker in dead:
+            try: replacement = self._spawn_worker(worker.platform, worker.worker_id, worker.accounts)
+            except RuntimeError as e: print(f"❌ Không khởi động lại được worker {worker.name} chat_id {self.chat_id}: {e}"); continue
+            with self.lock:
+                swapped = self.is_running and any(w is worker for w in self.threads)
+                if swapped: self.threads = [replacement if w is worker else w for w in self.threads]; restarted.append(worker.name)
+            if not swapped: replacement.stop(); WORKER_WATCHDOG.retire(self.chat_id, [replacement])   # job vừa dừng trong lúc tạo worker
+        for name in restarted: self.add_activity_log(f"♻️ Worker {name} dừng bất thường, đã khởi động lại.", 'warning')
+        return restarted
+
+    def stop_workers(self, keep_snapshot=False, wait=True):
+        # keep_snapshot=True: chuyển chat sang node khác (node mới chạy tiếp từ snapshot), không phải người dùng dừng job.
+        # Dừng hẳn engine: các chat đang gắn vào cũng bị tách ra (người dùng chỉ rời engine thì dùng leave_job).
+        # Mọi worker được báo dừng ngay; wait=True thì chờ chúng thoát (tối đa WORKER_STOP_TIMEOUT), worker chưa thoát kịp do watchdog theo dõi.
+        # Có join + ghi DB: không gọi khi đang giữ user_states_lock.
+        if self.engine is not None: JOB_ENGINES.detach(self); SHARDS.release(self.chat_id); return 0
+        with self.lock: self.is_running = False; workers = self.threads; self.threads = []
+        for worker in workers: worker.stop()
+        WORKER_WATCHDOG.retire(self.chat_id, workers)
+        self.schedulers = {}; self.worker_stats = {}
+        for subscriber in JOB_ENGINES.release(self):
+            SNAPSHOTTER.forget(subscriber.chat_id); SHARDS.release(subscriber.chat_id); subscriber.add_activity_log("⏹️ Engine dùng chung đã dừng."); DASHBOARD_REFRESHER.mark_dirty(subscriber)
+        if not keep_snapshot: SNAPSHOTTER.forget(self.chat_id)
+        SHARDS.release(self.chat_id)
+        if wait and workers:
+            lingering = WORKER_WATCHDOG.join(workers, WORKER_STOP_TIMEOUT)
+            if lingering: self.add_activity_log(f"⏳ {lingering} Worker chưa thoát sau {WORKER_STOP_TIMEOUT:g}s (đang chờ HTTP), watchdog sẽ theo dõi.", 'warning')
+        return len(workers)
+
+
+# ==============================================================================
+# 3. WORKER VÀ CÁC HÀM GOLIKE (ĐÃ FIX LỖI THỤT LỀ)
+# ==============================================================================
+
+class SessionPool:
+    # Mỗi auth token một cloudscraper session keep-alive dùng chung cho mọi lời gọi Golike API của token đó.
+    def __init__(self, max_sessions, connections_per_host, idle_ttl):
+        self.max_sessions = max_sessions; self.connections_per_host = connections_per_host; self.idle_ttl = idle_ttl
+        self.lock = threading.Lock(); self.sessions = OrderedDict()   # token -> [session, last_used]
+        self.created = 0; self.evicted = 0; self.retired_requests = 0; self.retired_connections = 0
+
+    def _create(self):
+        import cloudscraper   # import muộn (~0.3-1s): chỉ trả giá khi worker/API đầu tiên cần, không làm chậm cold start
+        session = cloudscraper.create_scraper(browser={'browser': 'chrome','platform': 'android','mobile': True})
+        # Giữ adapter của cloudscraper (TLS cipher riêng), chỉ giới hạn số connection idle mỗi host.
+        for adapter in session.adapters.values():
+            adapter._pool_connections = adapter._pool_maxsize = self.connections_per_host
+            adapter.init_poolmanager(self.connections_per_host, self.connections_per_host)
+        return session
+
+    @staticmethod
+    def _connection_counts(session):
+        requests_sent = connections = 0
+        for adapter in session.adapters.values():
+            pools = getattr(getattr(adapter, 'poolmanager', None), 'pools', None)
+            if pools is None: continue
+            for key in list(pools.keys()):
+                try: pool = pools[key]
+                except KeyError: continue
+                requests_sent += getattr(pool, 'num_requests', 0); connections += getattr(pool, 'num_connections', 0)
+        return requests_sent, connections
+
+    def _retire(self, token):
+        session = self.sessions.pop(token)[0]
+        requests_sent, connections = self._connection_counts(session)
+        self.retired_requests += requests_sent; self.retired_connections += connections; self.evicted += 1
+        try: session.close()
+        except Exception: pass
+
+    def _evict(self, now):
+        for token in [t for t, (_, last_used) in self.sessions.items() if now - last_used > self.idle_ttl]: self._retire(token)
+        while len(self.sessions) > self.max_sessions: self._retire(next(iter(self.sessions)))
+
+    def _lookup(self, auth_token, now):
+        entry = self.sessions.get(auth_token)
+        if entry is not None: self.sessions.move_to_end(auth_token); entry[1] = now; self._evict(now)
+        return entry
+
+    def get(self, auth_token):
+        with self.lock:
+            entry = self._lookup(auth_token, time.time())
+            if entry is not None: return entry[0]
+        # Dựng session ngoài lock (import + tạo cloudscraper chậm) để token khác không phải chờ; trùng thì bỏ bản thừa.
+        session = self._create()
+        with self.lock:
+            now = time.time(); entry = self._lookup(auth_token, now)
+            if entry is None:
+                self.sessions[auth_token] = [session, now]; self.created += 1; self._evict(now); return session
+        try: session.close()
+        except Exception: pass
+        return entry[0]
+
+    def discard(self, auth_token):
+        with self.lock:
+            if auth_token in self.sessions: self._retire(auth_token)
+
+    def stats(self):
+        with self.lock:
+            self._evict(time.time())
+            requests_sent, connections = self.retired_requests, self.retired_connections
+            for session, _ in self.sessions.values():
+                r, c = self._connection_counts(session); requests_sent += r; connections += c
+            return {'active_sessions': len(self.sessions), 'sessions_created': self.created, 'sessions_evicted': self.evicted,
+                    'requests': requests_sent, 'connections_opened': connections,
+                    'handshakes_saved': max(requests_sent - connections, 0),
+                    'reuse_ratio': round(1 - connections / requests_sent, 3) if requests_sent else 0.0}
+
+
+SESSION_POOL = SessionPool(SESSION_POOL_MAX, SESSION_POOL_CONNECTIONS, SESSION_IDLE_TTL)
+
+def get_headers(auth_token): return {'accept-language': 'vi,fr-FR;q=0.9,fr;q=0.8,en-US;q=0.7,en;q=0.6','authorization': auth_token,'content-type': 'application/json;charset=utf-8','origin': 'https://app.golike.net','priority': 'u=1, i','sec-ch-ua': '"Google Chrome";v="135", "Not-A.Brand";v="8", "Chromium";v="135"','sec-ch-ua-mobile': '?1','sec-ch-ua-platform': '"Android"','sec-fetch-dest': 'empty','sec-fetch-mode': 'cors','sec-fetch-site': 'same-site','t': 'VFZSak1FNTZWVFJOUkdkNFRrRTlQUT09',}
+    
+def get_accounts_from_api(auth_token, platform="instagram"): 
+    headers = get_headers(auth_token); scraper = SESSION_POOL.get(auth_token)
+    url = f"{GOLIKE_API_BASE}/api/instagram-account" if platform == "instagram" else f"{GOLIKE_API_BASE}/api/threads-account"
+    try: response, data, outcome, elapsed = golike_request(scraper, 'GET', url, 'accounts', platform, headers=headers, timeout=10)
+    except GatewayUnavailable as e: return [], f"Lỗi khi lấy UID từ API {platform}: Golike đang tạm ngắt ({e.reason}), thử lại sau {int(e.wait) + 1}s."
+    if response is None: return [], f"Lỗi khi lấy UID từ API {platform}: (Network Error)"
+    if data is None: return [], f"Lỗi HTTP {response.status_code} khi lấy UID: phản hồi không hợp lệ ({outcome})."
+    if response.status_code == 200:
+        accounts = []
+        if data.get('success') and 'data' in data:
+            for acc in data['data']:
+                if acc.get('status') == 1 and acc.get('is_banned') == 0:
+                    name = acc.get(f'{platform}_username') or acc.get('username') or f"ID:{acc['id']}"
+                    accounts.append({'id': acc['id'], 'platform': platform, 'name': name})
+            record_golike_call('accounts', platform, elapsed, 'ok'); return accounts, ""
+        else: record_golike_call('accounts', platform, elapsed, 'api_error'); return [], f"Lỗi Golike API: {data.get('message', 'Không thể xác định danh sách tài khoản.')}"
+    else: record_golike_call('accounts', platform, elapsed, outcome); return [], f"Lỗi HTTP {response.status_code} khi lấy UID: {response.text}"
+
+
+class AccountListCache:
+    # Lấy song song danh sách UID Instagram + Threads của một token và cache theo token (TTL + stale-while-revalidate).
+    # Kết quả: {'instagram': (accounts, err), 'threads': (accounts, err)}. Chỉ cache khi cả hai nền tảng không lỗi.
+    PLATFORMS = ('instagram', 'threads')
+
+    def __init__(self, ttl, stale_ttl, max_entries=ACCOUNT_CACHE_MAX):
+        self.ttl = ttl; self.stale_ttl = stale_ttl; self.max_entries = max_entries; self.executor = None
+        self.lock = threading.Lock(); self.entries = OrderedDict(); self.refreshing = set(); self.generation = 0
+        self.hits = 0; self.stale_hits = 0; self.misses = 0; self.evicted = 0
+
+    def _fetch(self, auth_token):
+        with self.lock: self.executor = self.executor or ThreadPoolExecutor(8, thread_name_prefix="ACCOUNT_FETCH")
+        others = {p: self.executor.submit(get_accounts_from_api, auth_token, p) for p in self.PLATFORMS[1:]}
+        result = {self.PLATFORMS[0]: get_accounts_from_api(auth_token, self.PLATFORMS[0])}
+        result.update({p: f.result() for p, f in others.items()})
+        return result
+
+    def _store(self, auth_token, result, generation):
+        with self.lock:
+            if generation == self.generation and not any(err for _, err in result.values()): self._put(auth_token, time.time(), result)
+
+    def _put(self, auth_token, fetched_at, result):
+        # Gọi khi đang giữ lock. Bỏ bản quá stale_ttl (không bao giờ được trả nữa) rồi cắt LRU theo max_entries.
+        self.entries[auth_token] = (fetched_at, result); self.entries.move_to_end(auth_token)
+        expired = time.time() - self.stale_ttl
+        for token in [t for t, (at, _) in self.entries.items() if at < expired and t != auth_token]: del self.entries[token]; self.evicted += 1
+        while len(self.entries) > self.max_entries: self.entries.popitem(last=False); self.evicted += 1
+
+    def _revalidate(self, auth_token, generation):
+        try: self._store(auth_token, self._fetch(auth_token), generation)
+        except Exception as e: print(f"❌ Lỗi làm mới danh sách UID: {e}")
+        finally:
+            with self.lock: self.refreshing.discard(auth_token)
+
+    def get(self, auth_token, force=False):
+        with self.lock:
+            entry = None if force else self.entries.get(auth_token); generation = self.generation
+            if entry is not None:
+                self.entries.move_to_end(auth_token); age = time.time() - entry[0]
+                if age < self.ttl: self.hits += 1; return entry[1]
+                if age < self.stale_ttl:
+                    self.stale_hits += 1
+                    if auth_token not in self.refreshing:
+                        self.refreshing.add(auth_token)
+                        threading.Thread(target=self._revalidate, args=(auth_token, generation), daemon=True, name="ACCOUNT_REVALIDATE").start()
+                    return entry[1]
+            self.misses += 1
+        result = self._fetch(auth_token); self._store(auth_token, result, generation)
+        return result
+
+    def prime(self, auth_token, result, fetched_at):
+        # Nạp danh sách lấy từ snapshot (không gọi Golike); quá TTL thì lần get() sau sẽ tự làm mới nền.
+        with self.lock:
+            if auth_token not in self.entries: self._put(auth_token, fetched_at, result)
+
+    def invalidate(self, auth_token):
+        with self.lock: self.generation += 1; self.entries.pop(auth_token, None)
+
+    def stats(self):
+        with self.lock: return {'cached_tokens': len(self.entries), 'hits': self.hits, 'stale_hits': self.stale_hits, 'misses': self.misses, 'evicted': self.evicted}
+
+
+ACCOUNT_CACHE = AccountListCache(ACCOUNT_CACHE_TTL, ACCOUNT_CACHE_STALE_TTL)
+    
+URL_JOBS = {'instagram': f'{GOLIKE_API_BASE}/api/advertising/publishers/instagram/jobs',
+            'threads': f'{GOLIKE_API_BASE}/api/advertising/publishers/threads/jobs'}
+URL_COMPLETE_JOBS = {'instagram': f'{GOLIKE_API_BASE}/api/advertising/publishers/instagram/complete-jobs',
+                     'threads': f'{GOLIKE_API_BASE}/api/advertising/publishers/threads/complete-jobs'}
+
+# Tham số request + parse response dùng chung cho worker thread (cloudscraper) và worker asyncio.
+def job_params(platform, account_id):
+    if platform == 'instagram': return { 'instagram_account_id': f'{account_id}', 'data': 'null' }
+    return { 'account_id': f'{account_id}' }
+
+def complete_job_payload(platform, account_id, job_id):
+    if platform == 'instagram': return { 'instagram_users_advertising_id': job_id, 'instagram_account_id': account_id, 'async': True, 'data': None }
+    return { 'account_id': account_id, 'ads_id': job_id }
+
+def parse_job(platform, data):
+    if platform == 'instagram': found = data.get('success') and 'data' in data and data['data'].get('status') == 0
+    else: found = data.get('success') and 'data' in data and 'lock' in data and data['lock'] is not None
+    if found: 
+        job_data = data['data']; return { 'id': job_data.get('id'), 'price_per': job_data.get('price_after_cost', job_data.get('price_per', 0)) }
+    return None
+
+def parse_complete_job(platform, data, price_per=0):
+    if "thành công" not in data.get('message', '').lower(): return False, 0
+    if platform == 'instagram': return True, price_per
+    return True, data.get('data', {}).get('prices', 0)
+
+def _complete_job(scraper, headers, platform, account_id, job_id, price_per=0):
+    _, data, outcome, elapsed = golike_request(scraper, 'POST', URL_COMPLETE_JOBS[platform], 'complete-jobs', platform, headers=headers, json=complete_job_payload(platform, account_id, job_id), timeout=5)
+    if data is None: return False, 0
+    result = parse_complete_job(platform, data, price_per)
+    record_golike_call('complete-jobs', platform, elapsed, outcome if outcome != 'ok' else ('success' if result[0] else 'failed'))
+    return result
+
+def _fetch_job(scraper, headers, platform, account_id):
+    _, data, outcome, elapsed = golike_request(scraper, 'GET', URL_JOBS[platform], 'jobs', platform, params=job_params(platform, account_id), headers=headers, timeout=3)
+    if data is None: return None
+    job = parse_job(platform, data)
+    record_golike_call('jobs', platform, elapsed, outcome if outcome != 'ok' else ('found' if job else 'empty'))
+    return job
+
+def nhan_xu_instagram(scraper, headers, uid_cauhinh, uid_job, price_per): return _complete_job(scraper, headers, 'instagram', uid_cauhinh, uid_job, price_per)
+
+def nhan_xu_threads(scraper, headers, account_id, ads_id): return _complete_job(scraper, headers, 'threads', account_id, ads_id)
+    
+def nhan_job_instagram(scraper, headers, uid_cauhinh): return _fetch_job(scraper, headers, 'instagram', uid_cauhinh)
+
+def nhan_job_threads(scraper, headers, account_id): return _fetch_job(scraper, headers, 'threads', account_id)
+
+
+class RoundRobinScheduler:
+    name = "roundrobin"
+
+    def __init__(self, accounts, now=None):
+        self.accounts = accounts; self.index = 0; self.lock = threading.Lock()
+
+    def next_account(self, now=None):
+        with self.lock:
+            if not self.accounts: return None, 0
+            if self.index >= len(self.accounts): self.index = 0
+            account = self.accounts[self.index]; self.index = (self.index + 1) % len(self.accounts)
+            return account, 0
+
+    def record(self, account, hit, earned=0, now=None): pass
+
+    def requeue(self, account, now=None): pass
+
+    def export_state(self, now=None):
+        with self.lock: return {'strategy': self.name, 'index': self.index}
+
+    def restore_state(self, saved, now=None):
+        with self.lock: self.index = int(saved.get('index', 0)) % max(len(self.accounts), 1)
+
+    def stats(self): return {'strategy': self.name, 'accounts': len(self.accounts)}
+
+
+class YieldAwareScheduler:
+    # Hai hàng đợi ưu tiên: `ready` (điểm cao trước) và `cooling` (UID vừa hỏi trượt, chờ tới ready_at).
+    # Điểm = tỉ lệ có job (làm trơn Laplace) x xu trung bình mỗi job x thưởng theo thời gian chưa có job.
+    # Mỗi lần trượt liên tiếp nhân đôi thời gian cooldown (tối đa cooldown_max), có job thì reset.
+    name = "yield"
+
+    def __init__(self, accounts, cooldown_base=SCHED_COOLDOWN_BASE, cooldown_max=SCHED_COOLDOWN_MAX, now=None):
+        now = time.monotonic() if now is None else now
+        self.accounts = accounts; self.cooldown_base = cooldown_base; self.cooldown_max = cooldown_max
+        self.lock = threading.Lock(); self.started_at = now; self.seq = 0; self.total_hits = 0; self.total_earned = 0
+        self.by_id = {acc['id']: acc for acc in accounts}
+        # id -> [polls, hits, earned, misses liên tiếp, thời điểm có job gần nhất]
+        self.account_stats = {acc_id: [0, 0, 0, 0, None] for acc_id in self.by_id}
+        self.ready = []; self.cooling = []; self.checked_out = set()   # checked_out: UID đang được worker hỏi dở
+        for acc_id in self.by_id: self._push_ready(acc_id, now)
+
+    def _score(self, acc_id, now):
+        polls, hits, earned, _, last_job_at = self.account_stats[acc_id]
+        mean_price = self.total_earned / self.total_hits if self.total_hits else 1
+        avg_earned = earned / hits if hits else mean_price
+        idle = now - (last_job_at if last_job_at is not None else self.started_at)
+        return (hits + 1) / (polls + 2) * max(avg_earned, 1) * (1 + min(idle / 600.0, 1.0))
+
+    def _push_ready(self, acc_id, now):
+        self.seq += 1; heapq.heappush(self.ready, (-self._score(acc_id, now), self.seq, acc_id))
+
+    def next_account(self, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            while self.cooling and self.cooling[0][0] <= now: self._push_ready(heapq.heappop(self.cooling)[2], now)
+            if self.ready:
+                acc_id = heapq.heappop(self.ready)[2]; self.checked_out.add(acc_id); return self.by_id[acc_id], 0
+            if self.cooling: return None, self.cooling[0][0] - now
+            return None, (1 if self.by_id else 0)   # còn UID nhưng đều đang được hỏi dở
+
+    def record(self, account, hit, earned=0, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            st = self.account_stats.get(account['id'])
+            if st is None: return
+            self.checked_out.discard(account['id']); st[0] += 1
+            if hit: st[1] += 1; st[2] += earned; st[3] = 0; st[4] = now; ready_at = now; self.total_hits += 1; self.total_earned += earned
+            else: st[3] += 1; ready_at = now + min(self.cooldown_base * 2 ** (st[3] - 1), self.cooldown_max)
+            self.seq += 1; heapq.heappush(self.cooling, (ready_at, self.seq, account['id']))
+
+    def requeue(self, account, now=None):
+        # Trả UID về hàng chờ mà không tính là một lần hỏi (request bị breaker chặn / worker gặp lỗi giữa chừng).
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            if account['id'] in self.checked_out: self.checked_out.discard(account['id']); self._push_ready(account['id'], now)
+
+    def export_state(self, now=None):
+        # Thời điểm monotonic không còn nghĩa sau khi khởi động lại: lưu dạng "cách đây / còn lại bao nhiêu giây".
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            cooling = {acc_id: round(ready_at - now, 1) for ready_at, _, acc_id in self.cooling if ready_at > now}
+            return {'strategy': self.name, 'accounts': {str(acc_id): [st[0], st[1], st[2], st[3], None if st[4] is None else round(now - st[4], 1), cooling.get(acc_id)]
+                                                         for acc_id, st in self.account_stats.items()}}
+
+    def restore_state(self, saved, now=None):
+        now = time.monotonic() if now is None else now
+        with self.lock:
+            self.ready = []; self.cooling = []; self.checked_out = set(); self.total_hits = 0; self.total_earned = 0
+            for acc_id, st in self.account_stats.items():
+                polls, hits, earned, misses, idle, cooldown = saved['accounts'].get(str(acc_id), (0, 0, 0, 0, None, None))
+                st[:] = [polls, hits, earned, misses, None if idle is None else now - idle]; self.total_hits += hits; self.total_earned += earned
+            for acc_id in self.account_stats:
+                cooldown = saved['accounts'].get(str(acc_id), [None] * 6)[5]
+                if cooldown: self.seq += 1; heapq.heappush(self.cooling, (now + min(cooldown, self.cooldown_max), self.seq, acc_id))
+                else: self._push_ready(acc_id, now)
+
+    def stats(self):
+        with self.lock:
+            polls = sum(st[0] for st in self.account_stats.values())
+            return {'strategy': self.name, 'accounts': len(self.by_id), 'cooling': len(self.cooling), 'polls': polls, 'hits': self.total_hits}
+
+
+ACCOUNT_SCHEDULERS = {'roundrobin': RoundRobinScheduler, 'yield': YieldAwareScheduler}
+_trace_lock = threading.Lock()
+
+def trace_poll(platform, account_id, hit, price):
+    line = json.dumps({'t': round(time.time(), 3), 'platform': platform, 'account': account_id, 'hit': bool(hit), 'price': price})
+    try:
+        with _trace_lock, open(SCHED_TRACE_FILE, 'a', encoding='utf-8') as f: f.write(line + "\n")
+    except OSError as e: print(f"❌ Không ghi được trace {SCHED_TRACE_FILE}: {e}")
+
+
+class DashboardRefresher:
+    # MỘT thread cho mọi chat: heap (hạn cập nhật, state). Chat đang chạy được xếp lại sau mỗi `interval` giây,
+    # signal_status_update chỉ đánh dấu "bẩn" để cập nhật ngay. Chỉ gửi edit khi nội dung status thực sự đổi.
+    def __init__(self, interval):
+        self.interval = interval; self.cond = threading.Condition(); self.thread = None
+        self.heap = []; self.scheduled = {}; self.seq = 0   # scheduled: state -> hạn hiện hành (entry khác trong heap là cũ)
+        self.refreshes = 0; self.skipped_unchanged = 0
+
+    def _ensure_started(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._run, daemon=True, name="STATUS_REFRESHER"); self.thread.start()
+
+    def _schedule(self, state, due):
+        current = self.scheduled.get(state)
+        if current is not None and current <= due: return
+        self.scheduled[state] = due; self.seq += 1
+        heapq.heappush(self.heap, (due, self.seq, state)); self.cond.notify()
+
+    def mark_dirty(self, state):
+        with self.cond: self._ensure_started(); self._schedule(state, time.monotonic())
+
+    def watch(self, state): self.mark_dirty(state)
+
+    def _pop_due(self):
+        with self.cond:
+            while True:
+                if not self.heap: self.cond.wait(); continue
+                due, _, state = self.heap[0]
+                if self.scheduled.get(state) != due: heapq.heappop(self.heap); continue   # entry cũ đã bị thay
+                wait = due - time.monotonic()
+                if wait > 0: self.cond.wait(wait); continue
+                heapq.heappop(self.heap); del self.scheduled[state]
+                return state
+
+    def _refresh(self, state):
+        if not state.last_status_message_id: return
+        text = state.generate_status_text()
+        if state.last_rendered_status == (state.last_status_message_id, text): self.skipped_unchanged += 1; return
+        self.refreshes += 1; state.update_status_message(text)
+
+    def _run(self):
+        while True:
+            state = self._pop_due()
+            try: self._refresh(state)
+            except Exception as e: print(f"❌ Lỗi cập nhật Status cho chat_id {state.chat_id}: {e}")
+            if state.is_running:
+                with self.cond: self._schedule(state, time.monotonic() + self.interval)
+
+    def stats(self):
+        with self.cond: return {'watched': len(self.scheduled), 'refreshes': self.refreshes, 'skipped_unchanged': self.skipped_unchanged}
+
+
+DASHBOARD_REFRESHER = DashboardRefresher(GLOBAL_LOG_UPDATE_INTERVAL)
+
+def worker_instagram_telebot(job_state: UserJobState, worker: WorkerHandle):
+    headers = get_headers(job_state.auth_token); platform = 'instagram'; accounts = worker.accounts; worker_id = worker.worker_id
+    while not worker.stopping:
+        account = None
+        try:
+            blocked = GOLIKE_GUARD.wait_time(f"{platform}/jobs", job_state.auth_token)
+            if blocked: worker.pause(min(blocked, 10)); continue   # Golike/token đang bị ngắt: không hỏi job
+            scraper = SESSION_POOL.get(job_state.auth_token)
+            account, wait = job_state.get_next_account(accounts, platform, worker_id)
+            if not account:
+                if wait: worker.pause(min(wait, 10)); continue   # mọi UID đang cooldown
+                if time.time() - job_state.last_no_job_log[platform] > 60: job_state.add_activity_log("⚠️ Instagram: Hết UID/cấu hình bị lỗi, tạm chờ 10s...", 'warning', platform); job_state.last_no_job_log[platform] = time.time()
+                worker.pause(10); continue
+            account_id = account['id']; account_name = account['name']; started = time.monotonic(); job = nhan_job_instagram(scraper, headers, account_id)
+            if worker.stopping: break   # bị dừng trong lúc hỏi job: không làm job mới
+            if job:
+                worker.busy = True
+                try:
+                    try: success, money_earned = nhan_xu_instagram(scraper, headers, account_id, job['id'], job['price_per'])
+                    except GatewayUnavailable: success, money_earned = False, 0
+                    job_state.record_poll(platform, account, True, money_earned, worker_id); account = None
+                    job_state.record_job_result('instagram', account_name, success, money_earned, account_id, job['id'], time.monotonic() - started)
+                finally: worker.busy = False
+                job_state.signal_status_update()
+                worker.pause(random.uniform(JOB_DELAY_MIN, JOB_DELAY_MAX))
+            else: job_state.record_poll(platform, account, False, worker_id=worker_id); account = None; worker.pause(NO_JOB_DELAY)
+        except GatewayUnavailable as e:
+            if account: job_state.requeue_account(platform, account, worker_id)
+            worker.pause(min(e.wait, 10))
+        except Exception as e:
+            # Không để một lỗi bất ngờ giết worker trong im lặng.
+            if account: job_state.requeue_account(platform, account, worker_id)
+            job_state.add_activity_log(f"❌ Instagram Worker gặp lỗi: {type(e).__name__}", 'error', platform); print(f"❌ Lỗi worker Instagram chat_id {job_state.chat_id}: {e}"); worker.pause(5)
+
+
+def worker_threads_telebot(job_state: UserJobState, worker: WorkerHandle):
+    headers = get_headers(job_state.auth_token); platform = 'threads'; accounts = worker.accounts; worker_id = worker.worker_id
+    while not worker.stopping:
+        account = None
+        try:
+            blocked = GOLIKE_GUARD.wait_time(f"{platform}/jobs", job_state.auth_token)
+            if blocked: worker.pause(min(blocked, 10)); continue   # Golike/token đang bị ngắt: không hỏi job
+            scraper = SESSION_POOL.get(job_state.auth_token)
+            account, wait = job_state.get_next_account(accounts, platform, worker_id)
+            if not account:
+                if wait: worker.pause(min(wait, 10)); continue   # mọi UID đang cooldown
+                if time.time() - job_state.last_no_job_log[platform] > 60: job_state.add_activity_log("⚠️ Threads: Hết UID/cấu hình bị lỗi, tạm chờ 10s...", 'warning', platform); job_state.last_no_job_log[platform] = time.time()
+                worker.pause(10); continue
+            account_id = account['id']; account_name = account['name']; started = time.monotonic(); job = nhan_job_threads(scraper, headers, account_id)
+            if worker.stopping: break   # bị dừng trong lúc hỏi job: không làm job mới
+            if job:
+                worker.busy = True
+                try:
+                    try: success, money_earned = nhan_xu_threads(scraper, headers, account_id, job['id'])
+                    except GatewayUnavailable: success, money_earned = False, 0
+                    job_state.record_poll(platform, account, True, money_earned, worker_id); account = None
+                    job_state.record_job_result('threads', account_name, success, money_earned, account_id, job['id'], time.monotonic() - started)
+                finally: worker.busy = False
+                job_state.signal_status_update()
+                worker.pause(random.uniform(JOB_DELAY_MIN, JOB_DELAY_MAX))
+            else: job_state.record_poll(platform, account, False, worker_id=worker_id); account = None; worker.pause(NO_JOB_DELAY)
+        except GatewayUnavailable as e:
+            if account: job_state.requeue_account(platform, account, worker_id)
+            worker.pause(min(e.wait, 10))
+        except Exception as e:
+            # Không để một lỗi bất ngờ giết worker trong im lặng.
+            if account: job_state.requeue_account(platform, account, worker_id)
+            job_state.add_activity_log(f"❌ Threads Worker gặp lỗi: {type(e).__name__}", 'error', platform); print(f"❌ Lỗi worker Threads chat_id {job_state.chat_id}: {e}"); worker.pause(5)
+
+WORKER_TARGETS = {'instagram': ('INSTA_WORKER', worker_instagram_telebot), 'threads': ('THREAD_WORKER', worker_threads_telebot)}
+
+
+class WorkerWatchdog:
+    # Một thread quét mỗi `interval` giây:
+    # - worker đã bị dừng (stop_workers) mà quá `stop_timeout` vẫn sống là worker rò: báo một lần, theo dõi tới khi thoát hẳn thì dọn.
+    # - worker của chat đang chạy mà đã chết (không phải do bị dừng): dọn khỏi state và khởi động lại cho đúng nhóm UID.
+    def __init__(self, interval, stop_timeout):
+        self.interval = interval; self.stop_timeout = stop_timeout; self.lock = threading.Lock(); self.thread = None
+        self.retiring = []   # [chat_id, worker, hạn thoát (monotonic), đã báo rò]
+        self.stopped = 0; self.leaked_total = 0; self.reaped = 0; self.restarted = 0
+
+    def ensure_started(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, daemon=True, name="WORKER_WATCHDOG"); self.thread.start()
+
+    def retire(self, chat_id, workers):
+        if not workers: return
+        deadline = time.monotonic() + self.stop_timeout
+        with self.lock: self.retiring.extend([chat_id, worker, deadline, False] for worker in workers); self.stopped += len(workers)
+        self.ensure_started()
+
+    @staticmethod
+    def join(workers, timeout):
+        # Chờ chung một hạn cho cả nhóm. -> số worker vẫn còn sống.
+        deadline = time.monotonic() + timeout
+        for worker in workers: worker.join(max(0.0, deadline - time.monotonic()))
+        return sum(1 for worker in workers if worker.is_alive())
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try: self.check()
+            except Exception as e: print(f"❌ Lỗi watchdog worker: {e}")
+
+    def check(self):
+        now = time.monotonic(); leaked = []
+        with self.lock:
+            retiring = []
+            for entry in self.retiring:
+                if not entry[1].is_alive(): self.reaped += 1; continue
+                if now >= entry[2] and not entry[3]: entry[3] = True; self.leaked_total += 1; leaked.append(entry)
+                retiring.append(entry)
+            self.retiring = retiring
+        for chat_id, worker, _, _ in leaked: print(f"⚠️ Worker {worker.name} của chat_id {chat_id} vẫn chạy {self.stop_timeout:g}s sau khi bị dừng.")
+        with user_states_lock: states = [state for state in USER_JOB_STATES.values() if state.is_running and state.engine is None]
+        for state in states:
+            restarted = state.restart_dead_workers()
+            if restarted:
+                with self.lock: self.restarted += len(restarted)
+                print(f"♻️ Đã khởi động lại worker chết {', '.join(restarted)} của chat_id {state.chat_id}.")
+
+    def live_by_chat(self):
+        # -> {chat_id: số worker còn sống} của các chat đang chạy worker trên node này.
+        with user_states_lock: states = [state for state in USER_JOB_STATES.values() if state.is_running and state.engine is None]
+        return {state.chat_id: state.live_workers()[0] for state in states}
+
+    def stats(self):
+        # Chỉ số tổng (công khai qua /stats); số worker theo từng chat_id chỉ xem qua /workers có khoá quản trị.
+        live = self.live_by_chat()
+        with self.lock:
+            lingering = [entry for entry in self.retiring if entry[1].is_alive()]
+            return {'live': sum(live.values()), 'live_chats': len(live), 'stopping': sum(1 for entry in lingering if not entry[3]), 'leaked': sum(1 for entry in lingering if entry[3]),
+                    'stopped': self.stopped, 'leaked_total': self.leaked_total, 'reaped': self.reaped, 'restarted': self.restarted}
+
+
+WORKER_WATCHDOG = WorkerWatchdog(WORKER_WATCHDOG_INTERVAL, WORKER_STOP_TIMEOUT)
+
+# ==============================================================================
+# 3.1 ASYNCIO JOB ENGINE (JOB_ENGINE=asyncio): MỘT EVENT LOOP CHO MỌI CHAT
+# ==============================================================================
+
+# Bọc một asyncio.Task với cùng giao diện WorkerHandle, dừng/chờ được từ thread khác. stop() huỷ task ngay (kể cả khi đang
+# sleep/chờ HTTP), trừ khi worker đang complete-jobs và drain=True: khi đó worker ghi nhận xong job rồi tự thoát ở pause() kế tiếp.
+class AsyncWorkerHandle:
+    def __init__(self, platform, worker_id, accounts, name):
+        self.platform = platform; self.worker_id = worker_id; self.accounts = accounts; self.name = name
+        self.stop_event = threading.Event(); self.busy = False; self.loop = None; self.task = None; self.done = threading.Event()
+
+    @property
+    def stopping(self): return self.stop_event.is_set()
+
+    async def pause(self, seconds):
+        if not self.stop_event.is_set(): await asyncio.sleep(seconds)
+        return self.stop_event.is_set()
+
+    def is_alive(self): return self.task is not None and not self.task.done()
+
+    def stop(self, drain=True):
+        self.stop_event.set()
+        if self.loop is not None: self.loop.call_soon_threadsafe(self._interrupt, drain)
+
+    def _interrupt(self, drain):
+        # Chạy trên event loop nên `busy` không đổi giữa lúc kiểm tra và lúc huỷ.
+        if self.task is not None and not (drain and self.busy): self.task.cancel()
+
+    def join(self, timeout): return self.done.wait(timeout)
+
+
+class AsyncJobEngine:
+    def __init__(self):
+        self.loop = None; self.thread = None; self.lock = threading.Lock()
+        self.session = None
+
+    def ensure_loop(self):
+        with self.lock:
+            if self.loop is not None and self.thread.is_alive(): return self.loop
+            loop = asyncio.new_event_loop(); ready = threading.Event()
+            def run(): asyncio.set_event_loop(loop); loop.call_soon(ready.set); loop.run_forever()
+            self.thread = threading.Thread(target=run, daemon=True, name="ASYNC_JOB_ENGINE"); self.thread.start(); ready.wait()
+            self.loop = loop; self.session = None
+            return loop
+
+    def spawn(self, handle, coro):
+        # Event loop kẹt quá ASYNC_SPAWN_TIMEOUT: bỏ worker (đánh dấu dừng để task có tạo muộn cũng thoát ngay) và báo lỗi cho caller.
+        loop = handle.loop = self.ensure_loop(); created = threading.Event()
+        def create():
+            if handle.stopping: coro.close(); handle.done.set(); return
+            handle.task = loop.create_task(coro, name=handle.name); handle.task.add_done_callback(lambda _: handle.done.set()); created.set()
+        loop.call_soon_threadsafe(create)
+        if not created.wait(ASYNC_SPAWN_TIMEOUT): handle.stop_event.set(); raise RuntimeError(f"event loop không nhận task {handle.name} sau {ASYNC_SPAWN_TIMEOUT:g}s")
+        return handle
+
+    async def _request(self, method, url, headers, timeout, params=None, json_data=None):
+        # -> (status, body text)
+        try: import aiohttp
+        except ImportError: aiohttp = None
+        if aiohttp is None:
+            # Không có aiohttp: chạy cloudscraper trong executor mặc định của loop, worker vẫn là task.
+            # Lấy session cũng trong executor: lần đầu có thể phải import + dựng cloudscraper.
+            def call():
+                scraper = SESSION_POOL.get(headers['authorization']); response = scraper.request(method, url, headers=headers, params=params, json=json_data, timeout=timeout); return response.status_code, response.text
+            return await asyncio.get_running_loop().run_in_executor(None, call)
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=ASYNC_HTTP_LIMIT, ttl_dns_cache=300))
+        async with self.session.request(method, url, headers=headers, params=params, json=json_data, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            return response.status, await response.text(errors='replace')
+
+    async def _guarded(self, method, url, endpoint, platform, headers, timeout, **kwargs):
+        # Giống golike_request: -> (data, outcome, giây), data None thì metric đã được ghi; có thể ném GatewayUnavailable.
+        key = f"{platform}/{endpoint}"; token = headers.get('authorization', '')
+        async with GOLIKE_INFLIGHT.hold_async(token):   # cùng giới hạn với worker thread của token
+            GOLIKE_GUARD.acquire(key, token); started = time.perf_counter()
+            try: status, text = await self._request(method, url, headers, timeout, **kwargs); error = None
+            except asyncio.CancelledError: GOLIKE_GUARD.release(key, token, 'cancelled'); raise
+            except Exception as e: error = e
+            elapsed = time.perf_counter() - started
+        if error is not None:
+            outcome = 'timeout' if is_timeout_error(error) else 'network_error'
+            GOLIKE_GUARD.release(key, token, outcome); record_golike_call(endpoint, platform, elapsed, outcome); return None, outcome, elapsed
+        outcome, data = classify_golike_response(status, text)
+        GOLIKE_GUARD.release(key, token, outcome)
+        if data is None: record_golike_call(endpoint, platform, elapsed, outcome)
+        return data, outcome, elapsed
+
+    async def nhan_job(self, platform, headers, account_id):
+        data, outcome, elapsed = await self._guarded('GET', URL_JOBS[platform], 'jobs', platform, headers, 3, params=job_params(platform, account_id))
+        if data is None: return None
+        job = parse_job(platform, data)
+        record_golike_call('jobs', platform, elapsed, outcome if outcome != 'ok' else ('found' if job else 'empty'))
+        return job
+
+    async def nhan_xu(self, platform, headers, account_id, job):
+        data, outcome, elapsed = await self._guarded('POST', URL_COMPLETE_JOBS[platform], 'complete-jobs', platform, headers, 5, json_data=complete_job_payload(platform, account_id, job['id']))
+        if data is None: return False, 0
+        result = parse_complete_job(platform, data, job['price_per'])
+        record_golike_call('complete-jobs', platform, elapsed, outcome if outcome != 'ok' else ('success' if result[0] else 'failed'))
+        return result
+
+
+ASYNC_ENGINE = AsyncJobEngine()
+
+async def async_worker_loop(job_state: UserJobState, worker: AsyncWorkerHandle):
+    headers = get_headers(job_state.auth_token); platform = worker.platform; accounts = worker.accounts; worker_id = worker.worker_id
+    label = 'Instagram' if platform == 'instagram' else 'Threads'
+    while not worker.stopping:
+        account = None
+        try:
+            blocked = GOLIKE_GUARD.wait_time(f"{platform}/jobs", job_state.auth_token)
+            if blocked: await worker.pause(min(blocked, 10)); continue   # Golike/token đang bị ngắt: không hỏi job
+            account, wait = job_state.get_next_account(accounts, platform, worker_id)
+            if not account:
+                if wait: await worker.pause(min(wait, 10)); continue   # mọi UID đang cooldown
+                if time.time() - job_state.last_no_job_log[platform] > 60: job_state.add_activity_log(f"⚠️ {label}: Hết UID/cấu hình bị lỗi, tạm chờ 10s...", 'warning', platform); job_state.last_no_job_log[platform] = time.time()
+                await worker.pause(10); continue
+            started = time.monotonic(); job = await ASYNC_ENGINE.nhan_job(platform, headers, account['id'])
+            if worker.stopping: break   # bị dừng trong lúc hỏi job: không làm job mới
+            if job:
+                # busy: stop(drain=True) không huỷ task giữa chừng, job đã gửi complete-jobs luôn được ghi nhận.
+                worker.busy = True
+                try:
+                    try: success, money_earned = await ASYNC_ENGINE.nhan_xu(platform, headers, account['id'], job)
+                    except GatewayUnavailable: success, money_earned = False, 0
+                    job_state.record_poll(platform, account, True, money_earned, worker_id)
+                    job_state.record_job_result(platform, account['name'], success, money_earned, account['id'], job['id'], time.monotonic() - started); account = None
+                finally: worker.busy = False
+                job_state.signal_status_update()
+                await worker.pause(random.uniform(JOB_DELAY_MIN, JOB_DELAY_MAX))
+            else: job_state.record_poll(platform, account, False, worker_id=worker_id); account = None; await worker.pause(NO_JOB_DELAY)
+        except asyncio.CancelledError:
+            if account: job_state.requeue_account(platform, account, worker_id)
+            raise
+        except GatewayUnavailable as e:
+            if account: job_state.requeue_account(platform, account, worker_id)
+            await worker.pause(min(e.wait, 10))
+        except Exception as e:
+            if account: job_state.requeue_account(platform, account, worker_id)
+            job_state.add_activity_log(f"❌ {label} Worker gặp lỗi: {type(e).__name__}", 'error', platform); print(f"❌ Lỗi worker {label} chat_id {job_state.chat_id}: {e}"); await worker.pause(5)
+
+# ==============================================================================
+# 3.2 WARM RESTART: CHỤP TRẠNG THÁI JOB ĐANG CHẠY VÀ TỰ CHẠY TIẾP KHI KHỞI ĐỘNG LẠI
+# ==============================================================================
+
+def token_fingerprint(auth_token): return hashlib.sha256(auth_token.encode('utf-8')).hexdigest()[:16]
+
+
+class JobSnapshotter:
+    # Một thread ghi snapshot của mọi chat đang chạy mỗi `interval` giây, chỉ ghi chat mà phần cần để chạy tiếp đã đổi
+    # (resume_key) hoặc bản đã ghi cũ hơn `max_age`; bộ đếm/giờ trong scheduler đổi mỗi lượt hỏi nên không tính là thay đổi.
+    # Dừng job thì xoá snapshot ngay, để lần khởi động sau không tự chạy lại chat đã dừng.
+    def __init__(self, interval, max_age):
+        self.interval = interval; self.max_age = max_age; self.lock = threading.Lock(); self.thread = None
+        self.written = {}; self.saves = 0; self.resumed = 0; self.resume_failed = 0
+
+    def ensure_started(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, daemon=True, name="JOB_SNAPSHOT"); self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try: self.save()
+            except Exception as e: print(f"❌ Lỗi ghi snapshot job: {e}")
+
+    def save(self, states=None):
+        if states is None:
+            with user_states_lock: states = [state for state in USER_JOB_STATES.values() if state.is_running]
+        now = time.time(); rows = []; keys = {}
+        for state in states:
+            snapshot = state.snapshot(); key = self.resume_key(snapshot)
+            with self.lock: written = self.written.get(state.chat_id)   # (resume_key, lúc ghi)
+            if written is not None and written[0] == key and now - written[1] < self.max_age: continue
+            rows.append((state.chat_id, json.dumps(snapshot, ensure_ascii=False, separators=(',', ':')), now)); keys[state.chat_id] = key
+        if not rows: return
+        STORE.save_snapshots(rows); self.saves += len(rows)
+        with self.lock: self.written.update({chat_id: (keys[chat_id], now) for chat_id, _, _ in rows})
+
+    @staticmethod
+    def resume_key(snapshot):
+        # Token, cấu hình, tập UID, tin Status và tổng tiền/job: những gì quyết định việc chạy tiếp.
+        accounts = {platform: sorted(str(account['id']) for account in items) for platform, items in (snapshot.get('accounts') or {}).items()}
+        return json.dumps([snapshot['token'], snapshot.get('shared', False), snapshot['platform_config'], snapshot['concurrency'], accounts,
+                           snapshot.get('status_message_id'), snapshot.get('totals')], sort_keys=True)
+
+    def forget(self, chat_id):
+        with self.lock: self.written.pop(chat_id, None)
+        try: STORE.delete_snapshot(chat_id)
+        except Exception as e: print(f"❌ Lỗi xoá snapshot chat_id {chat_id}: {e}")
+
+    def stats(self):
+        with self.lock: return {'tracked': len(self.written), 'saves': self.saves, 'resumed': self.resumed, 'resume_failed': self.resume_failed}
+
+
+SNAPSHOTTER = JobSnapshotter(SNAPSHOT_INTERVAL, SNAPSHOT_MAX_AGE)
+atexit.register(lambda: SNAPSHOTTER.save())
+
+def resume_job(chat_id, snapshot, saved_at):
+    # -> True: đã chạy tiếp, False: snapshot hỏng/hết hiệu lực (xoá), None: chat đang thuộc node khác (giữ snapshot).
+    auth = get_auth_data(chat_id)
+    if not auth or token_fingerprint(auth['auth_token']) != snapshot.get('token'): return False   # token đã đổi/xoá: không chạy lại
+    if is_running_here(chat_id): return True   # người dùng đã tự /startjob trong lúc chờ
+    if not SHARDS.acquire(chat_id): return None   # round-trip DB: làm ngoài user_states_lock
+    with user_states_lock:
+        job_state = USER_JOB_STATES.get(chat_id)
+        if job_state is not None and job_state.is_running: return True   # /startjob chen vào trong lúc lấy lease: lease vẫn của node này
+        job_state = USER_JOB_STATES[chat_id] = UserJobState(auth['auth_token'], chat_id, snapshot['platform_config'], snapshot.get('concurrency') or auth['concurrency'])
+    if snapshot.get('shared'):
+        # Chat từng gắn vào engine dùng chung: gắn lại nếu engine của token đã chạy tiếp (snapshot chủ được chạy trước).
+        job_state.last_status_message_id = snapshot.get('status_message_id')
+        if JOB_ENGINES.claim(job_state) is None: job_state.stop_workers(); return False   # engine không chạy lại: bỏ
+    else:
+        job_state.restore(snapshot)
+        accounts = snapshot['accounts']; instagram_accounts = accounts.get('instagram') or []; threads_accounts = accounts.get('threads') or []
+        ACCOUNT_CACHE.prime(job_state.auth_token, {'instagram': (instagram_accounts, ""), 'threads': (threads_accounts, "")}, saved_at)
+        if JOB_ENGINES.claim(job_state) is None and not job_state.start_workers(instagram_accounts, threads_accounts): job_state.stop_workers(); return False
+    job_state.add_activity_log("♻️ Bot vừa khởi động lại: Job được tự động chạy tiếp.")
+
+    # Dùng lại tin nhắn Status cũ; nếu đã bị xoá thì gửi tin mới.
+    try:
+        pending = job_state.update_status_message()
+        if pending is not None: pending.result(TG_WAIT_TIMEOUT)
+    except Exception as e:
+        if "message is not modified" not in str(e): job_state.last_status_message_id = None
+    if not job_state.last_status_message_id:
+        try: job_state.last_status_message_id = tg_send(chat_id, job_state.generate_status_text(), parse_mode='Markdown').result(TG_WAIT_TIMEOUT).message_id
+        except Exception as e: print(f"❌ Lỗi gửi Status khi chạy lại chat_id {chat_id}: {e}")
+    return True
+
+_resume_lock = threading.Lock()
+
+def is_running_here(chat_id):
+    with user_states_lock: job_state = USER_JOB_STATES.get(chat_id)
+    return job_state is not None and job_state.is_running
+
+def resume_jobs(stagger=RESUME_STAGGER):
+    # Chạy tiếp lần lượt từng chat, cách nhau `stagger` giây, để không dồn request vào Golike/Telegram lúc khởi động.
+    # Khi bật sharding, chỉ nhận các chat mà vòng hash giao cho node này và chưa có node sống nào khác giữ lease.
+    with _resume_lock:
+        try: snapshots = [row for row in STORE.fetch_snapshots() if not is_running_here(row[0]) and SHARDS.should_adopt(row[0])]
+        except Exception as e: print(f"❌ Lỗi đọc snapshot job: {e}"); return 0
+        snapshots.sort(key=lambda row: '"shared":true' in row[1])   # chat chủ engine chạy trước, chat gắn vào sau
+        resumed_count = 0
+        for index, (chat_id, payload, saved_at) in enumerate(snapshots):
+            if index and stagger: time.sleep(stagger)
+            try: resumed = resume_job(chat_id, json.loads(payload), saved_at)
+            except Exception as e: print(f"❌ Lỗi chạy lại job chat_id {chat_id}: {e}"); resumed = False
+            if resumed: SNAPSHOTTER.resumed += 1; resumed_count += 1
+            elif resumed is False: SNAPSHOTTER.resume_failed += 1; SNAPSHOTTER.forget(chat_id)
+        if snapshots: print(f"♻️ Đã chạy lại {resumed_count}/{len(snapshots)} job từ snapshot.")
+        return resumed_count
+
+
+# ==============================================================================
+# 3.3 SHARDING NHIỀU NODE: CONSISTENT HASHING + LEASE TRONG DATABASE
+# ==============================================================================
+
+class HashRing:
+    # Mỗi node có `vnodes` điểm trên vòng băm; chat thuộc node có điểm đầu tiên >= hash(chat_id).
+    # Thêm/bớt một node chỉ làm ~1/N số chat đổi chủ.
+    def __init__(self, nodes, vnodes):
+        points = sorted((self._hash(f"{node}#{i}"), node) for node in nodes for i in range(vnodes))
+        self.keys = [point for point, _ in points]; self.nodes = [node for _, node in points]
+
+    @staticmethod
+    def _hash(value): return int.from_bytes(hashlib.md5(str(value).encode('utf-8')).digest()[:8], 'big')
+
+    def node_for(self, key):
+        if not self.keys: return None
+        return self.nodes[bisect.bisect(self.keys, self._hash(key)) % len(self.keys)]
+
+
+class ShardCoordinator:
+    # Tắt (không có NODE_URL): mọi chat thuộc node này, không đụng tới DB.
+    # Bật: mỗi `heartbeat` giây ghi heartbeat, đọc node sống + lease, gia hạn lease của mình,
+    # trả chat không còn thuộc mình (node mới vào) và nhận chat mồ côi (node chết, lease hết hạn) từ snapshot.
+    def __init__(self, node_id, node_url, heartbeat, lease_ttl, vnodes):
+        self.node_id = node_id; self.node_url = node_url; self.enabled = bool(node_url)
+        self.heartbeat = heartbeat; self.lease_ttl = lease_ttl; self.vnodes = vnodes
+        self.lock = threading.Lock(); self.thread = None; self.executor = None
+        self.node_urls = {node_id: node_url}; self.ring = HashRing([node_id], vnodes); self.leases = {}
+        self.forwarded = 0; self.forward_failed = 0; self.handed_off = 0; self.adopted = 0; self.lease_conflicts = 0
+
+    def start(self):
+        if not self.enabled or (self.thread is not None and self.thread.is_alive()): return
+        self._tick(adopt=False)
+        self.thread = threading.Thread(target=self._run, daemon=True, name="SHARD_COORDINATOR"); self.thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.heartbeat)
+            try: self._tick()
+            except Exception as e: print(f"❌ Lỗi đồng bộ shard: {e}")
+
+    def _tick(self, adopt=True):
+        now = time.time()
+        STORE.heartbeat_node(self.node_id, self.node_url, now); STORE.renew_leases(self.node_id, now + self.lease_ttl)
+        nodes = dict(STORE.live_nodes(now - self.lease_ttl)); nodes[self.node_id] = self.node_url
+        leases = dict(STORE.live_leases(now))
+        with self.lock:
+            if set(nodes) != set(self.node_urls): self.ring = HashRing(sorted(nodes), self.vnodes); print(f"🔀 Shard: {len(nodes)} node đang sống.")
+            self.node_urls = nodes; self.leases = leases
+        self._hand_off_foreign()
+        if adopt: self.adopted += resume_jobs()
+
+    def _hand_off_foreign(self):
+        # Chat đang chạy ở đây nhưng vòng hash đã giao cho node khác: ghi snapshot rồi dừng, node kia sẽ nhận ở lượt kế.
+        # Chat chỉ gắn vào engine dùng chung không có worker riêng: đi theo host, không chuyển.
+        with user_states_lock: states = [state for state in USER_JOB_STATES.values() if state.is_running and state.engine is None and not self.owns(state.chat_id)]
+        if not states: return
+        SNAPSHOTTER.save(states)
+        for state in states:
+            state.stop_workers(keep_snapshot=True, wait=False); state.add_activity_log("🔀 Job được chuyển sang node khác.")
+            with user_states_lock:
+                if USER_JOB_STATES.get(state.chat_id) is state: USER_JOB_STATES.pop(state.chat_id)
+        self.handed_off += len(states)
+
+    def owns(self, chat_id):
+        if not self.enabled: return True
+        with self.lock: return self.ring.node_for(chat_id) == self.node_id
+
+    def should_adopt(self, chat_id):
+        if not self.enabled: return True
+        with self.lock: holder = self.leases.get(chat_id)
+        return self.owns(chat_id) and holder in (None, self.node_id)
+
+    def owner_url(self, chat_id):
+        # URL node phải xử lý update của chat; None nghĩa là xử lý tại chỗ. Lease còn hạn được ưu tiên hơn vòng hash.
+        if not self.enabled or chat_id is None: return None
+        with self.lock:
+            node = self.leases.get(chat_id)
+            if node not in self.node_urls: node = self.ring.node_for(chat_id)
+            return None if node == self.node_id else self.node_urls.get(node)
+
+    def acquire(self, chat_id):
+        if not self.enabled: return True
+        now = time.time()
+        if STORE.acquire_lease(chat_id, self.node_id, now + self.lease_ttl, now):
+            with self.lock: self.leases[chat_id] = self.node_id
+            return True
+        self.lease_conflicts += 1; return False
+
+    def release(self, chat_id):
+        if not self.enabled: return
+        with self.lock:
+            if self.leases.get(chat_id) == self.node_id: del self.leases[chat_id]
+        try: STORE.release_lease(chat_id, self.node_id)
+        except Exception as e: print(f"❌ Lỗi trả lease chat_id {chat_id}: {e}")
+
+    def forward(self, url, body, on_failure):
+        # Chuyển nguyên update sang node chủ (nền, không giữ webhook); node đó không thì xử lý tại chỗ.
+        with self.lock: self.executor = self.executor or ThreadPoolExecutor(4, thread_name_prefix="SHARD_FORWARD")
+        def send():
+            import requests
+            try:
+                response = requests.post(url + WEBHOOK_URL_PATH, data=body, timeout=5,
+                                         headers={'content-type': 'application/json', 'X-Shard-Forwarded': SHARD_SECRET})
+                if response.status_code != 200: raise RuntimeError(f"HTTP {response.status_code}")
+                self.forwarded += 1
+            except Exception as e: self.forward_failed += 1; print(f"❌ Lỗi chuyển update sang {url}: {e}"); on_failure()
+        self.executor.submit(send)
+
+    def shutdown(self):
+        # Thoát có chủ đích: ghi snapshot rồi trả mọi lease để node khác nhận ngay, không phải chờ hết hạn.
+        if not self.enabled: return
+        try: SNAPSHOTTER.save(); STORE.remove_node(self.node_id)
+        except Exception as e: print(f"❌ Lỗi rời shard: {e}")
+
+    def stats(self):
+        with self.lock: nodes = len(self.node_urls); leases = sum(1 for node in self.leases.values() if node == self.node_id)
+        return {'enabled': self.enabled, 'nodes': nodes, 'leases_held': leases, 'forwarded': self.forwarded, 'forward_failed': self.forward_failed,
+                'handed_off': self.handed_off, 'adopted': self.adopted, 'lease_conflicts': self.lease_conflicts}
+
+
+# Update chuyển tiếp giữa các node được xác thực bằng SHARD_SECRET: bật sharding mà thiếu khoá thì không khởi động.
+if NODE_URL and not SHARD_SECRET: raise RuntimeError("NODE_URL đã bật sharding nhưng SHARD_SECRET chưa được thiết lập.")
+
+def is_shard_forward(forwarded): return bool(SHARD_SECRET) and hmac.compare_digest(forwarded.encode('utf-8'), SHARD_SECRET.encode('utf-8'))
+
+SHARDS = ShardCoordinator(NODE_ID, NODE_URL, SHARD_HEARTBEAT, SHARD_LEASE_TTL, SHARD_VNODES)
+atexit.register(SHARDS.shutdown)
+
+# ==============================================================================
+# 4. CHỨC NĂNG LỆNH CỦA TELEBOT (Menu đã chỉnh sửa)
+# ==============================================================================
+
+def get_menu_keyboard():
+    keyboard = types.InlineKeyboardMarkup()
+    keyboard.row(types.InlineKeyboardButton("▶️ START JOB", callback_data="/startjob"), types.InlineKeyboardButton("⏹️ STOP JOB", callback_data="/stopjob"))
+    keyboard.row(types.InlineKeyboardButton("📊 STATUS", callback_data="/status"), types.InlineKeyboardButton("⚙️ CẤU HÌNH", callback_data="/config"))
+    keyboard.row(types.InlineKeyboardButton("📈 LỊCH SỬ", callback_data="/history"))
+    keyboard.row(types.InlineKeyboardButton("🔑 THÊM AUTHEN", callback_data="/auth_hint"), types.InlineKeyboardButton("🗑️ XOÁ AUTHEN", callback_data="/xoaauthen"))
+    return keyboard
+
+@bot.message_handler(commands=['start', 'help'])
+def send_welcome(message):
+    text = ("🤖 *Chào mừng đến với Golike Rotator Bot!*\n\n"
+        "Sử dụng các lệnh/nút sau để quản lý:\n"
+        "`/auth <token>`: Thêm Auth Token Golike.\n"
+        "`/config`: Chọn nền tảng chạy (IG, Threads, Cả 2).\n"
+        "`/startjob`: Bắt đầu auto đa luồng.\n"
+        "`/status`: Hiện/cập nhật tin nhắn thống kê chính (Log TỰ ĐỘNG thay đổi).\n"
+        "`/history [số ngày]`: Thu nhập theo ngày/giờ (lưu lại qua các lần Restart).\n"
+        "`/export`: Tải file JSONL các hoạt động gần nhất.\n\n"
+        "⚠️ *LƯU Ý:* Token và Config đã được lưu lại để chống mất dữ liệu khi Service ngủ/Restart.")
+    tg_send(message.chat.id, text, reply_markup=get_menu_keyboard(), parse_mode='Markdown')
+
+def get_config_keyboard(config: dict, concurrency: dict):
+    keyboard = types.InlineKeyboardMarkup()
+    ig_emoji = "✅ IG" if config['instagram'] else " IG"; th_emoji = "✅ Threads" if config['threads'] else " Threads"
+    keyboard.row(types.InlineKeyboardButton(ig_emoji, callback_data="config_toggle_instagram"), types.InlineKeyboardButton(th_emoji, callback_data="config_toggle_threads"))
+    keyboard.row(types.InlineKeyboardButton("CẢ HAI", callback_data="config_set_both"), types.InlineKeyboardButton("❌ KHÔNG CHẠY", callback_data="config_set_none"))
+    for platform, label in (('instagram', 'IG'), ('threads', 'Threads')):
+        keyboard.row(types.InlineKeyboardButton("➖", callback_data=f"config_workers_dec_{platform}"),
+                     types.InlineKeyboardButton(f"👷 {label}: {concurrency[platform]} worker", callback_data=f"config_workers_info_{platform}"),
+                     types.InlineKeyboardButton("➕", callback_data=f"config_workers_inc_{platform}"))
+    keyboard.row(types.InlineKeyboardButton("↩️ MENU CHÍNH", callback_data="/start"))
+    return keyboard
+
+def config_text(job_state):
+    current_config = job_state.platform_config; concurrency = job_state.concurrency
+    text = "⚙️ *CHỌN NỀN TẢNG MUỐN CHẠY TRONG PHIÊN TIẾP THEO:*\n\n"
+    text += f"- Instagram: {'✅ Đang bật' if current_config['instagram'] else '❌ Đang tắt'} ({concurrency['instagram']} worker)\n"
+    text += f"- Threads: {'✅ Đang bật' if current_config['threads'] else '❌ Đang tắt'} ({concurrency['threads']} worker)\n"
+    text += f"\nNhấn vào các nút bên dưới để chuyển đổi. Mỗi worker hỏi job cho một nhóm UID riêng (tối đa {WORKERS_MAX} worker/nền tảng)."
+    return text
+
+@bot.message_handler(commands=['config'])
+def handle_config(message):
+    chat_id = message.chat.id
+    with user_states_lock: job_state = USER_JOB_STATES.get(chat_id)
+    if not job_state: 
+        db_data = get_auth_data(chat_id)
+        if not db_data: tg_send(chat_id, "⚠️ **Chưa có Auth Token.** Vui lòng dùng lệnh `/auth` trước.", parse_mode='Markdown'); return
+        job_state = UserJobState(db_data['auth_token'], chat_id, db_data['platform_config'], db_data['concurrency'])
+        USER_JOB_STATES[chat_id] = job_state
+        job_state.add_activity_log("Dữ liệu cấu hình được khôi phục từ Database.")
+        
+    if job_state.is_running: tg_send(chat_id, "⚠️ **Phải dùng /stopjob** để dừng Job trước khi thay đổi cấu hình.", parse_mode='Markdown'); return
+
+    tg_send(chat_id, config_text(job_state), reply_markup=get_config_keyboard(job_state.platform_config, job_state.concurrency), parse_mode='Markdown')
+
+
+@bot.callback_query_handler(func=lambda call: call.data.startswith('config_'))
+def handle_config_callback(call):
+    chat_id = call.message.chat.id; config_action = call.data
+    
+    with user_states_lock:
+        job_state = USER_JOB_STATES.get(chat_id)
+        if not job_state or job_state.is_running: tg_answer(call.id, "❌ Không thể thay đổi khi Job đang chạy hoặc chưa có Token.", show_alert=True); return
+             
+        current_config = job_state.platform_config
+        if config_action == 'config_toggle_instagram': current_config['instagram'] = not current_config['instagram']; tg_answer(call.id, f"IG đã chuyển sang {'BẬT' if current_config['instagram'] else 'TẮT'}")
+        elif config_action == 'config_toggle_threads': current_config['threads'] = not current_config['threads']; tg_answer(call.id, f"Threads đã chuyển sang {'BẬT' if current_config['threads'] else 'TẮT'}")
+        elif config_action == 'config_set_both': current_config.update({'instagram': True, 'threads': True}); tg_answer(call.id, "✅ Đã chọn CẢ HAI.")
+        elif config_action == 'config_set_none': current_config.update({'instagram': False, 'threads': False}); tg_answer(call.id, "❌ Đã chọn KHÔNG CHẠY CÁI NÀO.")
+        elif config_action.startswith('config_workers_'):
+            _, _, step, platform = config_action.split('_', 3); concurrency = job_state.concurrency
+            if step == 'info' or platform not in concurrency: tg_answer(call.id, "Dùng ➖/➕ để đổi số worker."); return
+            count = clamp_workers(concurrency[platform] + (1 if step == 'inc' else -1))
+            if count == concurrency[platform]: tg_answer(call.id, f"Số worker phải từ 1 tới {WORKERS_MAX}."); return
+            concurrency[platform] = count; tg_answer(call.id, f"{'IG' if platform == 'instagram' else 'Threads'}: {count} worker")
+        
+        save_auth_data(chat_id, job_state.auth_token, current_config['instagram'], current_config['threads'], job_state.concurrency)
+        
+        new_text = config_text(job_state)
+        
+        def on_done(future):
+            e = future.exception()
+            if e is not None and "message is not modified" not in str(e): job_state.send_log_message(f"Lỗi cập nhật cấu hình: {e}")
+        tg_edit(chat_id, call.message.message_id, new_text, reply_markup=get_config_keyboard(current_config, job_state.concurrency), parse_mode='Markdown').add_done_callback(on_done)
+        
+    
+@bot.callback_query_handler(func=lambda call: call.data in ['/startjob', '/stopjob', '/status', '/history', '/xoaauthen', '/auth_hint', '/config', '/start'])
+def handle_callback_query(call):
+    message = call.message
+    tg_answer(call.id) 
+    if call.data == '/auth_hint': tg_send(message.chat.id, "Để thêm Auth Token, bạn gửi lệnh theo cú pháp sau:\n\n`/auth Bearer eyJ0eXAiOi...`\n\n*Bạn phải có khoảng trắng giữa /auth và Bearer.*", parse_mode='Markdown')
+    elif call.data == '/startjob': handle_startjob(message)
+    elif call.data == '/stopjob': handle_stopjob(message)
+    elif call.data == '/status': handle_status(message)
+    elif call.data == '/history': handle_history(message)
+    elif call.data == '/xoaauthen': handle_xoaauthen(message)
+    elif call.data == '/config': handle_config(message) 
+    elif call.data == '/start': send_welcome(message) 
+
+@bot.message_handler(commands=['auth'])
+def handle_auth(message):
+    chat_id = message.chat.id; token_match = re.match(r'/auth\s+(Bearer\s+\S+)', message.text, re.DOTALL)
+    
+    if token_match:
+        auth_token = token_match.group(1).strip()
+        job_state = USER_JOB_STATES.get(chat_id)
+        if job_state: job_state.send_log_message("🔍 Đang kiểm tra Auth Token và lấy danh sách tài khoản...")
+        else: tg_send(chat_id, "`🔍 Đang kiểm tra Auth Token và lấy danh sách tài khoản...`", parse_mode='Markdown') # CŨNG LÀ TIN NHẮN ĐỘC LẬP.
+        
+        if job_state and job_state.auth_token != auth_token: ACCOUNT_CACHE.invalidate(job_state.auth_token)
+        account_lists = ACCOUNT_CACHE.get(auth_token, force=True)
+        instagram_accounts, err_ig = account_lists['instagram']; threads_accounts, err_th = account_lists['threads']
+
+        if err_ig.startswith('Lỗi HTTP 401') or err_th.startswith('Lỗi HTTP 401') : tg_send(chat_id, "❌ Auth Token bị từ chối (401 Unauthorized). *Token không hợp lệ hoặc đã hết hạn.*", parse_mode='Markdown'); return
+
+        db_data = get_auth_data(chat_id); old_config = db_data['platform_config'] if db_data else {'instagram': True, 'threads': True}
+        old_concurrency = db_data['concurrency'] if db_data else default_concurrency()
+
+        # leave_job (chuyển engine, chờ worker thoát, ghi DB) phải chạy ngoài user_states_lock: hand_over cũng lấy lock này.
+        with user_states_lock: old_state = USER_JOB_STATES.get(chat_id)
+        if old_state and old_state.is_running: leave_job(old_state); tg_send(chat_id, "`⚠️ Công việc cũ đã được dừng.`", parse_mode='Markdown')
+
+        with user_states_lock: job_state = USER_JOB_STATES[chat_id] = UserJobState(auth_token, chat_id, old_config, old_concurrency)
+        job_state.add_activity_log(f"Token mới được thiết lập. IG:{len(instagram_accounts)}, TH:{len(threads_accounts)}")
+        save_auth_data(chat_id, auth_token, old_config['instagram'], old_config['threads'], old_concurrency)
+
+        acc_info = f"✅ Lưu Auth Token thành công!\n\n"; acc_info += f"📸 Tìm thấy {len(instagram_accounts)} UID Instagram hoạt động.\n"; acc_info += f"🧵 Tìm thấy {len(threads_accounts)} UID Threads hoạt động."
+            
+        tg_send(chat_id, acc_info, reply_markup=get_menu_keyboard(), parse_mode='Markdown')
+    else: tg_send(chat_id, "❌ Cú pháp lệnh sai. Vui lòng gửi theo mẫu:\n\n`/auth Bearer <Auth_Token>`", parse_mode='Markdown')
+
+@bot.message_handler(commands=['xoaauthen'])
+def handle_xoaauthen(message):
+    chat_id = message.chat.id
+    with user_states_lock: job_state = USER_JOB_STATES.get(chat_id)
+    if not job_state and not get_auth_data(chat_id): tg_send(chat_id, "🤷 Auth Token chưa được thiết lập."); return
+
+    remaining = 0
+    if job_state: 
+        if job_state.is_running: job_state, _, remaining = leave_job(job_state); tg_send(chat_id, "`⚠️ Job đang chạy đã được dừng trước khi xoá.`", parse_mode='Markdown')
+        if job_state.last_status_message_id:
+            tg_delete(chat_id, job_state.last_status_message_id)
+            
+    if job_state and not remaining: SESSION_POOL.discard(job_state.auth_token); ACCOUNT_CACHE.invalidate(job_state.auth_token)   # token còn chat khác đang chạy thì giữ session
+    else:
+        db_data = get_auth_data(chat_id)
+        if db_data: ACCOUNT_CACHE.invalidate(db_data['auth_token'])
+    delete_auth_data(chat_id)
+    USER_JOB_STATES.pop(chat_id, None)
+
+    tg_send(chat_id, "🗑️ Đã xoá Auth Token và dữ liệu phiên thành công. Bạn có thể thêm token mới bằng lệnh /auth.", reply_markup=get_menu_keyboard())
+
+@bot.message_handler(commands=['startjob'])
+def handle_startjob(message):
+    chat_id = message.chat.id
+    with user_states_lock: 
+        job_state = USER_JOB_STATES.get(chat_id)
+        if not job_state:
+             db_data = get_auth_data(chat_id)
+             if db_data: 
+                 job_state = UserJobState(db_data['auth_token'], chat_id, db_data['platform_config'], db_data['concurrency'])
+                 USER_JOB_STATES[chat_id] = job_state
+             else:
+                 tg_send(chat_id, "⚠️ **Auth Token đã bị mất (không tìm thấy trong Database/RAM).** Vui lòng dùng lệnh `/auth` để thiết lập lại.", parse_mode='Markdown'); return
+
+    if job_state.is_running: tg_send(chat_id, "⚠️ Job đã và đang chạy rồi."); return
+    if not any(job_state.platform_config.values()): tg_send(chat_id, "❌ Không có nền tảng nào được cấu hình chạy. Vui lòng dùng lệnh `/config` để bật Instagram, Threads, hoặc cả hai.", parse_mode='Markdown'); return
+
+    job_state.send_log_message("🔄 Đang lấy danh sách UID hoạt động để chuẩn bị chạy job...")
+    account_lists = ACCOUNT_CACHE.get(job_state.auth_token)
+    instagram_accounts, err_ig = account_lists['instagram']; threads_accounts, err_th = account_lists['threads']
+
+    filtered_ig = instagram_accounts if job_state.platform_config['instagram'] else []; filtered_th = threads_accounts if job_state.platform_config['threads'] else []
+    if not filtered_ig and not filtered_th: tg_send(chat_id, "❌ Không có tài khoản hoạt động nào để chạy với cấu hình hiện tại (kiểm tra trạng thái tài khoản trên Golike)."); return
+    # Lease chỉ lấy khi chắc chắn sẽ chạy; từ đây mọi đường thoát sớm phải trả lease (stop_workers tự trả).
+    if not SHARDS.acquire(chat_id): tg_send(chat_id, "⚠️ Job của bạn đang được một node khác chạy. Thử lại sau ít giây."); return
+
+    # Gửi tin nhắn Status BAN ĐẦU (để lấy ID)
+    try:
+         if job_state.last_status_message_id: 
+            tg_delete(chat_id, job_state.last_status_message_id)
+         initial_message = tg_send(chat_id, job_state.generate_status_text(), parse_mode='Markdown').result(TG_WAIT_TIMEOUT)
+         job_state.last_status_message_id = initial_message.message_id
+    except Exception as e: SHARDS.release(chat_id); job_state.send_log_message(f"❌ Lỗi gửi tin nhắn Status ban đầu: {e}"); return
+
+    host = JOB_ENGINES.claim(job_state)
+    if host is not None:
+        # Token đã có engine chạy ở chat khác: gắn vào thay vì tạo worker thứ hai hỏi cùng UID.
+        job_state.add_activity_log("🔗 Token này đang chạy ở chat khác: dùng chung engine (không tạo thêm worker)."); job_state.update_status_message(); return
+    num_workers = job_state.start_workers(filtered_ig, filtered_th)
+
+    if num_workers > 0: job_state.add_activity_log(f"Đã khởi động Job Đa Luồng thành công với {num_workers} Worker."); job_state.update_status_message()
+    else: job_state.stop_workers(); job_state.send_log_message("❌ Không thể khởi động Worker nào. Có lỗi xảy ra.")
+
+@bot.message_handler(commands=['stopjob'])
+def handle_stopjob(message):
+    chat_id = message.chat.id
+    with user_states_lock: 
+        job_state = USER_JOB_STATES.get(chat_id)
+        if not job_state: tg_send(chat_id, "⚠️ **Job không được tìm thấy trong bộ nhớ RAM.** Đã bị dừng hoặc chưa chạy.", parse_mode='Markdown'); return
+
+    if not job_state.is_running: tg_send(chat_id, "⚠️ Không có Job nào đang chạy để dừng."); return
+        
+    source = job_state.engine or job_state
+    with source.lock: final_money = source.total_money
+    job_state, num_stopped, remaining = leave_job(job_state)
+
+    if remaining:
+        job_state.add_activity_log(f"⏹️ Đã rời engine dùng chung (còn {remaining} chat đang chạy). Tổng tiền: {final_money}")
+        if job_state.last_status_message_id: job_state.update_status_message()
+        tg_send(chat_id, f"✅ *Đã rời Job dùng chung. Worker vẫn chạy cho {remaining} chat khác cùng token. Tổng thu nhập engine: {final_money} xu.*", parse_mode='Markdown', reply_markup=get_menu_keyboard())
+        return
+
+    job_state.add_activity_log(f"⏹️ Job đã dừng thành công {num_stopped} Worker. Tổng tiền: {final_money}")
+    
+    if job_state.last_status_message_id: job_state.update_status_message()
+    
+    tg_send(chat_id, f"✅ *Đã dừng thành công {num_stopped} Worker. Tổng thu nhập phiên này: {final_money} xu.*", parse_mode='Markdown', reply_markup=get_menu_keyboard())
+
+
+@bot.message_handler(commands=['status'])
+def handle_status(message):
+    chat_id = message.chat.id
+    with user_states_lock: job_state = USER_JOB_STATES.get(chat_id)
+    
+    if not job_state:
+        db_data = get_auth_data(chat_id)
+        if db_data: 
+             job_state = UserJobState(db_data['auth_token'], chat_id, db_data['platform_config'], db_data['concurrency'])
+             USER_JOB_STATES[chat_id] = job_state
+             job_state.add_activity_log("Dữ liệu Status được khôi phục từ Database.")
+        else:
+            tg_send(chat_id, "❌ **Auth Token chưa được thiết lập** (hoặc đã bị mất hoàn toàn). Vui lòng dùng /auth.", parse_mode='Markdown', reply_markup=get_menu_keyboard()); return
+
+    if job_state.is_running:
+         if job_state.last_status_message_id:
+             try: job_state.update_status_message().result(TG_WAIT_TIMEOUT); return 
+             except Exception as e:
+                 if "message to edit not found" in str(e).lower(): job_state.last_status_message_id = None
+                 elif "message is not modified" in str(e): return
+                 else: job_state.send_log_message(f"❌ Lỗi cập nhật Status: {e}")
+         
+         if not job_state.last_status_message_id:
+            try:
+               initial_message = tg_send(chat_id, job_state.generate_status_text(), parse_mode='Markdown').result(TG_WAIT_TIMEOUT)
+               job_state.last_status_message_id = initial_message.message_id
+               return
+            except Exception as e: job_state.send_log_message(f"❌ Lỗi hiển thị Status Log mới: {e}")
+
+    else:
+        status_text = f"🟡 *Trạng thái:* ĐÃ DỪNG\n"
+        status_text += f"💰 Thu nhập phiên cuối: `{job_state.total_money}` xu\n"
+        status_text += f"✅ Thành công: `{job_state.total_success}`\n"
+        status_text += f"❌ Thất bại: `{job_state.total_failed}`\n"
+        status_text += "\nNhấn /startjob để chạy lại."
+        tg_send(chat_id, status_text, parse_mode='Markdown', reply_markup=get_menu_keyboard())
+
+
+HISTORY_MAX_DAYS = 90; HISTORY_HOURS = 6
+
+def format_rollups(rows, period):
+    # rows: [(bucket_start, platform, success, failed, xu)] mới nhất trước -> các dòng Markdown, gộp 2 nền tảng theo mốc.
+    buckets = OrderedDict()
+    for bucket_start, platform, success, failed, xu in rows:
+        total = buckets.setdefault(bucket_start, {'success': 0, 'failed': 0, 'xu': 0, 'platforms': []})
+        total['success'] += success; total['failed'] += failed; total['xu'] += xu
+        if xu or success: total['platforms'].append(f"{'IG' if platform == 'instagram' else 'TH'} {xu}")
+    fmt = '%d/%m' if period == 'day' else '%H:00'
+    return [f"`{datetime.fromtimestamp(start, DISPLAY_TZ).strftime(fmt)}` 💰 `{t['xu']}` xu | ✅ `{t['success']}` ❌ `{t['failed']}`"
+            + (f" _({', '.join(t['platforms'])})_" if len(t['platforms']) > 1 else "") for start, t in buckets.items()]
+
+@bot.message_handler(commands=['history'])
+def handle_history(message):
+    chat_id = message.chat.id; parts = (message.text or '').split()
+    days = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else 7; days = max(1, min(days, HISTORY_MAX_DAYS))
+    now = time.time()
+    try:
+        daily = STORE.fetch_rollups(chat_id, 'day', rollup_bucket('day', now) - (days - 1) * 86400)
+        hourly = STORE.fetch_rollups(chat_id, 'hour', rollup_bucket('hour', now) - (HISTORY_HOURS - 1) * 3600)
+    except Exception as e:
+        tg_send(chat_id, f"❌ Lỗi đọc lịch sử job: {e}", reply_markup=get_menu_keyboard()); return
+    if not daily:
+        tg_send(chat_id, f"📈 Chưa có job nào được ghi nhận trong {days} ngày gần đây.", reply_markup=get_menu_keyboard()); return
+
+    total_xu = sum(row[4] for row in daily); total_success = sum(row[2] for row in daily); total_failed = sum(row[3] for row in daily)
+    text = f"📈 *LỊCH SỬ {days} NGÀY* (UTC{TZ_OFFSET_HOURS:+g})\n"
+    text += f"💰 Tổng: `{total_xu}` xu | ✅ `{total_success}` | ❌ `{total_failed}`\n"
+    text += "\n*Theo ngày:*\n" + "\n".join(format_rollups(daily, 'day'))
+    if hourly: text += f"\n\n*{HISTORY_HOURS} giờ gần nhất:*\n" + "\n".join(format_rollups(hourly, 'hour'))
+    tg_send(chat_id, text, parse_mode='Markdown', reply_markup=get_menu_keyboard())
+
+
+@bot.message_handler(commands=['export'])
+def handle_export(message):
+    chat_id = message.chat.id
+    with user_states_lock: job_state = USER_JOB_STATES.get(chat_id)
+    if job_state is None or not len(job_state.activity_log): tg_send(chat_id, "🤷 Chưa có hoạt động nào để xuất.", reply_markup=get_menu_keyboard()); return
+    document = io.BytesIO()
+    for line in activity_jsonl(job_state.activity_log): document.write(line.encode('utf-8'))
+    # bytes (không phải file object) để Outbox gửi lại được khi Telegram trả 429.
+    OUTBOX.submit(chat_id, 'send_document', chat_id, document.getvalue(), visible_file_name=f"activity_{chat_id}.jsonl",
+                  caption=f"📤 {len(job_state.activity_log)} sự kiện gần nhất (JSONL, UTC{TZ_OFFSET_HOURS:+g}).")
+
+
+@bot.message_handler(commands=['profile'])
+def handle_profile(message):
+    # /profile [giây] [TIỀN_TỐ_THREAD,...] — chỉ cho ADMIN_CHAT_IDS; đo trên thread riêng rồi gửi file collapsed stack.
+    chat_id = message.chat.id
+    if chat_id not in ADMIN_CHAT_IDS: tg_send(chat_id, "⛔ Lệnh chỉ dành cho quản trị viên."); return
+    parts = (message.text or '').split()
+    seconds = float(parts[1]) if len(parts) > 1 and parts[1].replace('.', '', 1).isdigit() else 10
+    prefixes = tuple(parts[2].split(',')) if len(parts) > 2 else PROFILE_THREAD_PREFIXES
+    if PROFILER.running: tg_send(chat_id, "⏳ Profiler đang chạy một phiên khác."); return
+
+    def run():
+        try: counts, samples = PROFILER.profile(seconds, prefixes=prefixes)
+        except RuntimeError as e: tg_send(chat_id, f"⏳ {e}"); return
+        if not counts: tg_send(chat_id, f"🤷 Không có thread nào khớp {', '.join(prefixes)} trong {samples} lần lấy mẫu."); return
+        caption = f"🔬 {samples} lần lấy mẫu / {min(seconds, PROFILE_MAX_SECONDS):g}s\n{profile_summary(counts)}"
+        OUTBOX.submit(chat_id, 'send_document', chat_id, collapsed_stacks(counts).encode('utf-8'),
+                      visible_file_name=f"profile_{int(time.time())}.collapsed", caption=caption[:1000])
+    tg_send(chat_id, f"🔬 Đang lấy mẫu stack trong {min(seconds, PROFILE_MAX_SECONDS):g}s...")
+    threading.Thread(target=run, daemon=True, name="PROFILER").start()
+
+
+# ==============================================================================
+# 5. KHỞI TẠO WEBHOOK VÀ CHẠY ỨNG DỤNG FLASK (Render)
+# ==============================================================================
+
+def update_chat_id(update):
+    for message in (update.message, update.edited_message, update.callback_query.message if update.callback_query else None):
+        if message is not None: return message.chat.id
+    return None
+
+
+class UpdateDispatcher:
+    # Hàng đợi nhận update có giới hạn. Mỗi chat được băm cố định vào một worker nên update của cùng
+    # chat xử lý đúng thứ tự; update_id đã nhận thì bỏ qua (Telegram gửi lại khi webhook phản hồi chậm).
+    def __init__(self, workers, max_pending, dedupe_size=10000):
+        self.queues = [queue.Queue(maxsize=max(1, max_pending // workers)) for _ in range(workers)]
+        self.threads = []; self.lock = threading.Lock(); self.seen = OrderedDict(); self.dedupe_size = dedupe_size
+        self.accepted = 0; self.duplicates = 0; self.rejected = 0; self.processed = 0; self.failed = 0
+        self.wait_samples = deque(maxlen=2048); self.max_wait = 0.0
+
+    def _ensure_started(self):
+        if self.threads: return
+        for index, shard in enumerate(self.queues):
+            t = threading.Thread(target=self._run, args=(shard,), daemon=True, name=f"UPDATE_WORKER_{index + 1}"); t.start(); self.threads.append(t)
+
+    def submit(self, update):
+        # True: đã nhận (hoặc trùng), False: hàng đợi đầy -> webhook trả 503 để Telegram gửi lại sau.
+        with self.lock:
+            self._ensure_started()
+            if update.update_id in self.seen: self.duplicates += 1; return True
+            self.seen[update.update_id] = None
+            while len(self.seen) > self.dedupe_size: self.seen.popitem(last=False)
+        chat_id = update_chat_id(update)
+        shard = self.queues[hash(chat_id if chat_id is not None else update.update_id) % len(self.queues)]
+        try: shard.put((time.monotonic(), update), timeout=UPDATE_ENQUEUE_TIMEOUT)
+        except queue.Full:
+            with self.lock: self.seen.pop(update.update_id, None); self.rejected += 1
+            return False
+        with self.lock: self.accepted += 1
+        return True
+
+    def _run(self, shard):
+        while True:
+            enqueued_at, update = shard.get(); waited = time.monotonic() - enqueued_at
+            with self.lock: self.wait_samples.append(waited); self.max_wait = max(self.max_wait, waited)
+            try: bot.process_new_updates([update]); ok = True
+            except Exception as e: ok = False; print(f"❌ Lỗi xử lý update {update.update_id}: {e}")
+            with self.lock:
+                if ok: self.processed += 1
+                else: self.failed += 1
+
+    def stats(self):
+        with self.lock:
+            samples = sorted(self.wait_samples); pick = lambda q: round(samples[min(len(samples) - 1, int(q * len(samples)))], 4) if samples else 0.0
+            return {'queue_depth': sum(q.qsize() for q in self.queues), 'accepted': self.accepted, 'duplicates': self.duplicates, 'rejected': self.rejected,
+                    'processed': self.processed, 'failed': self.failed, 'queue_wait_p50': pick(0.5), 'queue_wait_p99': pick(0.99), 'queue_wait_max': round(self.max_wait, 4)}
+
+
+UPDATE_DISPATCHER = UpdateDispatcher(UPDATE_WORKERS, UPDATE_QUEUE_MAX)
+
+@app.route(WEBHOOK_URL_PATH, methods=['POST'])
+def webhook():
+    if request.headers.get('content-type') == 'application/json':
+        json_string = request.get_data().decode('utf-8')
+        update = types.Update.de_json(json_string) 
+        forwarded = request.headers.get('X-Shard-Forwarded')
+        if forwarded is not None and not is_shard_forward(forwarded): return '', 403
+        owner_url = None if forwarded else SHARDS.owner_url(update_chat_id(update))
+        if owner_url: SHARDS.forward(owner_url, json_string.encode('utf-8'), lambda: UPDATE_DISPATCHER.submit(update)); return '', 200
+        if not UPDATE_DISPATCHER.submit(update): return '', 503
+        return '', 200
+    else: return '', 403
+
+def setup_webhook():
+    if not SERVER_URL or not SERVER_URL.startswith("https://"):
+         print("❌ SERVER_URL CHƯA ĐƯỢC THIẾT LẬP HOẶC KHÔNG HỢP LỆ/KHÔNG HTTPS. KHÔNG THỂ THIẾT LẬP WEBHOOK."); return
+    webhook_url = SERVER_URL + WEBHOOK_URL_PATH
+    for attempt in range(3):
+        try:
+            # Webhook đã trỏ đúng URL (trường hợp thường gặp khi service thức dậy/restart): không đăng ký lại.
+            # set_webhook tự thay URL cũ nên không cần remove_webhook + sleep như trước.
+            if bot.get_webhook_info().url == webhook_url: print(f"✅ Webhook đã trỏ đúng {webhook_url}, bỏ qua đăng ký lại."); return
+            if bot.set_webhook(url=webhook_url): print(f"✅ Webhook đã được thiết lập thành công tới: {webhook_url}"); return
+            else: print(f"Lần {attempt+1}: set_webhook trả về False.")
+        except Exception as e: print(f"Lần {attempt+1} - Lỗi khi thiết lập Webhook: {e}")
+        time.sleep(2 ** attempt) 
+    print("❌ THIẾT LẬP WEBHOOK THẤT BẠI HOÀN TOÀN.")
+
+STARTUP_PHASES = OrderedDict()   # tên giai đoạn -> giây, hiện trong /stats
+
+@contextmanager
+def startup_phase(name):
+    started = time.perf_counter()
+    try: yield
+    finally: STARTUP_PHASES[name] = round(time.perf_counter() - started, 3)
+
+def wait_for_server(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2): return True
+        except OSError: time.sleep(0.05)
+    return False
+
+def finish_startup():
+    # Chạy nền sau khi app.run bắt đầu: server nhận update ngay, đăng ký webhook không chặn việc lắng nghe cổng.
+    with startup_phase('server_listen'): wait_for_server(WEBHOOK_PORT)
+    with startup_phase('webhook'): setup_webhook()
+    STARTUP_PHASES['total'] = round(time.perf_counter() - BOOT_STARTED, 3)
+    print("⏱️ Khởi động: " + " | ".join(f"{name} {seconds:.3f}s" for name, seconds in STARTUP_PHASES.items()))
+            
+@app.route('/')
+def home(): return "Golike Rotator Telebot đang hoạt động! Tương tác qua Telegram.", 200
+
+def collect_stats(): return {'job_states': USER_JOB_STATES.stats(), 'golike_sessions': SESSION_POOL.stats(), 'golike_guard': GOLIKE_GUARD.stats(), 'golike_inflight': GOLIKE_INFLIGHT.stats(), 'storage': STORE.stats(), 'telegram_outbox': OUTBOX.stats(), 'dashboards': DASHBOARD_REFRESHER.stats(), 'webhook_updates': UPDATE_DISPATCHER.stats(), 'account_lists': ACCOUNT_CACHE.stats(), 'job_ledger': LEDGER.stats(), 'job_snapshots': SNAPSHOTTER.stats(), 'job_engines': JOB_ENGINES.stats(), 'workers': WORKER_WATCHDOG.stats(), 'shards': SHARDS.stats(), 'profiler': PROFILER.stats(), 'startup': dict(STARTUP_PHASES)}
+
+@app.route('/stats')
+def stats(): return jsonify(collect_stats()), 200
+
+def check_admin_key():
+    # -> None nếu hợp lệ, ngược lại là response lỗi. Route quản trị tắt hẳn (404) khi chưa đặt ADMIN_KEY.
+    # Khoá chỉ nhận qua header X-Admin-Key: query string bị ghi lại trong log của proxy/access log.
+    if not ADMIN_KEY: return "Not found", 404
+    supplied = request.headers.get('X-Admin-Key') or ''
+    if not hmac.compare_digest(supplied, ADMIN_KEY): return "Forbidden", 403
+    return None
+
+@app.route('/export/<int:chat_id>')
+def export_activity(chat_id):
+    # Stream JSONL sự kiện của một chat; ?since=<seq> để chỉ lấy các sự kiện mới hơn lần đọc trước.
+    denied = check_admin_key()
+    if denied: return denied
+    with user_states_lock: job_state = USER_JOB_STATES.get(chat_id)
+    if job_state is None: return "Not found", 404
+    since = request.args.get('since', '0'); since = int(since) if since.isdigit() else 0
+    return Response(activity_jsonl(job_state.activity_log, since), mimetype='application/x-ndjson'), 200
+
+@app.route('/workers')
+def workers_route():
+    # {chat_id: số worker còn sống} của các chat đang chạy trên node này.
+    denied = check_admin_key()
+    if denied: return denied
+    return jsonify({str(chat_id): live for chat_id, live in WORKER_WATCHDOG.live_by_chat().items()}), 200
+
+@app.route('/profile')
+def profile_route():
+    # GET /profile?seconds=10&interval=0.01&threads=INSTA_WORKER,UPDATE_WORKER -> collapsed stack (text), chặn trong lúc đo.
+    denied = check_admin_key()
+    if denied: return denied
+    try:
+        seconds = float(request.args.get('seconds', 10)); interval = float(request.args.get('interval', PROFILE_INTERVAL))
+    except ValueError: return "seconds/interval phải là số", 400
+    threads = request.args.get('threads'); prefixes = tuple(threads.split(',')) if threads else PROFILE_THREAD_PREFIXES
+    try: counts, _ = PROFILER.profile(seconds, interval, prefixes)
+    except RuntimeError as e: return str(e), 409
+    return Response(collapsed_stacks(counts), mimetype='text/plain'), 200
+
+@app.route('/metrics')
+def metrics():
+    # Định dạng text của Prometheus; số liệu của /stats được xuất thêm dưới dạng gauge golike_bot_<nhóm>_<tên>.
+    with user_states_lock: running = sum(1 for state in USER_JOB_STATES.values() if state.is_running)
+    gauges = [('golike_bot_running_chats', running), ('golike_bot_threads', threading.active_count())]
+    for group, values in collect_stats().items():
+        gauges += [(f"golike_bot_{group}_{key}", value) for key, value in values.items() if isinstance(value, (int, float)) and not isinstance(value, bool)]
+    return Response(METRICS.render(gauges), mimetype='text/plain; version=0.0.4'), 200
+
+if __name__ == '__main__':
+    # Chú ý: Đổi tên file này thành bot.py nếu Start command của Render là python bot.py
+    STARTUP_PHASES['module_load'] = round(time.perf_counter() - BOOT_STARTED, 3)
+    with startup_phase('init_db'): init_db()
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))   # Render gửi SIGTERM: thoát qua atexit để ghi snapshot + sổ cái
+    with startup_phase('background'):
+        SNAPSHOTTER.ensure_started(); SHARDS.start()
+        if RESUME_ON_BOOT: threading.Thread(target=resume_jobs, daemon=True, name="RESUME_JOBS").start()
+    threading.Thread(target=finish_startup, daemon=True, name="STARTUP").start()
+    print(f"Bot khởi động trên cổng: {WEBHOOK_PORT}")
     app.run(host="0.0.0.0", port=WEBHOOK_PORT)
\ No newline at end of file
@@ -0,0 +1,169 @@
+# Server giả lập Golike gateway + Telegram Bot API để benchmark/thử bot offline (chỉ dùng thư viện chuẩn).
+#
+#   python mock_server.py --port 8081 --accounts 5 --latency-ms 80 --job-rate 0.3 --tg-429-rate 0.01
+#   GOLIKE_API_BASE=http://127.0.0.1:8081 TELEGRAM_API_URL=http://127.0.0.1:8081 python ib.py
+#
+# GET /__stats trả thống kê số lời gọi theo endpoint và thời điểm hỏi job của từng worker; POST /__reset xoá thống kê.
+import argparse
+import itertools
+import json
+import random
+import re
+import sys
+import threading
+import time
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class MockConfig:
+    def __init__(self, accounts=5, latency_ms=50.0, jitter_ms=20.0, job_rate=0.3, error_rate=0.0, tg_429_rate=0.0, retry_after=1, price=50, seed=None):
+        self.accounts = accounts; self.latency_ms = latency_ms; self.jitter_ms = jitter_ms; self.job_rate = job_rate
+        self.error_rate = error_rate; self.tg_429_rate = tg_429_rate; self.retry_after = retry_after; self.price = price
+        self.rng = random.Random(seed); self.rng_lock = threading.Lock()
+
+    def roll(self, probability):
+        with self.rng_lock: return self.rng.random() < probability
+
+    def delay(self):
+        with self.rng_lock: ms = max(0.0, self.rng.gauss(self.latency_ms, self.jitter_ms)) if self.jitter_ms else self.latency_ms
+        if ms: time.sleep(ms / 1000)
+
+
+class MockStats:
+    def __init__(self):
+        self.lock = threading.Lock(); self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.calls = defaultdict(int); self.poll_times = defaultdict(list); self.started_at = time.time()
+
+    def record(self, name, worker=None):
+        with self.lock:
+            self.calls[name] += 1
+            if worker is not None: self.poll_times[worker].append(time.monotonic())
+
+    def snapshot(self):
+        with self.lock:
+            return {'since': self.started_at, 'calls': dict(self.calls),
+                    'poll_times': {'|'.join(map(str, k)): v for k, v in self.poll_times.items()}}
+
+
+TELEGRAM_METHODS = {'getMe', 'sendMessage', 'editMessageText', 'deleteMessage', 'answerCallbackQuery',
+                    'setWebhook', 'deleteWebhook', 'getWebhookInfo', 'sendDocument'}
+_message_ids = itertools.count(1000)
+
+
+def make_handler(config, stats):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args): pass
+
+        def _reply(self, status, payload, content_type='application/json'):
+            body = payload if isinstance(payload, bytes) else json.dumps(payload).encode('utf-8')
+            self.send_response(status); self.send_header('Content-Type', content_type); self.send_header('Content-Length', str(len(body)))
+            self.end_headers(); self.wfile.write(body)
+
+        def _params(self):
+            url = urlparse(self.path); params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+            length = int(self.headers.get('Content-Length') or 0); raw = self.rfile.read(length) if length else b''
+            if raw:
+                ctype = self.headers.get('Content-Type', '')
+                if 'json' in ctype:
+                    try: params.update(json.loads(raw))
+                    except ValueError: pass
+                elif 'form' in ctype: params.update({k: v[-1] for k, v in parse_qs(raw.decode('utf-8', 'replace')).items()})
+            return url.path, params
+
+        def do_GET(self): self._dispatch()
+        def do_POST(self): self._dispatch()
+
+        def _dispatch(self):
+            path, params = self._params()
+            if path == '/__stats': return self._reply(200, stats.snapshot())
+            if path == '/__reset': stats.reset(); return self._reply(200, {'ok': True})
+            telegram = re.match(r'^/bot[^/]+/(\w+)$', path)
+            if telegram: return self._telegram(telegram.group(1), params)
+            return self._golike(path, params)
+
+        def _telegram(self, method, params):
+            config.delay(); stats.record(f"telegram.{method}")
+            if method not in TELEGRAM_METHODS: return self._reply(404, {'ok': False, 'error_code': 404, 'description': 'Not Found: method not found'})
+            if method in ('sendMessage', 'editMessageText', 'sendDocument') and config.roll(config.tg_429_rate):
+                stats.record("telegram.429")
+                return self._reply(429, {'ok': False, 'error_code': 429, 'description': f"Too Many Requests: retry after {config.retry_after}",
+                                         'parameters': {'retry_after': config.retry_after}})
+            if method == 'getMe': result = {'id': 1, 'is_bot': True, 'first_name': 'mock', 'username': 'mock_bot'}
+            elif method == 'getWebhookInfo': result = {'url': '', 'has_custom_certificate': False, 'pending_update_count': 0}
+            elif method in ('sendMessage', 'editMessageText', 'sendDocument'):
+                message_id = int(params['message_id']) if params.get('message_id') else next(_message_ids)
+                result = {'message_id': message_id, 'date': int(time.time()), 'text': params.get('text', ''),
+                          'chat': {'id': int(params.get('chat_id', 0)), 'type': 'private'}}
+            else: result = True
+            return self._reply(200, {'ok': True, 'result': result})
+
+        def _golike(self, path, params):
+            config.delay(); token = self.headers.get('authorization', '')
+            if config.roll(config.error_rate):
+                stats.record("golike.error")
+                return self._reply(502, b"<html><body>502 Bad Gateway (mock)</body></html>", 'text/html')
+            if token.endswith('invalid'): return self._reply(401, {'success': False, 'message': 'Unauthenticated.'})
+            account_list = re.match(r'^/api/(instagram|threads)-account$', path)
+            if account_list:
+                platform = account_list.group(1); stats.record(f"golike.{platform}-account")
+                data = [{'id': i, 'status': 1, 'is_banned': 0, f'{platform}_username': f'{platform[:2]}_{i}'} for i in range(1, config.accounts + 1)]
+                return self._reply(200, {'success': True, 'data': data})
+            jobs = re.match(r'^/api/advertising/publishers/(instagram|threads)/(jobs|complete-jobs)$', path)
+            if not jobs: return self._reply(404, {'success': False, 'message': 'Not found'})
+            platform, action = jobs.groups()
+            if action == 'jobs':
+                account_id = params.get('instagram_account_id') or params.get('account_id')
+                stats.record(f"golike.{platform}.jobs", worker=(token, platform))
+                if not config.roll(config.job_rate): return self._reply(200, {'success': False, 'message': 'Hiện tại chưa có job mới', 'lock': None})
+                job = {'id': next(_message_ids), 'status': 0, 'price_per': config.price, 'price_after_cost': config.price, 'account_id': account_id}
+                return self._reply(200, {'success': True, 'data': job, 'lock': {'id': job['id']}})
+            stats.record(f"golike.{platform}.complete-jobs")
+            return self._reply(200, {'success': True, 'message': 'Thành công', 'data': {'prices': config.price}})
+
+    return Handler
+
+
+class MockHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Client huỷ request giữa chừng (worker bị dừng/task bị huỷ) là bình thường, không in traceback.
+        if isinstance(sys.exc_info()[1], ConnectionError): return
+        super().handle_error(request, client_address)
+
+
+def start_mock_server(config, host='127.0.0.1', port=0):
+    # -> (server, stats, base_url); server chạy trên thread nền, dừng bằng server.shutdown().
+    stats = MockStats(); server = MockHTTPServer((host, port), make_handler(config, stats))
+    threading.Thread(target=server.serve_forever, daemon=True, name="MOCK_SERVER").start()
+    return server, stats, f"http://{host}:{server.server_address[1]}"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock Golike gateway + Telegram Bot API.")
+    parser.add_argument('--host', default='127.0.0.1'); parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--accounts', type=int, default=5, help="Số UID mỗi nền tảng trả về")
+    parser.add_argument('--latency-ms', type=float, default=50); parser.add_argument('--jitter-ms', type=float, default=20)
+    parser.add_argument('--job-rate', type=float, default=0.3, help="Xác suất một lần hỏi job có job")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Xác suất Golike trả 502 HTML")
+    parser.add_argument('--tg-429-rate', type=float, default=0.0, help="Xác suất Telegram trả 429")
+    parser.add_argument('--retry-after', type=int, default=1); parser.add_argument('--price', type=int, default=50)
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+    config = MockConfig(args.accounts, args.latency_ms, args.jitter_ms, args.job_rate, args.error_rate, args.tg_429_rate, args.retry_after, args.price, args.seed)
+    server, _, base_url = start_mock_server(config, args.host, args.port)
+    print(f"Mock server: {base_url}", flush=True)
+    try:
+        while True: time.sleep(3600)
+    except KeyboardInterrupt: server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
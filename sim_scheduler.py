@@ -0,0 +1,101 @@
+# Mô phỏng offline để so sánh các chiến lược chọn UID (ACCOUNT_SCHEDULERS trong ib.py) trên cùng một trace.
+#
+#   python sim_scheduler.py trace.jsonl            # trace ghi bằng SCHED_TRACE_FILE=trace.jsonl khi chạy bot
+#   python sim_scheduler.py --synthetic 30 --hours 6
+#
+# Mỗi lần "hit" trong trace được coi là một job xuất hiện ở UID đó tại thời điểm ghi và còn nhận được trong
+# --job-ttl giây. Vòng lặp worker được mô phỏng theo giờ ảo giống worker thật: hỏi job mất --latency giây,
+# có job thì nghỉ JOB_DELAY_MIN-JOB_DELAY_MAX giây, trượt thì nghỉ NO_JOB_DELAY giây,
+# mọi UID đang cooldown thì chờ tới khi có UID sẵn sàng (tối đa 10s).
+import argparse
+import json
+import os
+import random
+import sys
+from collections import defaultdict, deque
+
+# Import ib dựng TeleBot (token phải có dấu ":") và mở storage: dùng token giả + storage trong RAM, không đụng DB thật.
+os.environ.setdefault('BOT_TOKEN', '1:sim'); os.environ.setdefault('STORAGE_BACKEND', 'memory')
+import ib
+
+
+def load_trace(path):
+    # -> {platform: {account_id: [(t, price), ...]}}, thời lượng trace (giây)
+    rows = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line: rows.append(json.loads(line))
+    if not rows: raise SystemExit(f"Trace {path} trống.")
+    t0 = min(r['t'] for r in rows); duration = max(r['t'] for r in rows) - t0
+    jobs = defaultdict(lambda: defaultdict(list))
+    for r in rows:
+        jobs[r['platform']].setdefault(r['account'], [])
+        if r['hit']: jobs[r['platform']][r['account']].append((r['t'] - t0, r['price']))
+    return jobs, duration
+
+
+def synthetic_trace(num_accounts, duration, seed):
+    # Phần lớn UID hiếm khi có job, một số ít "năng suất" có job thường xuyên với giá khác nhau.
+    rng = random.Random(seed); jobs = {}
+    for acc_id in range(1, num_accounts + 1):
+        rate = rng.choice([1 / 60, 1 / 300, 1 / 1800, 1 / 3600, 0.0])   # job/giây
+        price = rng.choice([30, 50, 80, 120]); t = 0.0; arrivals = []
+        while rate:
+            t += rng.expovariate(rate)
+            if t >= duration: break
+            arrivals.append((t, price))
+        jobs[acc_id] = arrivals
+    return {'instagram': jobs}
+
+
+def simulate(strategy, account_jobs, duration, job_ttl, latency, seed):
+    rng = random.Random(seed)
+    accounts = [{'id': acc_id, 'platform': 'sim', 'name': str(acc_id)} for acc_id in account_jobs]
+    pending = {acc_id: deque(sorted(arrivals)) for acc_id, arrivals in account_jobs.items()}
+    scheduler = ib.ACCOUNT_SCHEDULERS[strategy](accounts, now=0.0)
+    t = 0.0; polls = hits = 0; xu = 0
+    while t < duration:
+        account, wait = scheduler.next_account(now=t)
+        if account is None: t += min(wait, 10) if wait else 10; continue
+        t += latency; polls += 1; queue = pending[account['id']]
+        while queue and queue[0][0] < t - job_ttl: queue.popleft()       # job đã hết hạn trước khi được hỏi
+        if queue and queue[0][0] <= t:
+            _, price = queue.popleft(); hits += 1; xu += price
+            scheduler.record(account, True, price, now=t); t += latency + rng.uniform(ib.JOB_DELAY_MIN, ib.JOB_DELAY_MAX)
+        else: scheduler.record(account, False, now=t); t += ib.NO_JOB_DELAY
+    hours = duration / 3600 or 1
+    return {'strategy': strategy, 'xu_per_hour': round(xu / hours, 1), 'xu': xu, 'polls': polls, 'hits': hits,
+            'wasted_polls': polls - hits, 'hit_rate': round(hits / polls, 4) if polls else 0.0}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="So sánh chiến lược chọn UID trên trace hit/miss.")
+    parser.add_argument('trace', nargs='?', help="File JSONL ghi bằng SCHED_TRACE_FILE")
+    parser.add_argument('--synthetic', type=int, default=0, metavar='N', help="Sinh trace giả với N UID thay vì đọc file")
+    parser.add_argument('--hours', type=float, default=6, help="Thời lượng trace giả (giờ)")
+    parser.add_argument('--job-ttl', type=float, default=60, help="Số giây một job còn nhận được sau khi xuất hiện")
+    parser.add_argument('--latency', type=float, default=0.3, help="Thời gian một request Golike (giây)")
+    parser.add_argument('--strategies', default=','.join(ib.ACCOUNT_SCHEDULERS))
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', action='store_true', help="In kết quả dạng JSON")
+    args = parser.parse_args(argv)
+
+    if args.synthetic: duration = args.hours * 3600; trace = synthetic_trace(args.synthetic, duration, args.seed)
+    elif args.trace: trace, duration = load_trace(args.trace)
+    else: parser.error("Cần file trace hoặc --synthetic N")
+
+    results = []
+    for platform, account_jobs in trace.items():
+        for strategy in args.strategies.split(','):
+            result = simulate(strategy.strip(), account_jobs, duration, args.job_ttl, args.latency, args.seed)
+            result['platform'] = platform; results.append(result)
+
+    if args.json: json.dump(results, sys.stdout, indent=2); print(); return
+    print(f"{'platform':<10} {'strategy':<11} {'xu/giờ':>9} {'polls':>8} {'hits':>6} {'trượt':>8} {'hit rate':>9}")
+    for r in results:
+        print(f"{r['platform']:<10} {r['strategy']:<11} {r['xu_per_hour']:>9} {r['polls']:>8} {r['hits']:>6} {r['wasted_polls']:>8} {r['hit_rate']:>9}")
+
+
+if __name__ == '__main__':
+    main()
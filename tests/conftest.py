@@ -0,0 +1,6 @@
+# ib.py đọc cấu hình từ biến môi trường lúc import: token giả (TeleBot cần dấu ":") + storage trong RAM, không đụng DB/mạng thật.
+import os
+import sys
+
+os.environ.setdefault('BOT_TOKEN', '1:test'); os.environ.setdefault('STORAGE_BACKEND', 'memory')
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,54 @@
+# UpdateDispatcher qua route webhook: bỏ update_id trùng, trả 503 khi hàng đợi đầy, giữ thứ tự update của một chat.
+import json
+import threading
+import time
+
+import pytest
+
+import ib
+
+
+class FakeBot:
+    def __init__(self): self.processed = []; self.gate = threading.Event(); self.gate.set()
+
+    def process_new_updates(self, updates): self.gate.wait(5); self.processed.extend(update.update_id for update in updates)
+
+
+def post(client, update_id, chat_id=7):
+    body = {'update_id': update_id, 'message': {'message_id': update_id, 'date': 0, 'chat': {'id': chat_id, 'type': 'private'}, 'text': '/start'}}
+    return client.post(ib.WEBHOOK_URL_PATH, data=json.dumps(body), headers={'content-type': 'application/json'}).status_code
+
+
+def wait_for(predicate, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline: time.sleep(0.01)
+    return predicate()
+
+
+@pytest.fixture
+def dispatcher(monkeypatch):
+    bot = FakeBot(); monkeypatch.setattr(ib, 'bot', bot); monkeypatch.setattr(ib, 'UPDATE_ENQUEUE_TIMEOUT', 0.05)
+    dispatcher = ib.UpdateDispatcher(1, 1); monkeypatch.setattr(ib, 'UPDATE_DISPATCHER', dispatcher)
+    yield dispatcher, bot, ib.app.test_client()
+    bot.gate.set()
+
+
+def test_duplicate_update_ids_are_processed_once(dispatcher):
+    dispatcher, bot, client = dispatcher
+    assert [post(client, update_id) for update_id in (1, 1, 2, 1)] == [200, 200, 200, 200]
+    assert wait_for(lambda: dispatcher.stats()['processed'] == 2)
+    assert bot.processed == [1, 2] and dispatcher.stats()['duplicates'] == 2
+
+
+def test_full_queue_returns_503_and_accepts_the_retry(dispatcher):
+    dispatcher, bot, client = dispatcher
+    bot.gate.clear()
+    assert post(client, 10) == 200
+    assert wait_for(lambda: dispatcher.queues[0].qsize() == 0)   # update 10 đang xử lý (bị chặn)
+    assert post(client, 11) == 200   # lấp đầy hàng đợi (1 chỗ)
+    assert post(client, 12) == 503 and dispatcher.stats()['rejected'] == 1
+
+    bot.gate.set()
+    assert wait_for(lambda: dispatcher.stats()['processed'] == 2)
+    assert post(client, 12) == 200   # Telegram gửi lại: update bị từ chối không bị coi là trùng
+    assert wait_for(lambda: bot.processed == [10, 11, 12])
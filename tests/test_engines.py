@@ -0,0 +1,69 @@
+# Engine dùng chung theo token (JobEngineRegistry + leave_job): đếm chat gắn vào, chuyển engine khi chat chủ rời.
+# Không chạy worker thật: host được đánh dấu đang chạy với danh sách worker rỗng.
+import pytest
+
+import ib
+
+
+@pytest.fixture
+def states(monkeypatch):
+    monkeypatch.setattr(ib, 'JOB_ENGINES', ib.JobEngineRegistry())
+    created = []; chat_ids = []
+    def make(chat_id, token='Bearer shared'):
+        state = ib.UserJobState(token, chat_id, {'instagram': True, 'threads': False})
+        with ib.user_states_lock: ib.USER_JOB_STATES[chat_id] = state
+        created.append(state); chat_ids.append(chat_id); return state
+    yield make
+    for state in created:
+        while state.is_running: ib.leave_job(state)
+    with ib.user_states_lock:
+        for chat_id in chat_ids: ib.USER_JOB_STATES.pop(chat_id, None)
+
+
+def start_host(state):
+    assert ib.JOB_ENGINES.claim(state) is None
+    state.is_running = True
+
+
+def test_claim_attaches_same_token_only(states):
+    host = states(101); start_host(host)
+    sub = states(102); other = states(103, 'Bearer other')
+    assert ib.JOB_ENGINES.claim(sub) is host and sub.engine is host and sub.is_running
+    assert ib.JOB_ENGINES.claim(other) is None and other.engine is None
+    assert host.subscribers == (sub,) and ib.JOB_ENGINES.stats()['engines'] == 2
+
+
+def test_subscriber_leaves_engine_keeps_running(states):
+    host = states(111); start_host(host)
+    first = states(112); second = states(113)
+    ib.JOB_ENGINES.claim(first); ib.JOB_ENGINES.claim(second)
+
+    state, stopped, remaining = ib.leave_job(first)
+    assert (state, stopped, remaining) == (first, 0, 2)
+    assert not first.is_running and first.engine is None and host.is_running and host.subscribers == (second,)
+
+
+def test_host_leaving_hands_engine_to_first_subscriber(states):
+    host = states(121); start_host(host)
+    sub = states(122); ib.JOB_ENGINES.claim(sub)
+    host.total_money, host.total_success = 150, 3; sub.last_status_message_id = 77
+
+    state, stopped, remaining = ib.leave_job(host)
+    assert stopped == 0 and remaining == 1
+    assert state is ib.USER_JOB_STATES[121] and not state.is_running and state.total_money == 150   # chat chủ giữ tổng đã kiếm
+    assert ib.USER_JOB_STATES[122] is host and host.chat_id == 122 and host.is_running and host.last_status_message_id == 77
+    assert host.subscribers == () and ib.JOB_ENGINES.stats()['handovers'] == 1
+
+    state, stopped, remaining = ib.leave_job(host)   # chat cuối rời: engine dừng hẳn
+    assert remaining == 0 and not host.is_running
+    assert ib.JOB_ENGINES.stats()['engines'] == 0
+
+
+def test_host_leaving_stops_engine_when_successor_lease_fails(states, monkeypatch):
+    host = states(131); start_host(host)
+    sub = states(132); ib.JOB_ENGINES.claim(sub)
+    monkeypatch.setattr(ib.SHARDS, 'acquire', lambda chat_id: False)
+
+    state, stopped, remaining = ib.leave_job(host)
+    assert state is host and remaining == 0 and host.chat_id == 131
+    assert not host.is_running and not sub.is_running and sub.engine is None and host.subscribers == ()
@@ -0,0 +1,73 @@
+# Breaker + retry budget của GolikeGuard, với đồng hồ giả (không ngủ thật).
+import time
+import types
+
+import pytest
+
+import ib
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ib, 'time', types.SimpleNamespace(monotonic=lambda: now[0], time=time.time))
+    return now
+
+
+def test_breaker_opens_half_opens_and_closes():
+    breaker = ib.CircuitBreaker(3, 10, 40)
+    breaker.record(False, 0); breaker.record(False, 1)
+    assert breaker.state == 'closed' and breaker.peek(1) == 0
+    breaker.record(False, 2)
+    assert breaker.state == 'open' and breaker.peek(2) == 10 and breaker.trips == 1
+
+    assert breaker.peek(12) == 0
+    breaker.claim(12)
+    assert breaker.state == 'half_open' and breaker.peek(12) > 0   # chỉ một request thăm dò
+    breaker.record(False, 13)
+    assert breaker.state == 'open' and breaker.peek(13) == 20   # thăm dò thất bại: mở lại, thời gian gấp đôi
+
+    breaker.claim(33); breaker.record(True, 33)
+    assert breaker.state == 'closed' and breaker.failures == 0 and breaker.open_for == 10
+
+
+def test_breaker_open_time_is_capped():
+    breaker = ib.CircuitBreaker(1, 10, 25); now = 0
+    breaker.record(False, now)
+    for _ in range(3): now += breaker.open_for; breaker.claim(now); breaker.record(False, now)
+    assert breaker.open_for == 25
+
+
+def test_guard_blocks_endpoint_until_probe_succeeds(clock):
+    guard = ib.GolikeGuard(2, 10, 60, 60, 0.5)
+    for _ in range(2): guard.acquire('instagram/jobs', 'Bearer a'); guard.release('instagram/jobs', 'Bearer a', 'server_error')
+    with pytest.raises(ib.GatewayUnavailable) as blocked: guard.acquire('instagram/jobs', 'Bearer b')   # mọi token đều bị chặn
+    assert blocked.value.wait == 10
+    guard.acquire('threads/jobs', 'Bearer b')   # endpoint khác không bị ảnh hưởng
+
+    clock[0] += 10
+    guard.acquire('instagram/jobs', 'Bearer a')
+    with pytest.raises(ib.GatewayUnavailable): guard.acquire('instagram/jobs', 'Bearer b')   # thăm dò đang chạy
+    guard.release('instagram/jobs', 'Bearer a', 'ok')
+    guard.acquire('instagram/jobs', 'Bearer b')
+
+
+def test_guard_token_breaker_only_blocks_that_token(clock):
+    guard = ib.GolikeGuard(1, 10, 60, 60, 0.5)
+    guard.acquire('instagram/jobs', 'Bearer a'); guard.release('instagram/jobs', 'Bearer a', 'auth_error')
+    with pytest.raises(ib.GatewayUnavailable, match='token'): guard.acquire('instagram/jobs', 'Bearer a')
+    guard.acquire('instagram/jobs', 'Bearer b')
+
+
+def test_retry_budget_exhausts_and_refills(clock):
+    guard = ib.GolikeGuard(5, 10, 60, 2, 0.5)   # 2 lượt thử lại/phút
+    guard.acquire('threads/jobs', 'Bearer a'); guard.release('threads/jobs', 'Bearer a', 'timeout')
+    for _ in range(2): guard.acquire('threads/jobs', 'Bearer a'); guard.release('threads/jobs', 'Bearer a', 'timeout')
+    with pytest.raises(ib.GatewayUnavailable, match='thử lại') as blocked: guard.acquire('threads/jobs', 'Bearer a')
+    assert blocked.value.wait == pytest.approx(30)
+    assert guard.stats()['retries'] == 2
+
+    clock[0] += 30
+    guard.acquire('threads/jobs', 'Bearer a'); guard.release('threads/jobs', 'Bearer a', 'ok')
+    for _ in range(3): guard.acquire('threads/jobs', 'Bearer a'); guard.release('threads/jobs', 'Bearer a', 'ok')   # hết lỗi: không tốn budget
+    assert guard.stats()['retries'] == 3
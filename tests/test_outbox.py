@@ -0,0 +1,81 @@
+# TelegramOutbox với bot giả: gộp lệnh sửa cùng tin nhắn, lùi theo retry_after khi Telegram trả 429, giới hạn hàng đợi.
+import threading
+import time
+
+import pytest
+
+import ib
+
+
+class TooManyRequests(Exception):
+    def __init__(self, retry_after): super().__init__('429'); self.error_code = 429; self.result_json = {'parameters': {'retry_after': retry_after}}
+
+
+class FakeBot:
+    def __init__(self):
+        self.calls = []; self.gate = threading.Event(); self.gate.set(); self.failures = []
+
+    def _call(self, method, *args, **kwargs):
+        self.gate.wait(5); self.calls.append((method, time.monotonic(), args, kwargs))
+        if self.failures: raise self.failures.pop(0)
+        return (method, args, kwargs)
+
+    def send_message(self, *args, **kwargs): return self._call('send_message', *args, **kwargs)
+    def edit_message_text(self, *args, **kwargs): return self._call('edit_message_text', *args, **kwargs)
+
+
+@pytest.fixture
+def fake_bot(monkeypatch):
+    bot = FakeBot(); monkeypatch.setattr(ib, 'bot', bot)
+    return bot
+
+
+@pytest.fixture
+def outbox(fake_bot):
+    outbox = ib.TelegramOutbox(100, 100, 1000, 1000, 10, 2)
+    yield outbox
+    fake_bot.gate.set(); outbox.shutdown()
+
+
+def edit(outbox, text): return outbox.submit(1, 'edit_message_text', coalesce_key=('edit', 1, 5), chat_id=1, message_id=5, text=text)
+
+
+def test_pending_edits_of_one_message_are_coalesced(outbox, fake_bot):
+    fake_bot.gate.clear()
+    first = outbox.submit(1, 'send_message', 1, 'hello')   # chiếm chat 1: các lệnh sau phải chờ
+    while not outbox.busy: time.sleep(0.01)
+    futures = [edit(outbox, f'v{n}') for n in range(3)]
+    fake_bot.gate.set()
+
+    assert first.result(5)[0] == 'send_message'
+    assert futures[0] is futures[1] is futures[2] and futures[0].result(5)[2]['text'] == 'v2'
+    assert [(method, kwargs.get('text')) for method, _, _, kwargs in fake_bot.calls] == [('send_message', None), ('edit_message_text', 'v2')]
+    assert outbox.stats()['coalesced'] == 2
+
+
+def test_rate_limited_call_backs_off_and_retries(outbox, fake_bot):
+    fake_bot.failures.append(TooManyRequests(0.3))
+    started = time.monotonic()
+    assert outbox.submit(1, 'send_message', 1, 'hello').result(5)[0] == 'send_message'
+    assert len(fake_bot.calls) == 2 and fake_bot.calls[1][1] - started >= 0.3
+    assert outbox.stats()['rate_limited'] == 1 and outbox.stats()['sent'] == 1
+
+
+def test_rate_limited_edit_is_replaced_by_newer_edit(outbox, fake_bot):
+    fake_bot.failures.append(TooManyRequests(0.3))
+    older = edit(outbox, 'old')
+    while not fake_bot.calls: time.sleep(0.01)
+    newer = edit(outbox, 'new')   # bản cũ đang lùi theo 429: bản mới thay thế, cả hai cùng nhận kết quả của bản mới
+    assert newer.result(5)[2]['text'] == 'new' and older.result(5)[2]['text'] == 'new'
+    assert [kwargs['text'] for _, _, _, kwargs in fake_bot.calls] == ['old', 'new']
+
+
+def test_full_queue_rejects_new_calls(fake_bot):
+    outbox = ib.TelegramOutbox(100, 100, 1000, 1000, 1, 1); fake_bot.gate.clear()
+    try:
+        outbox.submit(1, 'send_message', 1, 'a')
+        while not outbox.busy: time.sleep(0.01)
+        outbox.submit(1, 'send_message', 1, 'b')
+        with pytest.raises(ib.OutboxFullError): outbox.submit(1, 'send_message', 1, 'c').result(1)
+        assert outbox.stats()['dropped'] == 1
+    finally: fake_bot.gate.set(); outbox.shutdown()
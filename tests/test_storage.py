@@ -0,0 +1,179 @@
+# Cùng một bộ kiểm thử cho mọi backend lưu trữ: SQLite (file tạm) và MemoryBackend (thay cho DB thật).
+import sys
+import threading
+import time
+import types
+
+import pytest
+
+import ib
+
+
+@pytest.fixture(params=['sqlite', 'memory'])
+def backend(request, tmp_path):
+    backend = ib.SQLiteBackend(str(tmp_path / 'test.db'), 2) if request.param == 'sqlite' else ib.MemoryBackend()
+    backend.init()
+    return backend
+
+
+def test_auth_upsert_get_delete(backend):
+    assert backend.fetch_auth(1) is None
+    backend.upsert_auth([(1, 'Bearer a', 1, 0, 2, 1), (2, 'Bearer b', 1, 1, 1, 1)])
+    assert tuple(backend.fetch_auth(1)) == ('Bearer a', 1, 0, 2, 1)
+    assert backend.count_auth() == 2
+
+    backend.upsert_auth([(1, 'Bearer c', 0, 1, 3, 4)])
+    assert tuple(backend.fetch_auth(1)) == ('Bearer c', 0, 1, 3, 4)
+    assert sorted(tuple(row) for row in backend.fetch_all_auth()) == [(1, 'Bearer c', 0, 1, 3, 4), (2, 'Bearer b', 1, 1, 1, 1)]
+
+    backend.delete_auth(1)
+    assert backend.fetch_auth(1) is None and backend.count_auth() == 1
+
+
+def test_cached_store_serves_hits_and_invalidates_on_write(backend):
+    store = ib.CachedStore(backend, cache_size=10, cache_ttl=60)
+    store.save_auth(1, 'Bearer a', True, False)
+    assert tuple(store.get_auth(1)) == ('Bearer a', 1, 0, 1, 1)
+    assert tuple(store.get_auth(1)) == ('Bearer a', 1, 0, 1, 1) and store.cache_hits == 1
+
+    backend.upsert_auth([(1, 'Bearer other-node', 1, 1, 1, 1)])   # ghi vòng qua cache: bản cache còn hạn vẫn được trả
+    assert store.get_auth(1)[0] == 'Bearer a'
+    store.save_auth(1, 'Bearer b', True, True)
+    assert store.get_auth(1)[0] == 'Bearer b'
+    store.delete_auth(1)
+    assert store.get_auth(1) is None
+
+
+def test_cached_store_does_not_cache_misses(backend):
+    store = ib.CachedStore(backend, cache_size=10, cache_ttl=60)
+    assert store.get_auth(7) is None
+    backend.upsert_auth([(7, 'Bearer new', 1, 1, 1, 1)])
+    assert store.get_auth(7)[0] == 'Bearer new'
+
+
+def test_cached_store_ttl_and_lru_bound(backend):
+    store = ib.CachedStore(backend, cache_size=2, cache_ttl=0)
+    store.save_auth(1, 'Bearer a', True, True)
+    store.get_auth(1); backend.upsert_auth([(1, 'Bearer b', 1, 1, 1, 1)])
+    assert store.get_auth(1)[0] == 'Bearer b'   # TTL 0: không bao giờ dùng bản cache
+
+    store = ib.CachedStore(backend, cache_size=2, cache_ttl=60)
+    backend.upsert_auth([(chat_id, f'Bearer {chat_id}', 1, 1, 1, 1) for chat_id in (1, 2, 3)])
+    for chat_id in (1, 2, 3): store.get_auth(chat_id)
+    assert list(store.cache) == [2, 3]
+
+
+def test_cached_store_disabled(backend):
+    store = ib.CachedStore(backend, cache_size=0)
+    store.save_auth(1, 'Bearer a', True, True); store.get_auth(1)
+    backend.upsert_auth([(1, 'Bearer b', 1, 1, 1, 1)])
+    assert store.get_auth(1)[0] == 'Bearer b' and not store.cache
+
+
+def test_ledger_insert_and_rollups(backend):
+    store = ib.CachedStore(backend)
+    now = time.time(); hour = ib.rollup_bucket('hour', now); day = ib.rollup_bucket('day', now)
+    store.append_jobs([(1, 'instagram', '11', 'j1', 50, 1, 120, now), (1, 'instagram', '11', 'j2', 0, 0, 80, now),
+                       (1, 'threads', '22', 'j3', 30, 1, 90, now), (2, 'threads', '33', 'j4', 40, 1, 70, now)])
+    store.append_jobs([(1, 'instagram', '12', 'j5', 20, 1, 60, now)])   # lô sau cộng dồn vào cùng bucket
+    assert sorted(tuple(row) for row in store.fetch_rollups(1, 'hour', hour)) == [(hour, 'instagram', 2, 1, 70), (hour, 'threads', 1, 0, 30)]
+    assert sorted(tuple(row) for row in store.fetch_rollups(1, 'day', day)) == [(day, 'instagram', 2, 1, 70), (day, 'threads', 1, 0, 30)]
+    assert store.fetch_rollups(1, 'hour', hour + 3600) == []
+
+
+def test_lease_acquire_renew_release(backend):
+    now = 1000.0
+    assert backend.acquire_lease(5, 'node-a', now + 30, now)
+    assert backend.acquire_lease(5, 'node-a', now + 40, now + 1)        # node đang giữ lấy lại được
+    assert not backend.acquire_lease(5, 'node-b', now + 40, now + 10)   # còn hạn: node khác không chiếm được
+    backend.renew_leases('node-a', now + 100)
+    assert not backend.acquire_lease(5, 'node-b', now + 130, now + 60)
+    assert [tuple(row) for row in backend.live_leases(now + 60)] == [(5, 'node-a')]
+
+    backend.release_lease(5, 'node-b')   # node không giữ lease thì không trả được
+    assert [tuple(row) for row in backend.live_leases(now + 60)] == [(5, 'node-a')]
+    backend.release_lease(5, 'node-a')
+    assert backend.live_leases(now + 60) == []
+    assert backend.acquire_lease(5, 'node-b', now + 90, now + 60)
+
+
+def test_lease_expires(backend):
+    assert backend.acquire_lease(6, 'node-a', 1030.0, 1000.0)
+    assert backend.acquire_lease(6, 'node-b', 1100.0, 1031.0)
+    assert [tuple(row) for row in backend.live_leases(1031.0)] == [(6, 'node-b')]
+
+
+# PostgresBackend không có DB thật ở đây: psycopg2 giả ghi lại từng câu SQL + tham số gửi đi.
+class FakeCursor:
+    def __init__(self, log): self.log = log; self.rowcount = 1; self.result = []
+    def __enter__(self): return self
+    def __exit__(self, *exc): return False
+    def execute(self, sql, params=None): self.log.append((sql, params))
+    def fetchone(self): return self.result[0] if self.result else None
+    def fetchall(self): return list(self.result)
+
+
+class FakeConnection:
+    def __init__(self, log): self.log = log; self.cursors = []
+    def __enter__(self): return self
+    def __exit__(self, *exc): return False
+    def cursor(self): self.cursors.append(FakeCursor(self.log)); return self.cursors[-1]
+
+
+class FakePool:
+    def __init__(self, minconn, maxconn, dsn): self.maxconn = maxconn; self.out = 0; self.peak = 0; self.log = []; self.lock = threading.Lock()
+
+    def getconn(self):
+        with self.lock:
+            if self.out >= self.maxconn: raise RuntimeError('connection pool exhausted')   # như psycopg2.pool.PoolError
+            self.out += 1; self.peak = max(self.peak, self.out)
+        time.sleep(0.01); return FakeConnection(self.log)
+
+    def putconn(self, conn):
+        with self.lock: self.out -= 1
+
+
+@pytest.fixture
+def pg(monkeypatch):
+    psycopg2 = types.ModuleType('psycopg2'); pool = types.ModuleType('psycopg2.pool'); extras = types.ModuleType('psycopg2.extras')
+    pool.ThreadedConnectionPool = FakePool
+    extras.execute_values = lambda cur, sql, rows, page_size=100: cur.log.append((sql, list(rows)))
+    psycopg2.pool = pool; psycopg2.extras = extras
+    for name, module in (('psycopg2', psycopg2), ('psycopg2.pool', pool), ('psycopg2.extras', extras)): monkeypatch.setitem(sys.modules, name, module)
+    return ib.PostgresBackend('postgresql://fake', 0, 2)
+
+
+def test_postgres_rewrites_placeholders(pg):
+    pg.fetch_auth(1); pg.delete_auth(2); pg.fetch_rollups(3, 'hour', 3600); pg.delete_snapshot(4)
+    assert pg.pool.log == [(ib.SQL_SELECT_AUTH.replace('?', '%s'), (1,)), (ib.SQL_DELETE_AUTH.replace('?', '%s'), (2,)),
+                           (ib.SQL_SELECT_ROLLUPS.replace('?', '%s'), (3, 'hour', 3600)), (ib.SQL_DELETE_SNAPSHOT.replace('?', '%s'), (4,))]
+    assert all('?' not in sql for sql, _ in pg.pool.log)
+
+
+def test_postgres_batched_upserts(pg):
+    pg.upsert_auth([])
+    pg.upsert_auth([(1, 'Bearer a', 1, 1, 1, 1), (2, 'Bearer b', 1, 0, 1, 1), (1, 'Bearer c', 0, 1, 2, 2)])   # trùng chat_id: giữ bản cuối
+    rows = [(1, 'instagram', '11', 'j1', 50, 1, 120, 10.0)]; rollups = [(1, 'hour', 0, 'instagram', 1, 0, 50)]
+    pg.append_jobs(rows, rollups); pg.save_snapshots([(1, '{}', 10.0)])
+    assert pg.pool.log == [(ib.PG_UPSERT_AUTH, [(1, 'Bearer c', 0, 1, 2, 2), (2, 'Bearer b', 1, 0, 1, 1)]),
+                           (ib.PG_INSERT_LEDGER, rows), (ib.PG_UPSERT_ROLLUP, rollups), (ib.PG_UPSERT_SNAPSHOT, [(1, '{}', 10.0)])]
+
+
+def test_postgres_lease_sql(pg):
+    assert pg.acquire_lease(5, 'node-a', 1030.0, 1000.0)
+    pg.renew_leases('node-a', 1100.0); pg.release_lease(5, 'node-a'); pg.remove_node('node-a')
+    assert pg.pool.log == [(ib.SQL_ACQUIRE_LEASE.replace('?', '%s'), (5, 'node-a', 1030.0, 1000.0)),
+                           (ib.SQL_RENEW_LEASES.replace('?', '%s'), (1100.0, 'node-a')),
+                           (ib.SQL_RELEASE_LEASE.replace('?', '%s'), (5, 'node-a')),
+                           (ib.SQL_RELEASE_NODE_LEASES.replace('?', '%s'), ('node-a',)), (ib.SQL_DELETE_NODE.replace('?', '%s'), ('node-a',))]
+
+
+def test_postgres_waits_for_free_connection(pg):
+    errors = []
+    def call():
+        try: pg.fetch_auth(1)
+        except Exception as exc: errors.append(exc)
+    threads = [threading.Thread(target=call) for _ in range(8)]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    assert errors == [] and pg.pool.peak == 2 and len(pg.pool.log) == 8